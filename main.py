@@ -1,47 +1,204 @@
-from dataclasses import dataclass
-from typing import List, Sequence
+from dataclasses import dataclass, fields, replace
+from typing import List
+from concurrent.futures import Future, ThreadPoolExecutor
+from collections import deque
+from contextlib import contextmanager, redirect_stdout
+import argparse
+import ctypes
+import glob
+import itertools
+import json
+import os
+import sys
+import zipfile
+import zlib
+if "--benchmark" in sys.argv:
+    # The benchmark renders without a window. PyOpenGL picks its platform when it is first imported
+    os.environ.setdefault("PYOPENGL_PLATFORM", "egl")
+    os.environ.setdefault("EGL_PLATFORM", "surfaceless")
+    os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")  # Only the report goes to stdout, so it can be redirected into a file
+import queue
 import pygame
 import math
+import re
 import time
 from pygame.locals import *
 from OpenGL.GL import *
+from OpenGL.GL import shaders
 from OpenGL.GLUT import *
 from OpenGL.GLU import *
+from OpenGL.GL.EXT.texture_filter_anisotropic import *
+from OpenGL.GL.EXT.texture_compression_s3tc import *
+from OpenGL.raw.GL.VERSION.GL_1_3 import glGetCompressedTexImage as glGetCompressedTexImageRaw
+from OpenGL.raw.GL.VERSION.GL_3_3 import glGetQueryObjectui64v as glGetQueryObjectui64vRaw  # The wrapped one cannot make its 64 bit output array
 from PIL import Image
 import numpy as np
 
 global timeVar; timeVar = 0  # Time since the beginning of the program
 
 def draw_house_at(models, position, rotate, scale):
-    for object in models:
-        glPushMatrix()
-        glTranslate(*position)
-        glScale(*scale)
-        if rotate:
-            glRotate(180, 0, 1, 0)
-        draw_model(object)
-        glPopMatrix()
+    with gl_state.batch():
+        for object in models:
+            glPushMatrix()
+            glTranslate(*position)
+            glScale(*scale)
+            if rotate:
+                glRotate(180, 0, 1, 0)
+            draw_model(object)
+            glPopMatrix()
+
+# Texture settings
+texture_max_size = None  # Textures larger than this many pixels on a side are downsampled when loaded. None keeps the source size
+texture_anisotropy = 8.0  # Anisotropic filtering level used when the driver supports it, clamped to the driver maximum
+texture_compression = False  # Keep textures S3TC (DXT1) compressed on the GPU and in the texture cache when the driver supports it. Lossy, so off unless asked for
 
-def load_texture(image_path):
-    """Loads a texture from an image file and returns the texture ID."""
-    # Generate a texture ID
-    texture_id = glGenTextures(1)
-    glBindTexture(GL_TEXTURE_2D, texture_id)
-
-    # Load the image using PIL
+@dataclass
+class TextureImage:
+    width : int
+    height : int
+    pixels : bytes or None # RGB rows from the bottom of the image to the top, as expected by glTexImage2D. None if levels is set
+    source : str or None = None # The image file this texture was read from
+    levels : list or None = None # Mipmap chain read from the texture cache as (width, height, data) tuples, largest level first
+    format : int = GL_RGB # Internal format of the data in levels, GL_RGB or a compressed format
+
+def decode_image(image_path):
+    """Reads an image file at its own resolution, downsampled to fit texture_max_size."""
     image = Image.open(image_path)
-    image = image.transpose(Image.FLIP_TOP_BOTTOM)  # Flip the image vertically
-    img_data = image.convert("RGB").tobytes()
+    image = image.transpose(Image.FLIP_TOP_BOTTOM).convert("RGB")  # Flip the image vertically
+    if texture_max_size is not None and max(image.width, image.height) > texture_max_size:
+        image.thumbnail((texture_max_size, texture_max_size), Image.LANCZOS)  # Keeps the aspect ratio
+    return TextureImage(image.width, image.height, image.tobytes(), image_path)
+
+def decode_texture(image_path):
+    """Reads a texture from the texture cache of an image file, or from the image file itself if the cache is missing or stale."""
+    cached = load_texture_cache(image_path)
+    if cached is not None:
+        return cached
+    return decode_image(image_path)
+
+# The texture cache of an image is stored next to it as <image>.texcache. It holds the texels of every mipmap level
+# exactly as the driver stored them, so loading it is a memory map and uploading it needs no decoding or mipmapping.
+# Layout: texture_cache_header, one texture_cache_level per mipmap level, then the data of every level.
+texture_cache_version = 1 # Bump whenever the layout of the cache files changes
+texture_cache_header = np.dtype([("magic", "S8"), ("version", "<i4"), ("format", "<i4"), ("level_count", "<i4"),
+                                 ("max_size", "<i4"), ("source_mtime", "<i8"), ("source_size", "<i8")])
+texture_cache_level = np.dtype([("width", "<i4"), ("height", "<i4"), ("offset", "<i8"), ("size", "<i8")])
+
+def texture_cache_file(image_path):
+    return image_path + ".texcache"
+
+def texture_compression_format():
+    """Returns the compressed format new textures are stored in, or None if compression is off or not supported."""
+    if texture_compression and glInitTextureCompressionS3TcEXT():
+        return GL_COMPRESSED_RGB_S3TC_DXT1_EXT
+    return None
+
+def load_texture_cache(image_path):
+    """Memory maps the texture cache of an image file. Returns a TextureImage with levels set, or None if there is no
+    cache or it was written for a different version of the image or a different texture_max_size."""
+    try:
+        data = np.memmap(texture_cache_file(image_path), dtype=np.uint8, mode='r')
+        header = np.frombuffer(data, texture_cache_header, 1)[0]
+        source = os.stat(image_path)
+    except (OSError, ValueError):
+        return None
+    if (header["magic"] != b"TEXCACHE" or header["version"] != texture_cache_version or header["max_size"] != (texture_max_size or 0)
+            or header["source_mtime"] != source.st_mtime_ns or header["source_size"] != source.st_size):
+        return None
+    table = np.frombuffer(data, texture_cache_level, header["level_count"], texture_cache_header.itemsize)
+    levels = [(int(level["width"]), int(level["height"]), data[level["offset"]:level["offset"] + level["size"]]) for level in table]
+    return TextureImage(levels[0][0], levels[0][1], None, image_path, levels, int(header["format"]))
+
+def save_texture_cache(image_path, levels, format):
+    """Writes the mipmap chain of an image file to its texture cache. Failing to write the cache is not fatal."""
+    source = os.stat(image_path)
+    header = np.zeros(1, texture_cache_header)
+    header[0] = (b"TEXCACHE", texture_cache_version, format, len(levels), texture_max_size or 0, source.st_mtime_ns, source.st_size)
+    table = np.zeros(len(levels), texture_cache_level)
+    offset = texture_cache_header.itemsize + texture_cache_level.itemsize * len(levels)
+    for index, (width, height, data) in enumerate(levels):
+        table[index] = (width, height, offset, data.nbytes)
+        offset += data.nbytes
+    temp_file = texture_cache_file(image_path) + ".tmp"
+    try:
+        with open(temp_file, 'wb') as cache:
+            cache.write(header.tobytes())
+            cache.write(table.tobytes())
+            for _, _, data in levels:
+                cache.write(data.tobytes())
+        os.replace(temp_file, texture_cache_file(image_path))
+    except OSError as error:
+        print("Cannot write texture cache for " + image_path + ": " + str(error))
+
+def read_texture_levels():
+    """Reads back every mipmap level of the bound texture as stored by the driver.
+    Returns the (width, height, data) levels and their internal format, GL_RGB if the texture is not compressed."""
+    compressed = glGetTexLevelParameteriv(GL_TEXTURE_2D, 0, GL_TEXTURE_COMPRESSED)
+    format = glGetTexLevelParameteriv(GL_TEXTURE_2D, 0, GL_TEXTURE_INTERNAL_FORMAT) if compressed else GL_RGB
+    levels = []
+    glPixelStorei(GL_PACK_ALIGNMENT, 1)
+    while True:
+        level = len(levels)
+        width = glGetTexLevelParameteriv(GL_TEXTURE_2D, level, GL_TEXTURE_WIDTH)
+        height = glGetTexLevelParameteriv(GL_TEXTURE_2D, level, GL_TEXTURE_HEIGHT)
+        if compressed:
+            data = np.empty(glGetTexLevelParameteriv(GL_TEXTURE_2D, level, GL_TEXTURE_COMPRESSED_IMAGE_SIZE), dtype=np.uint8)
+            glGetCompressedTexImageRaw(GL_TEXTURE_2D, level, data) # The PyOpenGL wrapper always reads level 0
+        else:
+            data = np.frombuffer(glGetTexImage(GL_TEXTURE_2D, level, GL_RGB, GL_UNSIGNED_BYTE), dtype=np.uint8)
+        levels.append((width, height, data))
+        if width <= 1 and height <= 1:
+            break
+    glPixelStorei(GL_PACK_ALIGNMENT, 4)
+    return levels, format
+
+def upload_texture(image, texture_id = None):
+    """Sends a TextureImage to the GPU with a full mipmap chain and returns the texture ID. Leaves the texture bound.
+
+    The image is stored into texture_id if given, otherwise a new texture ID is generated. Images that were decoded
+    from their source file are written to the texture cache once the driver has built their mipmaps."""
+    if texture_id is None:
+        texture_id = glGenTextures(1)
+    glBindTexture(GL_TEXTURE_2D, texture_id)
 
     # Set texture parameters
     glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_REPEAT)  # Repeat texture horizontally
     glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_REPEAT)  # Repeat texture vertically
-    glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)  # Linear filtering
+    glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR_MIPMAP_LINEAR)  # Trilinear filtering
     glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
-
-    # Upload the texture data
-    glTexImage2D(GL_TEXTURE_2D, 0, GL_RGB, image.width, image.height,
-                 0, GL_RGB, GL_UNSIGNED_BYTE, img_data)
+    if glInitTextureFilterAnisotropicEXT():
+        glTexParameterf(GL_TEXTURE_2D, GL_TEXTURE_MAX_ANISOTROPY_EXT, min(texture_anisotropy, glGetFloatv(GL_MAX_TEXTURE_MAX_ANISOTROPY_EXT)))
+
+    if image.levels is not None and image.format != (texture_compression_format() or GL_RGB):
+        image = decode_image(image.source)  # The cache was written with compression set differently, or by a driver that supports a format this one does not
+
+    glPixelStorei(GL_UNPACK_ALIGNMENT, 1)  # Rows of RGB pixels are not padded to 4 bytes
+    if image.levels is not None:
+        # Upload the cached mipmap chain as is
+        for level, (width, height, data) in enumerate(image.levels):
+            if image.format == GL_RGB:
+                glTexImage2D(GL_TEXTURE_2D, level, GL_RGB, width, height, 0, GL_RGB, GL_UNSIGNED_BYTE, data)
+            else:
+                glCompressedTexImage2D(GL_TEXTURE_2D, level, image.format, width, height, 0, data)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAX_LEVEL, len(image.levels) - 1)
+    else:
+        # Upload the texture data and build the smaller levels from it
+        if bool(glGenerateMipmap):
+            glTexImage2D(GL_TEXTURE_2D, 0, GL_RGB, image.width, image.height,
+                         0, GL_RGB, GL_UNSIGNED_BYTE, image.pixels)
+            glGenerateMipmap(GL_TEXTURE_2D)
+        else:
+            gluBuild2DMipmaps(GL_TEXTURE_2D, GL_RGB, image.width, image.height, GL_RGB, GL_UNSIGNED_BYTE, image.pixels)
+        compressed_format = texture_compression_format()
+        if compressed_format is not None:
+            # Building mipmaps of a compressed texture is not reliably supported, so each level built uncompressed is compressed on its own
+            levels, _ = read_texture_levels()
+            for level, (width, height, data) in enumerate(levels):
+                glTexImage2D(GL_TEXTURE_2D, level, compressed_format, width, height, 0, GL_RGB, GL_UNSIGNED_BYTE, data)
+        if image.source is not None:
+            save_texture_cache(image.source, *read_texture_levels())
+    glPixelStorei(GL_UNPACK_ALIGNMENT, 4)
+    gl_state.forget(("texture",))
 
     return texture_id
 
@@ -51,6 +208,86 @@ def draw_at(draw_func, posx, posy, posz):
     draw_func()
     glPopMatrix()
 
+class GLStateCache:
+    """Remembers the value last set of the enables, texture binding, material and light parameters set through it and
+    skips the calls that would set them to the value they already have. Code that changes the same state directly,
+    like display lists, must forget it so the next call is made."""
+    def __init__(self):
+        self.values = {} # Value of each piece of state, by key
+        self.pending = None # While batching, (value, call, args) of the restores held back, by key
+        self.skipped = 0 # Calls skipped since take_skipped was last called
+
+    def set(self, key, value, call, *args):
+        """Makes call(*args), which sets the state key to value, unless it already has that value."""
+        if self.pending is not None and self.pending.pop(key, None) is not None:
+            self.skipped += 1
+        if key in self.values and self.values[key] == value:
+            self.skipped += 1
+            return
+        self.values[key] = value
+        call(*args)
+
+    def restore(self, key, value, call, *args):
+        """Like set, for putting state back the way it is left between draws. In a batch, it waits for the end of the
+        batch and is dropped when the state is set again before."""
+        if self.pending is None:
+            self.set(key, value, call, *args)
+            return
+        if key in self.pending:
+            self.skipped += 1
+        self.pending[key] = (value, call, args)
+
+    @contextmanager
+    def batch(self):
+        """Holds back restores until the end, so draws that use the same state one after the other only set it once."""
+        if self.pending is not None:
+            yield
+            return
+        self.pending = {}
+        try:
+            yield
+        finally:
+            pending, self.pending = self.pending, None
+            for key, (value, call, args) in pending.items():
+                self.set(key, value, call, *args)
+
+    @contextmanager
+    def compiling(self):
+        """For calls recorded into a display list. The list may be called whatever the state is then, so it starts from
+        unknown state. Nothing is executed, so what is known of the current state is kept for after."""
+        values, pending, skipped = self.values, self.pending, self.skipped
+        self.values, self.pending = {}, None
+        try:
+            yield
+        finally:
+            self.values, self.pending, self.skipped = values, pending, skipped
+
+    def forget(self, *prefixes):
+        """Forgets the state whose keys start with any of prefixes, or all of it without any."""
+        self.values = {key: value for key, value in self.values.items() if prefixes and not any(key[:len(prefix)] == prefix for prefix in prefixes)}
+
+    def take_skipped(self):
+        skipped, self.skipped = self.skipped, 0
+        return skipped
+
+    def enable(self, capability, restore=False):
+        (self.restore if restore else self.set)(("enable", capability), True, glEnable, capability)
+
+    def disable(self, capability, restore=False):
+        (self.restore if restore else self.set)(("enable", capability), False, glDisable, capability)
+
+    def bind_texture(self, texture_id, restore=False):
+        (self.restore if restore else self.set)(("texture", GL_TEXTURE_2D), texture_id, glBindTexture, GL_TEXTURE_2D, texture_id)
+
+    def material(self, face, name, value, restore=False):
+        (self.restore if restore else self.set)(("material", face, name), tuple(np.ravel(value).tolist()), glMaterial, face, name, value)
+
+    def light(self, light, name, value):
+        """Not for GL_POSITION and GL_SPOT_DIRECTION, which are transformed by the modelview matrix of when they are set."""
+        self.set(("light", light, name), tuple(np.ravel(value).tolist()), glLightfv, light, name, np.ravel(value))
+
+gl_state = GLStateCache()
+
 @dataclass
 class Material:
     specular_exponent : float # Ns
@@ -63,18 +300,18 @@ class Material:
     illum : int
 
     def bind(self):
-        glMaterial(GL_FRONT, GL_SPECULAR, self.specular_reflection)
-        glMaterial(GL_FRONT, GL_AMBIENT, self.ambient_reflection)
-        glMaterial(GL_FRONT, GL_DIFFUSE, self.diffused_reflection)
-        glMaterial(GL_FRONT, GL_SHININESS, [self.specular_exponent])
-        glMaterial(GL_FRONT, GL_EMISSION, self.emissive_material)
+        gl_state.material(GL_FRONT, GL_SPECULAR, self.specular_reflection)
+        gl_state.material(GL_FRONT, GL_AMBIENT, self.ambient_reflection)
+        gl_state.material(GL_FRONT, GL_DIFFUSE, self.diffused_reflection)
+        gl_state.material(GL_FRONT, GL_SHININESS, [self.specular_exponent])
+        gl_state.material(GL_FRONT, GL_EMISSION, self.emissive_material)
 
     def unbind(self):
-        glMaterial(GL_FRONT, GL_SPECULAR, Model.default_material.specular_reflection)
-        glMaterial(GL_FRONT, GL_AMBIENT, Model.default_material.ambient_reflection)
-        glMaterial(GL_FRONT, GL_DIFFUSE, Model.default_material.diffused_reflection)
-        glMaterial(GL_FRONT, GL_SHININESS, [Model.default_material.specular_exponent])
-        glMaterial(GL_FRONT, GL_EMISSION, Model.default_material.emissive_material)
+        gl_state.material(GL_FRONT, GL_SPECULAR, Model.default_material.specular_reflection, restore=True)
+        gl_state.material(GL_FRONT, GL_AMBIENT, Model.default_material.ambient_reflection, restore=True)
+        gl_state.material(GL_FRONT, GL_DIFFUSE, Model.default_material.diffused_reflection, restore=True)
+        gl_state.material(GL_FRONT, GL_SHININESS, [Model.default_material.specular_exponent], restore=True)
+        gl_state.material(GL_FRONT, GL_EMISSION, Model.default_material.emissive_material, restore=True)
 
     @staticmethod
     def load(mtl_file):
@@ -88,51 +325,58 @@ class Material:
         illum = 2
         with open(mtl_file, 'r') as mtl:
             for line in mtl:
-                line = line.strip()
-                if line.startswith("newmtl"): # Expects only one material
+                tokens = line.split()
+                if len(tokens) == 0:
                     continue
-                if line.startswith("#"):
+                key, values = tokens[0], tokens[1:]
+                if key == "newmtl": # Expects only one material
                     continue
-                if len(line) == 0:
+                if key.startswith("#"):
                     continue
 
-                if line.startswith("Ns"): specular_exponent = float(line.split()[1])
-                elif line.startswith("Ka"): ambient_reflection = [float(line.split()[1]), float(line.split()[2]), float(line.split()[3])]
-                elif line.startswith("Kd"): diffused_reflection = [float(line.split()[1]), float(line.split()[2]), float(line.split()[3])]
-                elif line.startswith("Ks"): specular_reflection = [float(line.split()[1]), float(line.split()[2]), float(line.split()[3])]
-                elif line.startswith("Ke"): emissive_material = [float(line.split()[1]), float(line.split()[2]), float(line.split()[3])]
-                elif line.startswith("Ni"): index_of_reflection = float(line.split()[1])
-                elif line.startswith("d"): dissolve_index = float(line.split()[1])
-                elif line.startswith("illum"): illum = int(line.split()[1])
-                else: print("Cannot parse line of material file: " + line)
+                if key == "Ns": specular_exponent = float(values[0])
+                elif key == "Ka": ambient_reflection = [float(v) for v in values[:3]]
+                elif key == "Kd": diffused_reflection = [float(v) for v in values[:3]]
+                elif key == "Ks": specular_reflection = [float(v) for v in values[:3]]
+                elif key == "Ke": emissive_material = [float(v) for v in values[:3]]
+                elif key == "Ni": index_of_reflection = float(values[0])
+                elif key == "d": dissolve_index = float(values[0])
+                elif key == "illum": illum = int(values[0])
+                else: print("Cannot parse line of material file: " + line.strip())
         return Material(specular_exponent, ambient_reflection, diffused_reflection, specular_reflection, emissive_material, index_of_reflection, dissolve_index, illum)
 
 @dataclass
 class Model:
     default_material = Material(1, [1, 1, 1], [1, 1, 1], [1, 1, 1], [0, 0, 0], 1, 1, 2)
+    _unknown_line = re.compile(r'^[ \t]*(?!(?:v|vn|vt|f|mtllib|o|s|usemtl)(?:[ \t]|$)|#)(\S.*)$', re.M) # o, s and usemtl are ignored. Expects only one object and one material
+    _face_corner = re.compile(r'(?<!\S)-?\d+/-?\d+/-?\d+(?!\S)') # One v/vt/vn corner of a face line
     # From obj file
-    vertices : List[List[float]] # Vertex Array
-    normals : List[List[float]] # Normals Array
-    uvs : List[List[float]] # Texture Vertex Array
-    faces : List[List[List[int]]] # Faces Array. 1 index to vertices, 2 index to texture coordinates, 3 index to normals
+    vertices : np.ndarray # Vertex Array, (n, 3) float32
+    normals : np.ndarray # Normals Array, (n, 3) float32
+    uvs : np.ndarray # Texture Vertex Array, (n, 2) float32
+    faces : np.ndarray # Face corners of every face back to back, (n, 3) int32. 1 index to vertices, 2 index to texture coordinates, 3 index to normals
+    face_sizes : np.ndarray # Number of corners in each face, (n,) int32. Face i is faces[sum(face_sizes[:i]):sum(face_sizes[:i + 1])]
     # From mtl file
     material : Material
     # From .png or similar file
-    texture : Sequence[int] or None
+    texture : TextureImage or None
     texture_id : int # The texture index of where the texture is stored at on the gpu. If not yet passed to gpu, -1.
+    # Built from the obj file at load
+    vertex_data : np.ndarray # Every unique corner of the faces as interleaved GL_T2F_N3F_V3F vertices, (n, 8) float32
+    indices : np.ndarray # Triangulated faces as indices into vertex_data, (n * 3,) uint16 if vertex_data is small enough, uint32 otherwise
+    vbo : int # The buffer index of where vertex_data is stored at on the gpu. If not yet passed to gpu, -1.
+    ibo : int # The buffer index of where indices is stored at on the gpu. If not yet passed to gpu, -1.
 
     # Sends the texture to the GPU and stores the texture id into texture_id. Throws if texture_id is not -1.
     # When leaving this method, the currently bound texture is this texture
-    def send_texture(self, resolution):
+    def send_texture(self):
         if self.texture_id != -1: raise Exception("Texture is already in GPU.")
         if self.texture is None: raise Exception("Cannot send a texture if there is not one to send.")
-        self.texture_id = glGenTextures(1)
-        glBindTexture(GL_TEXTURE_2D, self.texture_id)
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_REPEAT)
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_REPEAT)
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
-        glTexImage2D(GL_TEXTURE_2D, 0, GL_RGB, resolution, resolution, 0, GL_RGB, GL_UNSIGNED_BYTE, self.texture) # TODO: 1024 magic number
+        self.texture_id = upload_texture(self.texture)
+
+    # Corners (lower, upper) of the box around the vertices
+    def bounds(self):
+        return self.vertices.min(0), self.vertices.max(0)
 
     def clear_texture(self):
         if self.texture_id == -1: raise Exception("Texture is not loaded into GPU.")
@@ -141,92 +385,868 @@ class Model:
 
     def bind_texture(self):
         if self.texture_id == -1: raise Exception("Texture is not loaded into GPU.")
-        glEnable(GL_TEXTURE_2D)
-        glBindTexture(GL_TEXTURE_2D, self.texture_id)
+        gl_state.enable(GL_TEXTURE_2D)
+        gl_state.bind_texture(self.texture_id)
 
     def unbind_texture(self):
         if self.texture_id == -1: raise Exception("Texture cannot be bound if it is not loaded into GPU...")
-        glBindTexture(GL_TEXTURE_2D, 0)
-        glDisable(GL_TEXTURE_2D)
+        gl_state.bind_texture(0, restore=True)
+        gl_state.disable(GL_TEXTURE_2D, restore=True)
+
+    # Sends vertex_data and indices to the GPU and stores the buffer ids into vbo and ibo. Throws if vbo is not -1.
+    def send_geometry(self):
+        if self.vbo != -1: raise Exception("Geometry is already in GPU.")
+        self.vbo, self.ibo = glGenBuffers(2)
+        glBindBuffer(GL_ARRAY_BUFFER, self.vbo)
+        glBufferData(GL_ARRAY_BUFFER, self.vertex_data.nbytes, self.vertex_data, GL_STATIC_DRAW)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self.ibo)
+        glBufferData(GL_ELEMENT_ARRAY_BUFFER, self.indices.nbytes, self.indices, GL_STATIC_DRAW)
+        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, 0)
+
+    def clear_geometry(self):
+        if self.vbo == -1: raise Exception("Geometry is not loaded into GPU.")
+        glDeleteBuffers(2, [self.vbo, self.ibo])
+        self.vbo = -1
+        self.ibo = -1
+
+    # Simplified copy of the model to draw from far away. Vertices in the same cell_size grid cell, and with nearby
+    # texture coordinates so textures do not stretch across seams, are merged into one and the triangles that
+    # collapse are dropped. The copy shares the texture and material and its geometry is not in the GPU yet
+    def decimate(self, cell_size):
+        uvs, positions = self.vertex_data[:, 0:2], self.vertex_data[:, 5:8]
+        keys = np.concatenate([np.floor(positions / cell_size), np.floor(uvs / 0.25)], 1).astype(np.int64)
+        _, first, cluster = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+        corners = first[cluster.reshape(-1)][self.indices].reshape(-1, 3)
+        corners = corners[(corners[:, 0] != corners[:, 1]) & (corners[:, 1] != corners[:, 2]) & (corners[:, 2] != corners[:, 0])]
+        used, indices = np.unique(corners, return_inverse=True)
+        return replace(self, vertex_data=np.ascontiguousarray(self.vertex_data[used]), indices=indices.reshape(-1).astype(self.indices.dtype), vbo=-1, ibo=-1)
+
+    # Draws every triangle of the model with the current texture and material
+    def draw_geometry(self):
+        if self.vbo == -1: raise Exception("Geometry is not loaded into GPU.")
+        glPushClientAttrib(GL_CLIENT_VERTEX_ARRAY_BIT)
+        glBindBuffer(GL_ARRAY_BUFFER, self.vbo)
+        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self.ibo)
+        glInterleavedArrays(GL_T2F_N3F_V3F, 0, None)
+        glDrawElements(GL_TRIANGLES, len(self.indices), GL_UNSIGNED_SHORT if self.indices.dtype == np.uint16 else GL_UNSIGNED_INT, None)
+        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, 0)
+        glPopClientAttrib()
+
+    instanced_program = None # LitProgram of draw_geometry_instanced, shared by every model
+    instance_vbo = None # Per-instance data of the current draw_geometry_instanced call, shared by every model
+    instanced_vertex_shader = """
+    #version 120
+    attribute mat4 instance_transform;
+    attribute vec3 instance_tint;
+    {lighting}
+    void main() {
+        vec4 eye = gl_ModelViewMatrix * (instance_transform * gl_Vertex);
+        gl_Position = gl_ProjectionMatrix * eye;
+        gl_FrontColor = fixed_function_lighting(eye.xyz, normalize(gl_NormalMatrix * mat3(instance_transform) * gl_Normal), vec4(instance_tint, 1.0));
+        gl_TexCoord[0] = gl_MultiTexCoord0;
+    }
+    """
+    instanced_fragment_shader = """
+    #version 120
+    uniform sampler2D model_texture;
+    uniform bool textured;
+    {lighting}
+    void main() {
+        vec4 color = lighting(gl_Color);
+        gl_FragColor = textured ? texture2D(model_texture, gl_TexCoord[0].st) * color : color;
+    }
+    """
+
+    # Draws the model once for each of the (n, 4, 4) transforms, column-major like glGetFloatv returns them, with the
+    # current texture and material. tints are the (n, 3) colors of the instances, which are otherwise drawn with the
+    # current color. Transforms may only scale uniformly. Uses one instanced draw when the GL version supports it
+    def draw_geometry_instanced(self, transforms, tints=None):
+        if self.vbo == -1: raise Exception("Geometry is not loaded into GPU.")
+        if not instancing_supported():
+            glPushAttrib(GL_CURRENT_BIT)
+            for i, transform in enumerate(transforms):
+                glPushMatrix()
+                glMultMatrixf(transform)
+                if tints is not None:
+                    glColor3f(*tints[i])
+                self.draw_geometry()
+                glPopMatrix()
+            glPopAttrib()
+            return
+        if len(transforms) == 0:
+            return
+        if Model.instanced_program is None:
+            Model.instanced_program = LitProgram(Model.instanced_vertex_shader, Model.instanced_fragment_shader)
+            Model.instance_vbo = glGenBuffers(1)
+        instances = np.empty((len(transforms), 19), np.float32)
+        instances[:, :16] = np.reshape(transforms, (-1, 16))
+        if tints is not None:
+            instances[:, 16:] = tints
+        glBindBuffer(GL_ARRAY_BUFFER, Model.instance_vbo)
+        glBufferData(GL_ARRAY_BUFFER, instances.nbytes, instances, GL_STREAM_DRAW)
+        program = Model.instanced_program.use()
+        glUniform1i(glGetUniformLocation(program, "textured"), int(glIsEnabled(GL_TEXTURE_2D)))
+        transform = glGetAttribLocation(program, "instance_transform")
+        tint = glGetAttribLocation(program, "instance_tint")
+        glPushClientAttrib(GL_CLIENT_VERTEX_ARRAY_BIT)
+        columns = [(transform + i, 4, i * 16) for i in range(4)] # A mat4 attribute takes one location per column
+        for location, size, offset in columns + ([(tint, 3, 64)] if tints is not None else []):
+            glEnableVertexAttribArray(location)
+            glVertexAttribDivisor(location, 1)
+            glVertexAttribPointer(location, size, GL_FLOAT, GL_FALSE, 76, ctypes.c_void_p(offset))
+        if tints is None:
+            glVertexAttrib3fv(tint, glGetFloatv(GL_CURRENT_COLOR)[:3])
+        glBindBuffer(GL_ARRAY_BUFFER, self.vbo)
+        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self.ibo)
+        glInterleavedArrays(GL_T2F_N3F_V3F, 0, None)
+        glDrawElementsInstanced(GL_TRIANGLES, len(self.indices), GL_UNSIGNED_SHORT if self.indices.dtype == np.uint16 else GL_UNSIGNED_INT, None, len(transforms))
+        for location in [transform + i for i in range(4)] + [tint]:
+            glVertexAttribDivisor(location, 0)
+            glDisableVertexAttribArray(location)
+        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, 0)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+        glPopClientAttrib()
+        glUseProgram(0)
 
 
     @staticmethod
     def load(obj_file, texture_file = None):
-        vertices = []
-        normals = []
-        uvs = []
-        faces = []
+        geometry = Model.load_cache(obj_file)
+        if geometry is None:
+            geometry = Model.parse_obj(obj_file)
+            Model.save_cache(obj_file, *geometry)
+        texture = None
+        if texture_file is not None:
+            texture = decode_texture(texture_file)
+        vertex_data, indices = Model.index_geometry(*geometry[:5])
+        return Model(*geometry[:6], texture, -1, vertex_data, indices, -1, -1)
+
+    # Parses an obj file and the mtl file it references.
+    # Returns (vertices, normals, uvs, faces, face_sizes, material, mtl_file), mtl_file is None if there is no mtllib line
+    @staticmethod
+    def parse_obj(obj_file):
         material = Model.default_material
-        with open(obj_file, 'r') as mtl:
-            for line in mtl:
-                line = line.strip()
-                if len(line) == 0:
-                    continue
-                if line.startswith("#"):
-                    continue
-                if line.startswith("o"): # Expects only one object
-                    continue
-                if line.startswith("s"): # Smooth shading
-                    continue
-                if line.startswith("usemtl"): # Expects only one material
+        mtl_file = None
+        with open(obj_file, 'r') as obj:
+            text = obj.read()
+
+        # Every element type is gathered from the whole file with one regex scan and converted by numpy in one call.
+        for line in Model._unknown_line.findall(text):
+            print("Cannot parse line of obj file: " + line.strip())
+        for mtl_name in Model._element("mtllib").findall(text):
+            mtl_file = '/'.join(obj_file.split('/')[:-1]) + "/" + mtl_name.strip() # Probably a terrible solution
+            material = Material.load(mtl_file)
+
+        vertices = Model._parse_elements(obj_file, "v", text, 3)
+        normals = Model._parse_elements(obj_file, "vn", text, 3)
+        uvs = Model._parse_elements(obj_file, "vt", text, 2)
+
+        # Each face is terminated with a 0/0/0 corner. OBJ indices start at 1 so the terminators mark where faces end.
+        # The corners are split on the slashes, so every corner has to be v/vt/vn for the indices to line up
+        face_lines = Model._element("f").findall(text)
+        face_text = " ".join(face_lines)
+        if len(Model._face_corner.findall(face_text)) != len(face_text.split()):
+            line = next(line for line in face_lines if len(Model._face_corner.findall(line)) != len(line.split()))
+            raise ValueError(f"{obj_file}: face 'f {line.strip()}' has corners that are not v/vt/vn, which is the only format supported")
+        corners = np.array((" 0/0/0 ".join(face_lines) + " 0/0/0").replace('/', ' ').split(), dtype=np.int32).reshape(-1, 3)
+        terminators = np.flatnonzero(corners[:, 0] == 0)
+        face_sizes = np.diff(terminators, prepend=-1).astype(np.int32) - 1
+        faces = corners[corners[:, 0] != 0] - 1 # - 1 because indices start at 1 not 0
+        return vertices, normals, uvs, faces, face_sizes, material, mtl_file
+
+    # Fan triangulates every face. Returns the corners of all triangles back to back, (n * 3, 3) int32
+    @staticmethod
+    def triangulate(faces, face_sizes):
+        triangle_counts = np.maximum(face_sizes - 2, 0)
+        first_corners = np.repeat(np.cumsum(face_sizes) - face_sizes, triangle_counts)
+        # Index of every triangle within its own face
+        fan_index = np.arange(triangle_counts.sum()) - np.repeat(np.cumsum(triangle_counts) - triangle_counts, triangle_counts)
+        triangles = np.stack([first_corners, first_corners + fan_index + 1, first_corners + fan_index + 2], axis=1)
+        return faces[triangles.reshape(-1)]
+
+    # Triangulates the faces and merges corners that share the same (vertex, uv, normal) triplet into one vertex.
+    # Returns (vertex_data, indices) as stored on a Model. Vertices are ordered by first use to keep the indices local.
+    @staticmethod
+    def index_geometry(vertices, normals, uvs, faces, face_sizes):
+        corners = Model.triangulate(faces, face_sizes)
+        unique_corners, first_use, corner_vertex = np.unique(corners, axis=0, return_index=True, return_inverse=True)
+        order = np.argsort(first_use)
+        vertex_index = np.empty_like(order)
+        vertex_index[order] = np.arange(len(order))
+        unique_corners = unique_corners[order]
+
+        vertex_data = np.zeros((len(unique_corners), 8), dtype=np.float32)
+        if len(uvs) > 0:
+            vertex_data[:, 0:2] = uvs[unique_corners[:, 1]]
+        vertex_data[:, 2:5] = normals[unique_corners[:, 2]]
+        vertex_data[:, 5:8] = vertices[unique_corners[:, 0]]
+        indices = vertex_index[corner_vertex.reshape(-1)].astype(np.uint16 if len(vertex_data) <= 65536 else np.uint32)
+        return vertex_data, indices
+
+    cache_version = 1 # Bump whenever the layout of the cache files or the parsed arrays changes
+
+    # The compiled cache of obj_file is stored next to it as <obj_file>.npz
+    @staticmethod
+    def cache_file(obj_file):
+        return obj_file + ".npz"
+
+    # Identifies the current contents of the given files by modification time and size
+    @staticmethod
+    def _source_stamp(files):
+        stats = [os.stat(file) for file in files]
+        return np.array([[stat.st_mtime_ns, stat.st_size] for stat in stats], dtype=np.int64)
+
+    # Writes the parsed geometry and material of obj_file to its cache file. Failing to write the cache is not fatal.
+    @staticmethod
+    def save_cache(obj_file, vertices, normals, uvs, faces, face_sizes, material, mtl_file):
+        sources = [obj_file] if mtl_file is None else [obj_file, mtl_file]
+        arrays = dict(version=Model.cache_version, sources=np.array(sources), stamp=Model._source_stamp(sources),
+                      vertices=vertices, normals=normals, uvs=uvs, faces=faces, face_sizes=face_sizes)
+        if mtl_file is not None:
+            for field in fields(Material):
+                arrays["material_" + field.name] = getattr(material, field.name)
+        temp_file = Model.cache_file(obj_file) + ".tmp.npz"
+        try:
+            np.savez(temp_file, **arrays) # Uncompressed so loading is a plain read
+            os.replace(temp_file, Model.cache_file(obj_file))
+        except OSError as error:
+            print("Cannot write model cache for " + obj_file + ": " + str(error))
+
+    # Loads the geometry and material of obj_file from its cache file.
+    # Returns the same tuple as parse_obj, or None if there is no cache, it is corrupt, or the obj or mtl file changed since it was written.
+    @staticmethod
+    def load_cache(obj_file):
+        try:
+            with np.load(Model.cache_file(obj_file)) as cache:
+                if cache["version"] != Model.cache_version or cache["sources"][0] != obj_file:
+                    return None
+                sources = list(cache["sources"])
+                if not np.array_equal(cache["stamp"], Model._source_stamp(sources)):
+                    return None
+                material = Model.default_material
+                mtl_file = None
+                if len(sources) > 1:
+                    mtl_file = str(sources[1])
+                    values = {field.name: cache["material_" + field.name] for field in fields(Material)}
+                    material = Material(**{name: value.item() if value.ndim == 0 else value.tolist() for name, value in values.items()})
+                return cache["vertices"], cache["normals"], cache["uvs"], cache["faces"], cache["face_sizes"], material, mtl_file
+        except (OSError, KeyError, ValueError, EOFError, zipfile.BadZipFile, zlib.error): # Also a truncated or corrupt cache file
+            return None
+
+    # The first columns numbers of every keyword line of text, (n, columns) float32. Extra numbers, like the optional w
+    # of v and vt, are ignored. Raises ValueError naming the first line that does not start with columns numbers.
+    @staticmethod
+    def _parse_elements(obj_file, keyword, text, columns):
+        lines = Model._element(keyword).findall(text)
+        try:
+            elements = np.array([line.split()[:columns] for line in lines], dtype=np.float32)
+            if elements.shape == (len(lines), columns) or not lines:
+                return elements.reshape(-1, columns)
+        except ValueError:
+            pass
+        for line in lines:
+            try:
+                if len(np.array(line.split()[:columns], dtype=np.float32)) == columns:
                     continue
+            except ValueError:
+                pass
+            raise ValueError(f"{obj_file}: cannot parse line of obj file: '{keyword} {line.strip()}'")
 
-                split = line.split(' ')
-
-                if line.startswith("mtllib"):
-                    material = Material.load('/'.join(obj_file.split('/')[:-1]) + "/" + ' '.join(split[1:])) # Probably a terrible solution
-                elif line.startswith("vn"):
-                    normals.append([float(split[1]), float(split[2]), float(split[3])])
-                elif line.startswith("vt"):
-                    uvs.append([float(split[1]), float(split[2])])
-                elif line.startswith("v"):
-                    vertices.append([float(split[1]), float(split[2]), float(split[3])])
-                elif line.startswith("f"):
-                    face = []
-                    for vert in line.split()[1:]:
-                        indices = vert.split('/')
-                        face.append([int(indices[0]) - 1, int(indices[1]) - 1, int(indices[2]) - 1]) # - 1 because indices start at 1 not 0
-                    faces.append(face)
-                else:
-                    print("Cannot parse line of obj file: " + line)
-        texture = None
-        if texture_file is not None:
-            texture = Image.open(texture_file).transpose(Image.Transpose.FLIP_TOP_BOTTOM).convert("RGB").tobytes()
-        return Model(vertices, normals, uvs, faces, material, texture, -1)
+    # Matches the arguments of every line starting with keyword
+    @staticmethod
+    def _element(keyword):
+        return re.compile(r'^[ \t]*' + keyword + r'[ \t]+(.*)$', re.M)
 
 def draw_model(model : Model):
+    if model_recorder is not None:
+        model_recorder.append((model, glGetFloatv(GL_MODELVIEW_MATRIX)))
+        return
     if model.texture is not None:
         model.bind_texture()
+    else:
+        gl_state.disable(GL_TEXTURE_2D)  # In a batch, the texture of the model drawn before may not be unbound yet
     model.material.bind()
-    length = -1  # -1 -> glBegin has not been called, 0 -> drawing polygons, 3 -> drawing triangles, 4 -> drawing quads
-    for face in model.faces:
-        if len(face) != length:
-            if length != -1:
-                glEnd()
-            length = len(face)
-            if length != 3 or length != 4:
-                length = 0
-            if length == 3:
-                glBegin(GL_TRIANGLES)
-            elif length == 4:
-                glBegin(GL_QUADS)
-            else:
-                glBegin(GL_POLYGON)
-        elif length == 0:
-            glEnd()
-            glBegin(GL_POLYGON)
-
-        for indices in face:  # Each 'indices' contains 3 vertex indices: 0 -> mesh vertex index, 1 -> texture vertex index, 2 -> normal vertex index
-            glNormal3fv(model.normals[indices[2]])
-            if model.texture is not None:
-                glTexCoord2fv(model.uvs[indices[1]])
-            glVertex3fv(model.vertices[indices[0]])
-    if length != -1:
-        glEnd()
+    model.draw_geometry()
+    if model.texture is not None:
+        model.unbind_texture()
+    model.material.unbind()
+
+def draw_model_instanced(model : Model, transforms, tints=None):
+    """Draws model at each of the transforms, with one draw call where instancing is supported. See Model.draw_geometry_instanced."""
+    if model_recorder is not None:
+        model_recorder.extend((model, matrix) for matrix in np.reshape(transforms, (-1, 4, 4)) @ glGetFloatv(GL_MODELVIEW_MATRIX))
+        return
+    if model.texture is not None:
+        model.bind_texture()
+    else:
+        gl_state.disable(GL_TEXTURE_2D)  # In a batch, the texture of the model drawn before may not be unbound yet
+    model.material.bind()
+    model.draw_geometry_instanced(transforms, tints)
     if model.texture is not None:
         model.unbind_texture()
     model.material.unbind()
 
+def transform_bounds(matrix, lower, upper):
+    """Box around the box from lower to upper once transformed by matrix, column-major like glGetFloatv returns it.
+    matrix may also be a stack of (n, 4, 4) matrices, giving (n, 3) corners."""
+    corners = np.stack(np.meshgrid(*zip(lower, upper), indexing='ij'), -1).reshape(-1, 3)
+    points = corners @ matrix[..., :3, :3] + matrix[..., 3:, :3]
+    return points.min(-2), points.max(-2)
+
+model_recorder = None # While record_models runs, draw_model and draw_model_instanced add (model, matrix) of each model to this list instead of drawing it
+
+def record_models(draw):
+    """(model, matrix) of every model draw draws with draw_model or draw_model_instanced, without drawing anything.
+    The matrices are column-major like glGetFloatv returns them, and place the models in world coordinates."""
+    global model_recorder
+    model_recorder = []
+    glPushMatrix()
+    glLoadIdentity()
+    try:
+        draw()
+    finally:
+        glPopMatrix()
+        records, model_recorder = model_recorder, None
+    return records
+
+def measure_models(draw):
+    """Bounds (lower, upper) of every model draw draws with draw_model or draw_model_instanced, without drawing anything."""
+    boxes = [transform_bounds(matrix, *model.bounds()) for model, matrix in record_models(draw)]
+    return np.min([lower for lower, _ in boxes], 0), np.max([upper for _, upper in boxes], 0)
+
+# Level of detail settings
+lod_scale = 1.0 # Multiplies the sizes on screen at which objects switch to simpler levels. 0 always draws the most detailed level
+lod_hysteresis = 0.2 # Objects only switch once they are this fraction past the size they switch at, so they do not flicker between levels
+
+def select_levels(levels, sizes, switch_sizes):
+    """New level of detail of objects at levels that are sizes pixels on screen. switch_sizes are the sizes below
+    which they switch to each simpler level, largest first. Level 0 is the most detailed."""
+    switch_sizes = np.asarray(switch_sizes, np.float64) * lod_scale
+    sizes = np.asarray(sizes, np.float64)[..., None]
+    coarsest = np.sum(sizes < switch_sizes * (1 - lod_hysteresis), -1)
+    finest = np.sum(sizes < switch_sizes * (1 + lod_hysteresis), -1)
+    return np.clip(levels, coarsest, finest)
+
+@dataclass
+class Drawable:
+    """Display list of a static part of the scene, with the box around it so it can be culled."""
+    name : str
+    display_list : int # None for recorded drawables
+    lower : np.ndarray # Corner of the box with the smallest x, y and z, in world coordinates
+    upper : np.ndarray
+    handle : int = None # Of its box in the SpatialGrid of the scene
+    lods : list = () # (size on screen in pixels below which it is drawn, display list) of the simpler levels of detail, largest first
+    level : int = 0 # Level of detail drawn last, 0 is display_list
+    records : list = None # Of drawables made only of models, the (model, matrix) of each model of each level of detail, drawn through a RenderQueue
+    textured : bool = None # Whether the display lists draw with a texture, for per pixel lighting. None keeps them on fixed function lighting
+
+    @staticmethod
+    def compile(name, draw, bounds=None, lods=(), textured=None):
+        """Compiles draw into a display list. bounds is (lower, upper). None measures the models draw draws with draw_model.
+        lods is (size on screen in pixels, draw) of simpler levels of detail, largest first. Per pixel lighting only
+        draws the display lists with its shaders when textured says whether they use a texture."""
+        if bounds is None:
+            bounds = measure_models(draw)
+        display_lists = []
+        for level_draw in [draw, *[level_draw for _, level_draw in lods]]:
+            display_lists.append(glGenLists(1))
+            with gl_state.compiling():
+                glNewList(display_lists[-1], GL_COMPILE)
+                level_draw()
+                glEndList()
+        return Drawable(name, display_lists[0], np.asarray(bounds[0], np.float64), np.asarray(bounds[1], np.float64),
+                        lods=[(size, display_list) for (size, _), display_list in zip(lods, display_lists[1:])], textured=textured)
+
+    @staticmethod
+    def record(name, draw, lods=()):
+        """Like compile, for draw functions that only draw models. Records the models of each level instead of compiling
+        them, so a RenderQueue can draw them sorted together with the models of other drawables."""
+        records = [record_models(level_draw) for level_draw in [draw, *[level_draw for _, level_draw in lods]]]
+        boxes = [transform_bounds(matrix, *model.bounds()) for model, matrix in records[0]]
+        return Drawable(name, None, np.min([lower for lower, _ in boxes], 0).astype(np.float64), np.max([upper for _, upper in boxes], 0).astype(np.float64),
+                        lods=[(size, None) for size, _ in lods], records=records)
+
+    def select_level(self, frustum):
+        """Display list of the level of detail for the size of the drawable on screen. Also sets level."""
+        if self.lods:
+            self.level = int(select_levels(self.level, frustum.screen_sizes(self.lower, self.upper)[0], [size for size, _ in self.lods]))
+        return self.display_list if self.level == 0 else self.lods[self.level - 1][1]
+
+class Frustum:
+    """The six planes of the view volume of the current projection and modelview matrices."""
+    def __init__(self):
+        modelview = glGetFloatv(GL_MODELVIEW_MATRIX)
+        projection = glGetFloatv(GL_PROJECTION_MATRIX)
+        clip = (modelview @ projection).T  # Projection times modelview, row-major
+        self.planes = np.array([clip[3] + clip[0], clip[3] - clip[0], clip[3] + clip[1], clip[3] - clip[1], clip[3] + clip[2], clip[3] - clip[2]], np.float64)
+        self.eye = np.linalg.inv(modelview.T.astype(np.float64))[:3, 3]
+        self.pixels_per_unit = projection[1, 1] * glGetIntegerv(GL_VIEWPORT)[3] / 2 # On screen, at a distance of 1 from the eye
+
+    def screen_sizes(self, lower, upper):
+        """Radius in pixels on screen of the spheres around the boxes with the given (n, 3) corners. Infinite for the
+        spheres the eye is in."""
+        lower = np.asarray(lower, np.float64).reshape(-1, 3)
+        upper = np.asarray(upper, np.float64).reshape(-1, 3)
+        radius = np.linalg.norm(upper - lower, axis=1) / 2
+        distance = np.linalg.norm((lower + upper) / 2 - self.eye, axis=1)
+        with np.errstate(divide='ignore'):
+            return np.where(distance > radius, radius * self.pixels_per_unit / distance, np.inf)
+
+    def visible(self, lower, upper):
+        """Which of the boxes with the given (n, 3) corners are at least partly inside. A box is only left out when it is
+        fully behind one of the planes, so some boxes near the corners of the frustum are kept although they are outside."""
+        lower = np.asarray(lower, np.float64).reshape(-1, 3)
+        upper = np.asarray(upper, np.float64).reshape(-1, 3)
+        center = (lower + upper) / 2
+        extent = (upper - lower) / 2
+        normals = self.planes[:, :3]
+        return np.all(center @ normals.T + extent @ np.abs(normals).T + self.planes[:, 3] >= 0, axis=1)
+
+scene_vertex_shader = """
+#version 120
+{lighting}
+void main() {
+    vec4 eye = gl_ModelViewMatrix * gl_Vertex;
+    gl_Position = gl_ProjectionMatrix * eye;
+    gl_FrontColor = fixed_function_lighting(eye.xyz, normalize(gl_NormalMatrix * gl_Normal), gl_Color);
+    gl_TexCoord[0] = gl_MultiTexCoord0;
+}
+"""
+scene_program = None # LitProgram draw_visible calls display lists with when per_pixel_lighting is on, made on first use
+
+def draw_visible(drawables, visible, frustum):
+    """Calls the display list of every drawable whose handle is set in the visible mask, at the level of detail for
+    its size on screen. Returns their part of the mask."""
+    global scene_program
+    shown = visible[[drawable.handle for drawable in drawables]]
+    for drawable in itertools.compress(drawables, shown):
+        if per_pixel_lighting and drawable.textured is not None:
+            if scene_program is None:
+                scene_program = LitProgram(scene_vertex_shader, Model.instanced_fragment_shader)
+            glUniform1i(glGetUniformLocation(scene_program.use(), "textured"), int(drawable.textured))
+            glCallList(drawable.select_level(frustum))
+            glUseProgram(0)
+        else:
+            glCallList(drawable.select_level(frustum))
+    gl_state.forget(("texture",), ("enable", GL_TEXTURE_2D))  # The ground and the water bind their textures directly
+    return shown
+
+class RenderQueue:
+    """Models submitted over a phase, drawn together sorted by texture and material, and front to back within each.
+    Consecutive draws of the same mesh with the same texture and material are merged into one instanced draw, and
+    the draws go through one gl_state batch so state is only set when it changes from one draw to the next."""
+    def __init__(self):
+        self.records = [] # (model, matrix) of each model to draw, matrix placing it in world coordinates
+
+    def submit(self, records):
+        self.records.extend(records)
+
+    def draw(self, eye):
+        """Draws and empties the queue. Returns (draw calls, times the texture or material changed between them)."""
+        materials = {} # Values of each material by its id, models of the same file share theirs
+        def state(model):
+            if id(model.material) not in materials:
+                material = model.material
+                materials[id(model.material)] = tuple(np.concatenate([np.ravel(value) for value in (material.specular_reflection, material.ambient_reflection,
+                                                      material.diffused_reflection, [material.specular_exponent], material.emissive_material)]).tolist())
+            return model.texture_id, materials[id(model.material)]
+        records = sorted(self.records, key=lambda record: (*state(record[0]), record[0].vbo, float(np.sum((record[1][3, :3] - eye) ** 2))))
+        self.records = []
+        calls = changes = 0
+        previous = None
+        with gl_state.batch():
+            for (texture_id, material, _), group in itertools.groupby(records, lambda record: (*state(record[0]), record[0].vbo)):
+                group = list(group)
+                model = group[0][0]
+                if len(group) == 1 and not per_pixel_lighting: # Only the instanced draw lights per pixel
+                    glPushMatrix()
+                    glMultMatrixf(group[0][1])
+                    draw_model(model)
+                    glPopMatrix()
+                else:
+                    draw_model_instanced(model, np.array([matrix for _, matrix in group]))
+                calls += 1
+                changes += previous is not None and previous != (texture_id, material)
+                previous = (texture_id, material)
+        return calls, changes
+
+def queue_visible(drawables, visible, frustum, queue):
+    """Like draw_visible, for recorded drawables: submits their models to queue instead of drawing them."""
+    shown = visible[[drawable.handle for drawable in drawables]]
+    for drawable in itertools.compress(drawables, shown):
+        drawable.select_level(frustum)
+        queue.submit(drawable.records[drawable.level])
+    return shown
+
+def ray_boxes(origin, direction, lower, upper):
+    """Distances along the ray at which it enters and leaves each of the boxes. It misses the boxes it would leave
+    before entering."""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t_lower = (lower - origin) / direction
+        t_upper = (upper - origin) / direction
+    parallel = direction == 0
+    inside = (lower <= origin) & (origin <= upper)
+    enter = np.where(parallel, np.where(inside, -np.inf, np.inf), np.minimum(t_lower, t_upper))
+    leave = np.where(parallel, np.where(inside, np.inf, -np.inf), np.maximum(t_lower, t_upper))
+    return enter.max(-1), leave.min(-1)
+
+class SpatialGrid:
+    """Uniform grid over the ground that buckets the boxes of the objects in the scene by the cells their x and z
+    span, so queries only look at the objects in the cells they reach. insert returns a handle to each box, which
+    the queries return. Boxes that stick out of the grid are kept apart and looked at by every query."""
+    def __init__(self, extent=150, cell_size=10):
+        self.extent = extent # The grid covers -extent..extent on x and z, like the ground
+        self.cell_size = cell_size
+        self.side = int(math.ceil(2 * extent / cell_size)) # Cells along x and along z
+        self.cells = [set() for _ in range(self.side * self.side)] # Handles in each cell, the cell at x index i and z index k is i * side + k
+        self.outside = set()
+        self.lower = np.zeros((0, 3))
+        self.upper = np.zeros((0, 3))
+        self.ranges = np.zeros((0, 4), int) # First and last cell on x and on z of each box, -1 when outside
+        self.items = [] # What was inserted with each handle, None once removed
+        self.free = [] # Handles of removed boxes, reused first
+        self.height = [np.inf, -np.inf] # Lowest and highest y of any box, for the boxes of the cells
+        corners = -extent + cell_size * np.stack(np.meshgrid(np.arange(self.side), np.arange(self.side), indexing='ij'), -1).reshape(-1, 2)
+        self.cell_lower = np.insert(corners, 1, 0, axis=1).astype(np.float64)
+        self.cell_upper = self.cell_lower + (cell_size, 0, cell_size)
+
+    def _cell(self, x, z):
+        """Indices on x and z of the cell under x, z, or of the nearest cell when it is not over the grid."""
+        return np.clip(np.floor((np.array([x, z]) + self.extent) / self.cell_size).astype(int), 0, self.side - 1)
+
+    def _cell_ranges(self, lower, upper):
+        """(first x, last x, first z, last z) cells of each of the (n, 3) boxes, or -1 for the boxes not inside the grid."""
+        first = np.floor((lower[:, [0, 2]] + self.extent) / self.cell_size).astype(int)
+        last = np.minimum(np.floor((upper[:, [0, 2]] + self.extent) / self.cell_size).astype(int), self.side - 1)
+        ranges = np.stack([first[:, 0], last[:, 0], first[:, 1], last[:, 1]], 1)
+        outside = np.any(lower[:, [0, 2]] < -self.extent, 1) | np.any(upper[:, [0, 2]] > self.extent, 1)
+        ranges[outside] = -1
+        return ranges
+
+    def _link(self, handle, cell_range):
+        if cell_range[0] < 0:
+            self.outside.add(handle)
+            return
+        for i in range(cell_range[0], cell_range[1] + 1):
+            for k in range(cell_range[2], cell_range[3] + 1):
+                self.cells[i * self.side + k].add(handle)
+
+    def _unlink(self, handle, cell_range):
+        if cell_range[0] < 0:
+            self.outside.discard(handle)
+            return
+        for i in range(cell_range[0], cell_range[1] + 1):
+            for k in range(cell_range[2], cell_range[3] + 1):
+                self.cells[i * self.side + k].discard(handle)
+
+    def insert_many(self, lower, upper, items):
+        """Adds the (n, 3) boxes and returns their handles."""
+        lower = np.asarray(lower, np.float64).reshape(-1, 3)
+        upper = np.asarray(upper, np.float64).reshape(-1, 3)
+        handles = []
+        for _ in range(len(lower)):
+            if self.free:
+                handles.append(self.free.pop())
+            else:
+                handles.append(len(self.items))
+                self.items.append(None)
+        handles = np.array(handles, int)
+        if len(self.items) > len(self.lower):
+            capacity = max(len(self.items), 2 * len(self.lower))
+            self.lower = np.resize(self.lower, (capacity, 3))
+            self.upper = np.resize(self.upper, (capacity, 3))
+            self.ranges = np.resize(self.ranges, (capacity, 4))
+        for handle, item in zip(handles, items):
+            self.items[handle] = item
+        self.lower[handles] = lower
+        self.upper[handles] = upper
+        self.ranges[handles] = self._cell_ranges(lower, upper)
+        for handle in handles:
+            self._link(handle, self.ranges[handle])
+        if len(lower):
+            self.height = [min(self.height[0], lower[:, 1].min()), max(self.height[1], upper[:, 1].max())]
+        return handles
+
+    def insert(self, lower, upper, item):
+        return int(self.insert_many(lower, upper, [item])[0])
+
+    def remove(self, handle):
+        self._unlink(handle, self.ranges[handle])
+        self.items[handle] = None
+        self.free.append(handle)
+
+    def move_many(self, handles, lower, upper):
+        """Replaces the boxes of the handles. Only the boxes that now span other cells are moved between cells."""
+        lower = np.asarray(lower, np.float64).reshape(-1, 3)
+        upper = np.asarray(upper, np.float64).reshape(-1, 3)
+        ranges = self._cell_ranges(lower, upper)
+        for index in np.flatnonzero(np.any(ranges != self.ranges[handles], 1)):
+            self._unlink(handles[index], self.ranges[handles[index]])
+            self._link(handles[index], ranges[index])
+        self.lower[handles] = lower
+        self.upper[handles] = upper
+        self.ranges[handles] = ranges
+        if len(lower):
+            self.height = [min(self.height[0], lower[:, 1].min()), max(self.height[1], upper[:, 1].max())]
+
+    def move(self, handle, lower, upper):
+        self.move_many(np.array([handle]), lower, upper)
+
+    def _candidates(self, cells):
+        """Handles in the given cells and outside of the grid, without repeats."""
+        return np.unique(np.fromiter(itertools.chain(self.outside, *(self.cells[cell] for cell in cells)), int))
+
+    def query_frustum(self, frustum):
+        """Mask over the handles of the boxes that are at least partly inside the frustum. The frustum is only
+        checked against the boxes in the cells it reaches."""
+        self.cell_lower[:, 1], self.cell_upper[:, 1] = self.height
+        cells = np.flatnonzero(frustum.visible(self.cell_lower, self.cell_upper))
+        candidates = self._candidates(cell for cell in cells if self.cells[cell])
+        visible = np.zeros(len(self.lower), bool)
+        visible[candidates[frustum.visible(self.lower[candidates], self.upper[candidates])]] = True
+        return visible
+
+    def query_radius(self, center, radius):
+        """Handles of the boxes that come within radius of center."""
+        center = np.asarray(center, np.float64)
+        first = self._cell(center[0] - radius, center[2] - radius)
+        last = self._cell(center[0] + radius, center[2] + radius)
+        candidates = self._candidates(i * self.side + k for i in range(first[0], last[0] + 1) for k in range(first[1], last[1] + 1))
+        nearest = np.clip(center, self.lower[candidates], self.upper[candidates])
+        return candidates[np.sum((nearest - center) ** 2, 1) <= radius * radius]
+
+    def raycast(self, origin, direction):
+        """Nearest box the ray hits, as (handle, distance along direction), or None. Walks the cells under the ray
+        in order and stops once the nearest hit so far is before the end of the cell it is in."""
+        origin = np.asarray(origin, np.float64)
+        direction = np.asarray(direction, np.float64)
+        best = (None, np.inf)
+        def hit(handles):
+            nonlocal best
+            handles = np.fromiter(handles, int)
+            enter, leave = ray_boxes(origin, direction, self.lower[handles], self.upper[handles])
+            distance = np.where((enter <= leave) & (leave >= 0), np.maximum(enter, 0), np.inf)
+            if len(handles) and distance.min() < best[1]:
+                best = (int(handles[distance.argmin()]), float(distance.min()))
+        hit(self.outside)
+
+        # Where the ray is over the grid
+        enter, leave = ray_boxes(origin, direction, np.array([-self.extent, -np.inf, -self.extent]), np.array([self.extent, np.inf, self.extent]))
+        if enter > leave or leave < 0:
+            return best if best[0] is not None else None
+        t = max(enter, 0)
+        start = origin + t * direction
+        cell = self._cell(start[0], start[2])
+        step = np.sign(direction[[0, 2]]).astype(int)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # Distance along the ray to the next cell boundary on x and z, and between boundaries
+            boundary = -self.extent + (cell + (step > 0)) * self.cell_size
+            next_boundary = np.where(step != 0, (boundary - origin[[0, 2]]) / direction[[0, 2]], np.inf)
+            between = np.where(step != 0, self.cell_size / np.abs(direction[[0, 2]]), np.inf)
+        while t <= leave and np.all((0 <= cell) & (cell < self.side)):
+            hit(self.cells[cell[0] * self.side + cell[1]])
+            axis = int(np.argmin(next_boundary))
+            t = next_boundary[axis]
+            if best[1] <= t:
+                break
+            cell[axis] += step[axis]
+            next_boundary[axis] += between[axis]
+        return best if best[0] is not None else None
+
+@dataclass
+class SharedAsset:
+    asset : object # The shared Model (geometry only) once loaded, or the texture id
+    references : int # How many acquired models and textures still use the asset
+    ready : Future # Resolved on the GL thread once the asset is in GPU
+    data : TextureImage or None = None # Decoded pixels of a shared texture
+
+class AssetRegistry:
+    """Loads every obj and texture file once and shares the result between all models that use the same path.
+
+    Parsing and decoding run on a pool of worker threads. The results wait in a queue until upload_ready is called on
+    the thread that owns the GL context, so the caller can keep rendering while assets stream in.
+
+    Geometry and textures are reference counted separately, so the three houses share one furniture VBO while still
+    getting their own wall textures. Release every acquired model and texture once it is no longer drawn."""
+    def __init__(self, workers = 4):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.uploads = queue.Queue() # (upload function, finished worker task) pairs waiting for the GL thread
+        self.geometry = {} # obj file -> SharedAsset holding a Model with geometry in GPU and no texture
+        self.textures = {} # texture file -> SharedAsset holding the texture id
+
+    # Runs work on a worker thread and queues upload to be called with its result on the GL thread
+    def _load(self, work, upload):
+        task = self.executor.submit(work)
+        task.add_done_callback(lambda task: self.uploads.put((upload, task)))
+
+    def _acquire_geometry(self, obj_file):
+        if obj_file not in self.geometry:
+            shared_geometry = SharedAsset(None, 0, Future())
+            def upload(geometry):
+                geometry.send_geometry()
+                shared_geometry.asset = geometry
+                shared_geometry.ready.set_result(geometry)
+            self._load(lambda: Model.load(obj_file), upload)
+            self.geometry[obj_file] = shared_geometry
+        self.geometry[obj_file].references += 1
+        return self.geometry[obj_file]
+
+    # Returns the id the texture of texture_file will have. The id can be bound right away, the pixels arrive once
+    # the image is decoded and upload_ready is called.
+    def acquire_texture(self, texture_file):
+        if texture_file not in self.textures:
+            shared_texture = SharedAsset(glGenTextures(1), 0, Future())
+            def upload(image):
+                upload_texture(image, shared_texture.asset)
+                glBindTexture(GL_TEXTURE_2D, 0)
+                shared_texture.data = image
+                shared_texture.ready.set_result(shared_texture.asset)
+            self._load(lambda: decode_texture(texture_file), upload)
+            self.textures[texture_file] = shared_texture
+        self.textures[texture_file].references += 1
+        return self.textures[texture_file].asset
+
+    # Returns a Future of a ready to draw Model of obj_file textured with texture_file. The Future is resolved by
+    # upload_ready. Nothing is parsed, decoded or sent to the GPU if the files were already acquired.
+    def acquire_model(self, obj_file, texture_file = None):
+        shared_geometry = self._acquire_geometry(obj_file)
+        shared_texture = None
+        if texture_file is not None:
+            self.acquire_texture(texture_file)
+            shared_texture = self.textures[texture_file]
+
+        model = Future()
+        def combine(_):
+            if model.done() or not shared_geometry.ready.done():
+                return
+            if shared_texture is None:
+                model.set_result(replace(shared_geometry.asset))
+            elif shared_texture.ready.done():
+                model.set_result(replace(shared_geometry.asset, texture=shared_texture.data, texture_id=shared_texture.asset))
+        shared_geometry.ready.add_done_callback(combine)
+        if shared_texture is not None:
+            shared_texture.ready.add_done_callback(combine)
+        return model
+
+    # Sends finished assets to the GPU until the queue is empty or time_budget seconds have passed. Must be called on the
+    # thread that owns the GL context. At least one asset is sent per call so loading always makes progress.
+    def upload_ready(self, time_budget = None):
+        start = time.perf_counter()
+        while True:
+            try:
+                upload, task = self.uploads.get_nowait()
+            except queue.Empty:
+                return
+            upload(task.result()) # Re-raises anything that went wrong on the worker thread
+            if time_budget is not None and time.perf_counter() - start > time_budget:
+                return
+
+    # Blocks until every acquired asset is in GPU. Must be called on the thread that owns the GL context.
+    def finish(self):
+        while any(not shared.ready.done() for shared in [*self.geometry.values(), *self.textures.values()]):
+            upload, task = self.uploads.get()
+            upload(task.result())
+
+    # Gives back a texture returned by acquire_texture. The texture is removed from the GPU once nothing uses it.
+    def release_texture(self, texture_file):
+        shared_texture = self.textures[texture_file]
+        shared_texture.references -= 1
+        if shared_texture.references == 0:
+            shared_texture.ready.add_done_callback(lambda _: glDeleteTextures(shared_texture.asset))
+            del self.textures[texture_file]
+
+    # Gives back a model returned by acquire_model. Geometry and textures no model uses anymore are removed from the GPU.
+    def release_model(self, obj_file, texture_file = None):
+        shared_geometry = self.geometry[obj_file]
+        shared_geometry.references -= 1
+        if shared_geometry.references == 0:
+            shared_geometry.ready.add_done_callback(lambda ready: ready.result().clear_geometry())
+            del self.geometry[obj_file]
+        if texture_file is not None:
+            self.release_texture(texture_file)
+
+@dataclass
+class Mesh:
+    """Untextured triangles, sent to the GPU the first time they are drawn."""
+    vertex_data : np.ndarray # (n, 6) float32 in GL_N3F_V3F layout
+    indices : np.ndarray # uint16
+    vbo : int = -1
+    ibo : int = -1
+
+    def draw(self):
+        if self.vbo == -1:
+            self.vbo, self.ibo = glGenBuffers(2)
+            glBindBuffer(GL_ARRAY_BUFFER, self.vbo)
+            glBufferData(GL_ARRAY_BUFFER, self.vertex_data.nbytes, self.vertex_data, GL_STATIC_DRAW)
+            glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self.ibo)
+            glBufferData(GL_ELEMENT_ARRAY_BUFFER, self.indices.nbytes, self.indices, GL_STATIC_DRAW)
+        glPushClientAttrib(GL_CLIENT_VERTEX_ARRAY_BIT)
+        glBindBuffer(GL_ARRAY_BUFFER, self.vbo)
+        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self.ibo)
+        glInterleavedArrays(GL_N3F_V3F, 0, None)
+        glDrawElements(GL_TRIANGLES, len(self.indices), GL_UNSIGNED_SHORT, None)
+        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, 0)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+        glPopClientAttrib()
+
+# Unit cylinders and disks by shape. Each is built the first time it is drawn and reused after that
+quadric_meshes = {}
+cylinder_tapers = 32 # Top to base radius ratios of the cached cylinders are rounded to this many steps per unit, so cones of many shapes share a few meshes
+
+def grid_indices(rings, columns):
+    """Two triangles for every quad of a grid of rings x columns vertices, facing the side rings grow away from."""
+    ring, column = np.meshgrid(np.arange(rings - 1), np.arange(columns - 1), indexing='ij')
+    a = (ring * columns + column).ravel()
+    return np.stack([a, a + columns, a + 1, a + 1, a + columns, a + columns + 1], 1).ravel().astype(np.uint16)
+
+def cylinder_mesh(slices, stacks, top):
+    """Same triangles as gluCylinder with a base radius of 1, the given top radius and a height of 1."""
+    angle = np.linspace(0, 2 * math.pi, slices + 1)
+    z = np.linspace(0, 1, stacks + 1)[:, None]
+    radius = 1 + (top - 1) * z
+    vertex_data = np.empty((stacks + 1, slices + 1, 6), np.float32)
+    length = math.sqrt(1 + (1 - top) ** 2)
+    vertex_data[..., 0] = np.sin(angle) / length
+    vertex_data[..., 1] = np.cos(angle) / length
+    vertex_data[..., 2] = (1 - top) / length
+    vertex_data[..., 3] = np.sin(angle) * radius
+    vertex_data[..., 4] = np.cos(angle) * radius
+    vertex_data[..., 5] = z
+    return Mesh(vertex_data.reshape(-1, 6), grid_indices(stacks + 1, slices + 1))
+
+def disk_mesh(slices, loops, inner):
+    """Same triangles as gluDisk with the given inner radius and an outer radius of 1."""
+    angle = np.linspace(0, 2 * math.pi, slices + 1)
+    radius = np.linspace(inner, 1, loops + 1)[:, None]
+    vertex_data = np.zeros((loops + 1, slices + 1, 6), np.float32)
+    vertex_data[..., 2] = 1
+    vertex_data[..., 3] = np.sin(angle) * radius
+    vertex_data[..., 4] = np.cos(angle) * radius
+    indices = grid_indices(loops + 1, slices + 1).reshape(-1, 3)[:, ::-1]  # Faces +z
+    return Mesh(vertex_data.reshape(-1, 6), np.ascontiguousarray(indices).ravel())
+
+def cached_cylinder(base, top, height, slices, stacks):
+    """Draws what gluCylinder draws, by scaling a cached unit mesh. The taper is not a transformation, so there is a
+    mesh for every ratio of top to base radius, rounded to 1 / cylinder_tapers."""
+    key = ("cylinder", slices, stacks, round(top / base * cylinder_tapers))
+    if key not in quadric_meshes:
+        quadric_meshes[key] = cylinder_mesh(slices, stacks, key[3] / cylinder_tapers)
+    glPushMatrix()
+    glScalef(base, base, height)
+    quadric_meshes[key].draw()
+    glPopMatrix()
+
+def cached_disk(inner, outer, slices, loops):
+    """Draws what gluDisk draws, by scaling a cached unit mesh."""
+    key = ("disk", slices, loops, round(inner / outer, 4))
+    if key not in quadric_meshes:
+        quadric_meshes[key] = disk_mesh(slices, loops, key[3])
+    glPushMatrix()
+    glScalef(outer, outer, 1)
+    quadric_meshes[key].draw()
+    glPopMatrix()
+
 def cube(xSize, ySize, zSize):
     glBegin(GL_POLYGON)
     glNormal3f(0, -1, 0)
@@ -529,20 +1549,16 @@ def prtCar():
 
     glRotatef(90, 1, 0, 0)
     glTranslatef(0.25, 0.75, -1.4)
-    quadric = gluNewQuadric()
-    gluCylinder(quadric, 0.05, 0.05, 1.2, 20, 1)
+    cached_cylinder(0.05, 0.05, 1.2, 20, 1)
 
     glTranslatef(0, -0.5, 0)
-    quadric = gluNewQuadric()
-    gluCylinder(quadric, 0.05, 0.05, 1.2, 20, 1)
+    cached_cylinder(0.05, 0.05, 1.2, 20, 1)
 
     glTranslatef(-0.5, 0, 0)
-    quadric = gluNewQuadric()
-    gluCylinder(quadric, 0.05, 0.05, 1.2, 20, 1)
+    cached_cylinder(0.05, 0.05, 1.2, 20, 1)
 
     glTranslatef(0, 0.5, 0)
-    quadric = gluNewQuadric()
-    gluCylinder(quadric, 0.05, 0.05, 1.2, 20, 1)
+    cached_cylinder(0.05, 0.05, 1.2, 20, 1)
 
     glPopMatrix()
 
@@ -551,36 +1567,24 @@ def prtCar():
     glColor3f(0.1, 0.1, 0.1)
 
     glTranslatef(0.8, -0.02, 0)
-    quadric = gluNewQuadric()
-    gluCylinder(quadric, 0.2, 0.2, 0.2, 20, 1)
-    quadric = gluNewQuadric()
-    gluCylinder(quadric, 0.075, 0.075, 0.2, 20, 1)
-    quadric = gluNewQuadric()
-    gluDisk(quadric, 0.075, 0.2, 20, 1)
+    cached_cylinder(0.2, 0.2, 0.2, 20, 1)
+    cached_cylinder(0.075, 0.075, 0.2, 20, 1)
+    cached_disk(0.075, 0.2, 20, 1)
 
     glTranslatef(-1.6, 0, 0)
-    quadric = gluNewQuadric()
-    gluCylinder(quadric, 0.2, 0.2, 0.2, 20, 1)
-    quadric = gluNewQuadric()
-    gluCylinder(quadric, 0.075, 0.075, 0.2, 20, 1)
-    quadric = gluNewQuadric()
-    gluDisk(quadric, 0.075, 0.2, 20, 1)
+    cached_cylinder(0.2, 0.2, 0.2, 20, 1)
+    cached_cylinder(0.075, 0.075, 0.2, 20, 1)
+    cached_disk(0.075, 0.2, 20, 1)
 
     glTranslatef(0, 0, 0.8)
-    quadric = gluNewQuadric()
-    gluCylinder(quadric, 0.2, 0.2, 0.2, 20, 1)
-    quadric = gluNewQuadric()
-    gluCylinder(quadric, 0.075, 0.075, 0.2, 20, 1)
-    quadric = gluNewQuadric()
-    gluDisk(quadric, 0.075, 0.2, 20, 1)
+    cached_cylinder(0.2, 0.2, 0.2, 20, 1)
+    cached_cylinder(0.075, 0.075, 0.2, 20, 1)
+    cached_disk(0.075, 0.2, 20, 1)
 
     glTranslatef(1.6, 0, 0)
-    quadric = gluNewQuadric()
-    gluCylinder(quadric, 0.2, 0.2, 0.2, 20, 1)
-    quadric = gluNewQuadric()
-    gluCylinder(quadric, 0.075, 0.075, 0.2, 20, 1)
-    quadric = gluNewQuadric()
-    gluDisk(quadric, 0.075, 0.2, 20, 1)
+    cached_cylinder(0.2, 0.2, 0.2, 20, 1)
+    cached_cylinder(0.075, 0.075, 0.2, 20, 1)
+    cached_disk(0.075, 0.2, 20, 1)
 
     glPopMatrix()
 
@@ -621,28 +1625,22 @@ def prtStraightTrack(pillar):
     glColor3f(0.7, 0.7, 0.7)
 
     glTranslatef(0.35, -0.3, -5)
-    quadric = gluNewQuadric()
-    gluCylinder(quadric, 0.1, 0.1, 10, 20, 1)
+    cached_cylinder(0.1, 0.1, 10, 20, 1)
 
     glTranslatef(0, -0.3, 0)
-    quadric = gluNewQuadric()
-    gluCylinder(quadric, 0.1, 0.1, 10, 20, 1)
+    cached_cylinder(0.1, 0.1, 10, 20, 1)
 
     glTranslatef(0, -0.3, 0)
-    quadric = gluNewQuadric()
-    gluCylinder(quadric, 0.1, 0.1, 10, 20, 1)
+    cached_cylinder(0.1, 0.1, 10, 20, 1)
 
     glTranslatef(-0.7, 0, 0)
-    quadric = gluNewQuadric()
-    gluCylinder(quadric, 0.1, 0.1, 10, 20, 1)
+    cached_cylinder(0.1, 0.1, 10, 20, 1)
 
     glTranslatef(0, 0.3, 0)
-    quadric = gluNewQuadric()
-    gluCylinder(quadric, 0.1, 0.1, 10, 20, 1)
+    cached_cylinder(0.1, 0.1, 10, 20, 1)
 
     glTranslatef(0, 0.3, 0)
-    quadric = gluNewQuadric()
-    gluCylinder(quadric, 0.1, 0.1, 10, 20, 1)
+    cached_cylinder(0.1, 0.1, 10, 20, 1)
 
     glColor3f(0.6, 0.55, 0.5)
 
@@ -737,8 +1735,7 @@ def prtLight():
     glColor3f(0.8, 0.8, 0.8)
 
     glRotatef(90, 1, 0, 0)
-    quadric = gluNewQuadric()
-    gluCylinder(quadric, 0.2, 0.2, 5, 20, 1)
+    cached_cylinder(0.2, 0.2, 5, 20, 1)
 
     glColor3f(0.6, 0.6, 0.6)
 
@@ -747,399 +1744,735 @@ def prtLight():
 
     glPopMatrix()
 
-def draw_prt():
-        glPushMatrix()
-        glScale(1.2, 1.2, 1.2)
-        glRotatef(90, 0, 1, 0)
-        glTranslatef(-40, 10, 10)
-        prtStraightTrack(True)
-        glTranslatef(0, 0, -10)
-        prtStraightTrack(False)
+@dataclass
+class PrtPath:
+    """PRT route made of straight segments and circular arcs in the xz plane."""
+    starts : np.ndarray # Distance along the route at which each segment starts
+    points : np.ndarray # (x, z) where each segment starts
+    headings : np.ndarray # Heading in radians where each segment starts, counterclockwise seen from above like glRotatef about y
+    curvatures : np.ndarray # Change of heading per unit of distance, 0 on straight segments
+    length : float
 
-        glPushMatrix()
-        glTranslatef(0, 7, -5)
-        glTranslatef(0, 0, 13)
-        glRotatef(180, 0, 1, 0)
-        prtLight()
-        glPopMatrix()
+    @staticmethod
+    def build(segments, start=(0, 0), heading=0):
+        """segments is a list of (length, turn in degrees). A turn of 0 is a straight segment.
+        The route starts at the (x, z) start, heading in degrees away from +x."""
+        lengths = np.array([length for length, _ in segments], np.float64)
+        turns = np.radians([turn for _, turn in segments])
+        starts = np.concatenate([[0], np.cumsum(lengths)])
+        headings = np.radians(heading) + np.concatenate([[0], np.cumsum(turns)])
+        curvatures = turns / lengths
+        points = np.zeros((len(segments) + 1, 2))
+        points[0] = start
+        for i in range(len(segments)):
+            points[i + 1] = points[i] + PrtPath._advance(headings[i], curvatures[i], lengths[i])
+        return PrtPath(starts[:-1], points[:-1], headings[:-1], curvatures, float(starts[-1]))
 
-        glPushMatrix()
-        glTranslatef(0, 0, -6)
-        for i in range(1,19):
-            glScalef(1, 1, 0.333)
-            prtStraightTrack(False)
-            glScalef(1, 1, 3)
-            glRotatef(5, 0, 1, 0)
-            glTranslatef(0, 0, -1)
-        glTranslatef(0, 0, -5)
-        prtStraightTrack(True)
-        glTranslatef(0, 7, 0)
-        prtLight()
-        glTranslatef(0, -7, 0)
-        glTranslatef(0, 0, -10)
-        prtStraightTrack(False)
-        glTranslatef(0, 0, -10)
-        prtStraightTrack(False)
-        glTranslatef(0, 0, -10)
-        prtStraightTrack(True)
-        prtStraightTrack(False)
-        glTranslatef(0, 0, -10)
-        prtStraightTrack(False)
-        glTranslatef(0, 0, -10)
-        prtStraightTrack(True)
-        prtStraightTrack(False)
-        glTranslatef(0, 0, -10)
-        prtStraightTrack(False)
-        glPopMatrix()
+    @staticmethod
+    def _advance(heading, curvature, distance):
+        """(dx, dz) covered by moving distance along a segment that starts with heading. Works on arrays too."""
+        straight = curvature == 0
+        curvature = np.where(straight, 1, curvature)  # Avoids the division on straight segments, whose result is discarded
+        end = heading + curvature * distance
+        dx = np.where(straight, np.cos(heading) * distance, (np.sin(end) - np.sin(heading)) / curvature)
+        dz = np.where(straight, -np.sin(heading) * distance, (np.cos(end) - np.cos(heading)) / curvature)
+        return np.stack([dx, dz], -1)
+
+    def poses(self, distances):
+        """x, z and heading of pods at the given distances along the route. The segment of each is found by binary search."""
+        distances = np.clip(distances, 0, self.length)
+        segment = np.searchsorted(self.starts, distances, side='right') - 1
+        along = distances - self.starts[segment]
+        offset = self._advance(self.headings[segment], self.curvatures[segment], along)
+        x, z = (self.points[segment] + offset).T
+        return x, z, self.headings[segment] + self.curvatures[segment] * along
+
+    def matrices(self, distances):
+        """Column-major model matrices that place a pod at each of the distances, facing along the route."""
+        x, z, heading = self.poses(np.atleast_1d(distances))
+        matrices = np.zeros((len(x), 16), np.float32)
+        matrices[:, 0] = matrices[:, 10] = np.cos(heading)
+        matrices[:, 8] = np.sin(heading)
+        matrices[:, 2] = -matrices[:, 8]
+        matrices[:, 5] = matrices[:, 15] = 1
+        matrices[:, 12] = x
+        matrices[:, 14] = z
+        return matrices
+
+# The two routes of the guideway, in the frame draw_prt draws the pods in. The turns have the radii and run-outs of
+# the 36 step approximations the pods were moved along before, so they still follow the same guideway
+prt_path = PrtPath.build([(33, 0), (10.590, 90), (6.590, 0), (5.275, -90), (12.25, 0), (10.590, 90), (35.035, 0)])
+prt_path2 = PrtPath.build([(35.305, 0), (5.275, -90), (12, 0), (10.590, 90), (6.590, 0), (5.275, -90), (37.25, 0)], (59.6, -58), 270)
+prt_routes = [(prt_path, 0, 112), (prt_path2, 3, 110)] # (path, start, end) the pods run along, see PrtFleet
+# Forest settings
+forest_file = "Resources/forest.csv" # Table of the trees in the scene
+forest_trees = None # Number of randomly placed trees to use instead of the table. None uses the table
+forest_seed = 0
+
+# PRT pod speeds
+maxSpeed = 4.5
+minSpeed = 0
+prt_pods = 2 # Number of pods on the guideway, at most PrtFleet.capacity(prt_routes)
+
+class PrtFleet:
+    """Every pod on the guideway. Positions, speeds and accelerations are arrays so all pods advance in one step."""
+    headway = 2.5 # Closest a pod may get to the one ahead of it on its route. Pods are 2 long
+
+    def __init__(self, routes, count):
+        """routes is a list of (path, start, end). Pods go back to the start of the path once they pass end.
+        The pods are spread over the routes in proportion to their length."""
+        self.paths = [path for path, _, _ in routes]
+        starts = np.array([start for _, start, _ in routes], np.float64)
+        self.ends = np.array([end for _, _, end in routes], np.float64)
+        per_route = np.round(count * self.ends / self.ends.sum()).astype(int)
+        per_route[-1] = count - per_route[:-1].sum()
+        if count < 0 or np.any(per_route * self.headway > self.ends):
+            raise ValueError(f"{count} pods do not fit on the guideway, at most {PrtFleet.capacity(routes)} do")
+        self.route = np.repeat(np.arange(len(routes)), per_route)
+        rank = np.arange(count) - np.searchsorted(self.route, self.route)  # Index of each pod among the pods of its route
+        self.position = (starts[self.route] + rank * self.ends[self.route] / per_route[self.route]) % self.ends[self.route]
+        self.speed = np.zeros(count)
+        self.acceleration = np.full(count, 1.5)
+        self.previous = self.position.copy() # Positions at the tick before the last one
+        self.shown = self.position.copy() # Positions the pods are drawn at, between previous and position
 
-        glPushMatrix()
-        glTranslatef(0, 0, 16)
-        for i in range(1,19):
-            glScalef(1, 1, 0.333)
-            prtStraightTrack(False)
-            glScalef(1, 1, 3)
-            glRotatef(5, 0, 1, 0)
-            glTranslatef(0, 0, 1)
-        
-        glTranslatef(0, 0, 5)
-        prtStraightTrack(True)
-        glTranslatef(0, 7, 0)
-        prtLight()
-        glTranslatef(0, -7, 0)
-
-        glTranslatef(0, 0, 5)
-        for i in range(1,19):
-            glScalef(1, 1, 0.333)
-            prtStraightTrack(False)
-            glScalef(1, 1, 3)
-            glRotatef(-5, 0, 1, 0)
-            glTranslatef(0, 0, 1)
-        
-        glTranslatef(0, 0, 5)
-        prtStraightTrack(True)
-
-        glTranslatef(0, 0, 10)
-        prtStraightTrack(False)
-        glTranslatef(0, 0, 10)
-        prtStraightTrack(False)
-        glTranslatef(0, 0, 10)
-        prtStraightTrack(True)
-        glTranslatef(0, 0, 10)
-        prtStraightTrack(False)
-        glTranslatef(0, 0, 10)
-        prtStraightTrack(False)
-        glTranslatef(0, 0, 10)
-        prtStraightTrack(True)
+    @staticmethod
+    def capacity(routes):
+        """Most pods that fit on routes at the headway."""
+        return int(sum(end // PrtFleet.headway for _, _, end in routes))
+
+    def step(self, delta):
+        """Accelerates every pod, holds it back at the headway behind the pod ahead, and moves it along its route."""
+        if delta <= 0:
+            return
+        self.previous = self.position.copy()
+        self.speed = np.clip(self.speed + self.acceleration * delta, minSpeed, maxSpeed)
+
+        # Sorted by route and then position, the pod ahead of each one is the next in order. The last one on a route follows the first
+        order = np.lexsort((self.position, self.route))
+        route = self.route[order]
+        ahead = np.roll(order, -1)
+        last = np.append(route[1:] != route[:-1], True)
+        ahead[last] = order[np.searchsorted(route, route[last])]
+        gap = (self.position[ahead] - self.position[order]) % self.ends[route]
+        gap[ahead == order] = np.inf  # Alone on its route
+        self.speed[order] = np.minimum(self.speed[order], np.maximum(gap - self.headway, 0) / delta)
+
+        self.position += self.speed * delta
+        wrapped = self.position > self.ends[self.route]
+        self.position[wrapped] = 0
+        self.previous[wrapped] = 0  # Jumps back to the start instead of sliding back along the route
+        self.speed[wrapped] = 0
+
+    def interpolate(self, alpha):
+        """Shows the pods alpha of the way from where they were at the tick before the last one to where they are."""
+        self.shown = self.previous + (self.position - self.previous) * alpha
+
+    def matrices(self):
+        """Model matrix of every pod where it is shown, in the frame draw_prt draws the pods in."""
+        matrices = np.empty((len(self.shown), 16), np.float32)
+        for route, path in enumerate(self.paths):
+            on_route = self.route == route
+            matrices[on_route] = path.matrices(self.shown[on_route])
+        return matrices
+
+# Pod geometry and the frame the pods are drawn in, both set up by compile_guideway
+prt_car_dl = None
+prt_frame = None
+# Boxes around what prtStraightTrack, its pillar, prtLight and prtCar draw, in their own frames
+prt_track_bounds = ((-5.05, -4.51, -5), (5.05, 1.91, 5))
+prt_pillar_bottom = -11.51
+prt_light_bounds = ((-1.25, -5.01, -0.5), (1.25, 0.11, 0.5))
+prt_pod_bounds = ((-1.1, -0.22, -0.5), (1.1, 1.41, 0.5))
+
+def prt_guideway_frame():
+    glScale(1.2, 1.2, 1.2)
+    glRotatef(90, 0, 1, 0)
+    glTranslatef(-40, 10, 10)
+
+def prt_loop(track, light):
+    """Draws the guideway loop the pods run on with the given track and light functions, leaving the matrix where the pods start."""
+    glTranslatef(0, 0, 16)
+    for i in range(1,19):
+        glScalef(1, 1, 0.333)
+        track(False)
+        glScalef(1, 1, 3)
+        glRotatef(5, 0, 1, 0)
+        glTranslatef(0, 0, 1)
+    
+    glTranslatef(0, 0, 5)
+    track(True)
+    glTranslatef(0, 7, 0)
+    light()
+    glTranslatef(0, -7, 0)
+
+    glTranslatef(0, 0, 5)
+    for i in range(1,19):
+        glScalef(1, 1, 0.333)
+        track(False)
+        glScalef(1, 1, 3)
+        glRotatef(-5, 0, 1, 0)
+        glTranslatef(0, 0, 1)
+    
+    glTranslatef(0, 0, 5)
+    track(True)
+
+    glTranslatef(0, 0, 10)
+    track(False)
+    glTranslatef(0, 0, 10)
+    track(False)
+    glTranslatef(0, 0, 10)
+    track(True)
+    glTranslatef(0, 0, 10)
+    track(False)
+    glTranslatef(0, 0, 10)
+    track(False)
+    glTranslatef(0, 0, 10)
+    track(True)
+
+def draw_guideway(track=prtStraightTrack, light=prtLight):
+    """Draws the guideway with the given track and light functions. compile_guideway also replays it to find its bounds."""
+    glPushMatrix()
+    prt_guideway_frame()
+    track(True)
+    glTranslatef(0, 0, -10)
+    track(False)
 
-        glPushMatrix()
-        glScalef(2, 2, 2)
-        glRotatef(90, 0, 1, 0)
-        glTranslatef(0, 0.5, 1.25)
-        glPushMatrix()
+    glPushMatrix()
+    glTranslatef(0, 7, -5)
+    glTranslatef(0, 0, 13)
+    glRotatef(180, 0, 1, 0)
+    light()
+    glPopMatrix()
 
-        glTranslatef(min(position, 33), 0, 0)
-        turns = max(0, min((position - 33)/0.306, 36))
-        for i in range(round(turns)):
-            glRotatef(2.5, 0, 1, 0)
-            glTranslatef(0.306, 0, -0.005)
-        if position > 33 and position < 44:
-            glTranslatef(position-33-round(turns)*0.306, 0, -0.016*(position-33-round(turns)*0.306))
+    glPushMatrix()
+    glTranslatef(0, 0, -6)
+    for i in range(1,19):
+        glScalef(1, 1, 0.333)
+        track(False)
+        glScalef(1, 1, 3)
+        glRotatef(5, 0, 1, 0)
+        glTranslatef(0, 0, -1)
+    glTranslatef(0, 0, -5)
+    track(True)
+    glTranslatef(0, 7, 0)
+    light()
+    glTranslatef(0, -7, 0)
+    glTranslatef(0, 0, -10)
+    track(False)
+    glTranslatef(0, 0, -10)
+    track(False)
+    glTranslatef(0, 0, -10)
+    track(True)
+    track(False)
+    glTranslatef(0, 0, -10)
+    track(False)
+    glTranslatef(0, 0, -10)
+    track(True)
+    track(False)
+    glTranslatef(0, 0, -10)
+    track(False)
+    glPopMatrix()
 
-        glTranslatef(max(0, min(position-44, 5.75)), 0, 0)
-        
-        turns = max(0, min((position - 49.75)/0.153, 36))
-        for i in range(round(turns)):
-            glRotatef(-2.5, 0, 1, 0)
-            glTranslatef(0.153, 0, -0.01)
-        if position > 49.75 and position < 55.25:
-            glTranslatef(position-49.75-round(turns)*0.153, 0, 0.065*(position-49.75-round(turns)*0.153))
-        
-        glTranslatef(max(0, min(position-55.25, 12.25)), 0, 0)
-
-        turns = max(0, min((position - 67.5)/0.306, 36))
-        for i in range(round(turns)):
-            glRotatef(2.5, 0, 1, 0)
-            glTranslatef(0.306, 0, -0.005)
-        if position > 67.5 and position < 78.5:
-            glTranslatef(position-67.5-round(turns)*0.306, 0, -0.016*(position-67.5-round(turns)*0.306))
-        
-        glTranslatef(max(0, min(position-78.5, 34.5)), 0, 0)
- 
-        prtCar()
-        glPopMatrix()
+    glPushMatrix()
+    prt_loop(track, light)
+    glPopMatrix()
+    glPopMatrix()
 
-        glRotatef(270, 0, 1, 0)
-        glTranslatef(-58, 0, -59.6)
-
-        glTranslatef(min(position2, 35), 0, 0)
-        turns = max(0, min((position2 - 35)/0.153, 36))
-        for i in range(round(turns)):
-            glRotatef(-2.5, 0, 1, 0)
-            glTranslatef(0.153, 0, -0.01)
-        if position2 > 35 and position2 < 40.5:
-            glTranslatef(position2-35-round(turns)*0.153, 0, -0.065*(position2-35-round(turns)*0.153))
-
-        glTranslatef(max(0, min(position2-40.5, 12)), 0, 0)
-
-        turns = max(0, min((position2 - 52.5)/0.306, 36))
-        for i in range(round(turns)):
-            glRotatef(2.5, 0, 1, 0)
-            glTranslatef(0.306, 0, -0.005)
-        if position2 > 52.5 and position2 < 63.5:
-            glTranslatef(position2-52.5-round(turns)*0.306, 0, -0.016*(position2-52.5-round(turns)*0.306))
-        
-        glTranslatef(max(0, min(position2-63.5, 5.75)), 0, 0)
+def compile_guideway():
+    """Compiles the guideway and the pod geometry into display lists and finds the frame the pods are drawn in.
+    Returns the guideway as a Drawable."""
+    global prt_car_dl, prt_frame
+    guideway_dl = glGenLists(1)
+    glNewList(guideway_dl, GL_COMPILE)
+    draw_guideway()
+    glEndList()
 
-        turns = max(0, min((position2 - 69.25)/0.153, 36))
-        for i in range(round(turns)):
-            glRotatef(-2.5, 0, 1, 0)
-            glTranslatef(0.153, 0, -0.01)
-        if position2 > 69.25 and position2 < 74.75:
-            glTranslatef(position2-69.25-round(turns)*0.153, 0, -0.065*(position2-69.25-round(turns)*0.153))
+    prt_car_dl = glGenLists(1)
+    glNewList(prt_car_dl, GL_COMPILE)
+    prtCar()
+    glEndList()
 
-        glTranslatef(max(0, min(position2-74.75, 37.25)), 0, 0)
+    glPushMatrix()
+    glLoadIdentity()
+    # Only follow the transformations of the guideway, adding up the boxes around its pieces instead of drawing them
+    boxes = []
+    track_box = lambda pillar: boxes.append(transform_bounds(glGetFloatv(GL_MODELVIEW_MATRIX), (prt_track_bounds[0][0], prt_pillar_bottom if pillar else prt_track_bounds[0][1], prt_track_bounds[0][2]), prt_track_bounds[1]))
+    light_box = lambda: boxes.append(transform_bounds(glGetFloatv(GL_MODELVIEW_MATRIX), *prt_light_bounds))
+    draw_guideway(track_box, light_box)
 
-        prtCar()
+    # Only follow the transformations of the loop, without drawing it
+    glLoadIdentity()
+    prt_guideway_frame()
+    glTranslatef(0, 0, -10)  # Left over from the first two pieces of track in draw_guideway
+    prt_loop(lambda pillar: None, lambda: None)
+    glScalef(2, 2, 2)
+    glRotatef(90, 0, 1, 0)
+    glTranslatef(0, 0.5, 1.25)
+    prt_frame = glGetFloatv(GL_MODELVIEW_MATRIX)
+    glPopMatrix()
+    return Drawable("guideway", guideway_dl, np.min([lower for lower, _ in boxes], 0), np.max([upper for _, upper in boxes], 0), textured=False)
+
+def build_light_list():
+    """LightList of the street lights, a light at each PRT lamp and lights under the pieces of guideway track at least
+    guideway_light_spacing apart, brightest first so full cells leave out the dimmest."""
+    lights = LightList((-150, -0.5, -150), (150, 0, 150), light_cell_size)
+    for position in street_lights:
+        lights.add_spot(position, (1, 1, 1), (0, -1, 0), 40, 80)
+    tracks, lamps = [], []
+    glPushMatrix()
+    glLoadIdentity()
+    draw_guideway(lambda pillar: tracks.append(glGetFloatv(GL_MODELVIEW_MATRIX)[3, :3].copy()), lambda: lamps.append(glGetFloatv(GL_MODELVIEW_MATRIX)[3, :3].copy()))
+    glPopMatrix()
+    for position in lamps:
+        lights.add_point(position - (0, 1, 0), (1, 0.9, 0.7), prt_lamp_reach)  # Just under the lamp head
+    placed = []
+    for position in tracks:
+        if all(np.linalg.norm(position - other) >= guideway_light_spacing for other in placed):
+            placed.append(position)
+            lights.add_point(position - (0, 6, 0), (0.6, 0.7, 0.9), guideway_light_reach)  # Under the deck of the track
+    dropped = lights.build()
+    if dropped:
+        print(f"{dropped} lights left out of ground cells reached by more than {LightList.cell_capacity}")
+    return lights
+
+def prt_pod_boxes(fleet):
+    """World space (lower, upper) corners of the boxes around the pods."""
+    return transform_bounds(fleet.matrices().reshape(-1, 4, 4) @ prt_frame, *prt_pod_bounds)
+
+def draw_prt(fleet, visible):
+    """Draws the pods set in the visible mask. The guideway they run on is drawn by compile_guideway's Drawable."""
+    matrices = fleet.matrices()
+    glPushMatrix()
+    glMultMatrixf(prt_frame)
+    for matrix in matrices[visible]:
+        glPushMatrix()
+        glMultMatrixf(matrix)
+        glCallList(prt_car_dl)
         glPopMatrix()
+    glPopMatrix()
 
-        #prtStraightTrack(True)
-        glPopMatrix()
-        glPopMatrix()
+def fixed_function_lighting(lights):
+    """GLSL function doing the fixed function per-vertex lighting, with GL_COLOR_MATERIAL tracking the ambient and
+    diffuse color, for the given light numbers. Lets geometry drawn with shaders look like the rest of the scene."""
+    return """
+vec4 light(gl_LightSourceParameters light, vec3 eye, vec3 normal, vec4 color) {
+    vec3 to_light = light.position.xyz - eye * light.position.w;
+    float distance = length(to_light);
+    to_light = normalize(to_light);
+    float attenuation = 1.0;
+    if (light.position.w != 0.0)
+        attenuation = 1.0 / (light.constantAttenuation + light.linearAttenuation * distance + light.quadraticAttenuation * distance * distance);
+    if (light.spotCutoff != 180.0) {
+        float spot = dot(-to_light, normalize(light.spotDirection));
+        attenuation *= spot < light.spotCosCutoff ? 0.0 : pow(spot, light.spotExponent);
+    }
+    float diffuse = max(dot(normal, to_light), 0.0);
+    float specular = diffuse > 0.0 ? pow(max(dot(normal, normalize(to_light + vec3(0.0, 0.0, 1.0))), 1e-6), gl_FrontMaterial.shininess) : 0.0;
+    return attenuation * (light.ambient * color + diffuse * light.diffuse * color + specular * light.specular * gl_FrontMaterial.specular);
+}
+
+vec4 fixed_function_lighting(vec3 eye, vec3 normal, vec4 color) {
+    vec4 result = gl_FrontMaterial.emission + gl_LightModel.ambient * color;
+""" + "".join(f"    result += light(gl_LightSource[{i}], eye, normal, color);\n" for i in lights) + """    return vec4(result.rgb, color.a);
+}
+"""
+
+# Per pixel lighting settings
+per_pixel_lighting = False  # Light in the fragment shaders instead of per vertex, adding the lights of the guideway to the street lights
+light_cell_size = 10  # Side of the cells of the grid over the ground the lights are sorted into for per pixel lighting
+guideway_light_spacing = 12  # Closest two lights under the guideway track get to each other
+guideway_light_reach = 14  # Distance at which the lights under the guideway fade out
+prt_lamp_reach = 18  # Distance at which the lights of the PRT lamps fade out
+
+per_vertex_fragment_lighting = """
+vec4 lighting(vec4 color) {
+    return color;
+}
+"""
+
+per_pixel_vertex_lighting = """
+varying vec3 lit_eye;
+varying vec3 lit_normal;
+
+vec4 fixed_function_lighting(vec3 eye, vec3 normal, vec4 color) {
+    lit_eye = eye;
+    lit_normal = normal;
+    return color;
+}
+"""
+
+def per_pixel_fragment_lighting(lights):
+    """GLSL function lighting a pixel with fixed_function_lighting for the given light numbers, plus the lights of the
+    LightList in the ground cell under the pixel."""
+    texels = LightList.cell_capacity // 4
+    return fixed_function_lighting(lights) + f"""
+uniform bool street_lights_on;
+uniform vec4 light_position[{LightList.capacity}]; // Eye coordinates, and the distance the light fades out at. 0 does not fade
+uniform vec4 light_color[{LightList.capacity}]; // Color, and spot exponent
+uniform vec4 light_spot[{LightList.capacity}]; // Eye coordinates direction the spot shines in, and cosine of its cutoff. -1 for point lights
+uniform sampler2D light_cells; // Light numbers of each cell, {LightList.cell_capacity} a cell along x and a cell a row along z. 255 ends the list
+uniform vec4 light_grid; // x and z of the corner of the grid, cells along x and along z
+uniform float light_cell_size;
+uniform mat4 eye_to_world;
+varying vec3 lit_eye;
+varying vec3 lit_normal;
+
+vec3 street_light(float slot, vec3 eye, vec3 normal, vec3 color) {{
+    int i = int(slot * 255.0 + 0.5);
+    if (i == 255)
+        return vec3(0.0);
+    vec3 to_light = light_position[i].xyz - eye;
+    float distance = length(to_light);
+    to_light /= distance;
+    float attenuation = 1.0;
+    if (light_position[i].w > 0.0) {{
+        float fade = clamp(1.0 - distance * distance / (light_position[i].w * light_position[i].w), 0.0, 1.0);
+        attenuation = fade * fade;
+    }}
+    if (light_spot[i].w > -1.0) {{
+        float spot = dot(-to_light, light_spot[i].xyz);
+        attenuation *= spot < light_spot[i].w ? 0.0 : pow(spot, light_color[i].a);
+    }}
+    float diffuse = max(dot(normal, to_light), 0.0);
+    float specular = diffuse > 0.0 ? pow(max(dot(normal, normalize(to_light + vec3(0.0, 0.0, 1.0))), 1e-6), gl_FrontMaterial.shininess) : 0.0;
+    return attenuation * light_color[i].rgb * (diffuse * color + specular * gl_FrontMaterial.specular.rgb);
+}}
+
+vec4 lighting(vec4 color) {{
+    vec3 normal = normalize(lit_normal);
+    vec4 result = fixed_function_lighting(lit_eye, normal, color);
+    if (street_lights_on) {{
+        vec2 cell = floor(((eye_to_world * vec4(lit_eye, 1.0)).xz - light_grid.xy) / light_cell_size);
+        if (all(greaterThanEqual(cell, vec2(0.0))) && all(lessThan(cell, light_grid.zw))) {{
+            for (int texel = 0; texel < {texels}; texel++) {{
+                vec4 slots = texture2D(light_cells, vec2((cell.x * {texels}.0 + float(texel) + 0.5) / (light_grid.z * {texels}.0), (cell.y + 0.5) / light_grid.w));
+                result.rgb += street_light(slots.x, lit_eye, normal, color.rgb) + street_light(slots.y, lit_eye, normal, color.rgb)
+                            + street_light(slots.z, lit_eye, normal, color.rgb) + street_light(slots.w, lit_eye, normal, color.rgb);
+            }}
+        }}
+    }}
+    return vec4(result.rgb, color.a);
+}}
+"""
+
+class LightList:
+    """Lights of the street and of the guideway for per pixel lighting, with the list of the lights that reach each
+    cell of a grid over the ground. Shaders only go through the lights of the cell under each pixel, so a light only
+    costs where it shines."""
+    capacity = 64 # Most lights. Sizes the uniform arrays of the shaders, and cells store light numbers in bytes
+    cell_capacity = 12 # Most lights reaching one cell, a multiple of 4. The lights added last are left out of full cells
+
+    def __init__(self, lower, upper, cell_size):
+        """The grid covers the ground from the (x, z) of lower to the (x, z) of upper."""
+        self.origin = np.array([lower[0], lower[2]], np.float32)
+        self.cell_size = cell_size
+        self.cells = np.ceil((np.array([upper[0], upper[2]]) - self.origin) / cell_size).astype(int) # Along x and z
+        self.positions = np.empty((0, 4), np.float32) # World coordinates, and reach like the light_position uniform
+        self.colors = np.empty((0, 4), np.float32) # Like the light_color uniform
+        self.spots = np.empty((0, 4), np.float32) # World direction, and cosine of the cutoff like the light_spot uniform
+        self.radii = [] # Of the circle around each light on the ground that it reaches
+        self.texture_id = None
+        self.uniforms = None # Values of the uniforms for the current camera, set by place
+        self.uploaded = set() # Programs given the uniforms since the last place
+
+    def add_point(self, position, color, reach):
+        """Adds a light shining all around that fades out at reach."""
+        self._add(position, reach, color, 0, (0, 0, 0), -1, reach)
+
+    def add_spot(self, position, color, direction, cutoff, exponent, ground=-0.5):
+        """Adds a spot light that does not fade with distance, like the fixed function ones with the same parameters."""
+        direction = np.divide(direction, np.linalg.norm(direction))
+        # Beyond the angle the exponent leaves under 1/256 of the light, the spot no longer shows
+        angle = min(math.radians(cutoff), math.acos((1 / 256) ** (1 / exponent)) if exponent > 0 else math.pi / 2)
+        radius = (position[1] - ground) * math.tan(angle) if direction[1] < 0 and angle < math.pi / 2 else np.inf
+        self._add(position, 0, color, exponent, direction, math.cos(math.radians(cutoff)), radius)
+
+    def _add(self, position, reach, color, exponent, direction, cos_cutoff, radius):
+        if len(self.radii) == self.capacity:
+            raise Exception(f"A LightList holds at most {self.capacity} lights")
+        self.positions = np.vstack([self.positions, [*position, reach]])
+        self.colors = np.vstack([self.colors, [*color, exponent]])
+        self.spots = np.vstack([self.spots, [*direction, cos_cutoff]])
+        self.radii.append(radius)
+
+    def build(self):
+        """Sorts the lights into the cells they reach and uploads the cells to a texture on texture unit 1, 4 light
+        numbers a texel. Returns how many lights full cells left out."""
+        cells = np.full((self.cells[1], self.cells[0], self.cell_capacity), 255, np.uint8)
+        counts = np.zeros((self.cells[1], self.cells[0]), int)
+        dropped = 0
+        for i, (position, radius) in enumerate(zip(self.positions, self.radii)):
+            center = position[[0, 2]] - self.origin
+            lower = np.clip(np.floor((center - radius) / self.cell_size), 0, self.cells - 1).astype(int)
+            upper = np.clip(np.floor((center + radius) / self.cell_size), 0, self.cells - 1).astype(int)
+            for z in range(lower[1], upper[1] + 1):
+                for x in range(lower[0], upper[0] + 1):
+                    nearest = np.clip(center, np.array([x, z]) * self.cell_size, np.array([x + 1, z + 1]) * self.cell_size)
+                    if np.linalg.norm(nearest - center) > radius:
+                        continue
+                    if counts[z, x] == self.cell_capacity:
+                        dropped += 1
+                        continue
+                    cells[z, x, counts[z, x]] = i
+                    counts[z, x] += 1
+        if self.texture_id is None:
+            self.texture_id = glGenTextures(1)
+        glActiveTexture(GL_TEXTURE1)
+        glBindTexture(GL_TEXTURE_2D, self.texture_id)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP_TO_EDGE)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_CLAMP_TO_EDGE)
+        glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
+        glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA8, self.cells[0] * self.cell_capacity // 4, self.cells[1], 0, GL_RGBA, GL_UNSIGNED_BYTE, cells)
+        glActiveTexture(GL_TEXTURE0)
+        return dropped
+
+    def place(self, view, on):
+        """Moves the lights into the eye coordinates of view, the camera matrix column-major like glGetFloatv returns
+        it. on switches them all on or off. Called every frame once the camera has moved."""
+        positions = self.positions.copy()
+        positions[:, :3] = positions[:, :3] @ view[:3, :3] + view[3, :3]
+        spots = self.spots.copy()
+        spots[:, :3] = spots[:, :3] @ view[:3, :3]
+        self.uniforms = (on, positions, spots, np.linalg.inv(view).astype(np.float32))
+        self.uploaded.clear()
+
+    def upload(self, program):
+        """Gives program, which must be current, the uniforms of the lights unless it already has them."""
+        if self.uniforms is None or program in self.uploaded:
+            return
+        on, positions, spots, eye_to_world = self.uniforms
+        location = lambda name: glGetUniformLocation(program, name)
+        glUniform1i(location("street_lights_on"), int(on))
+        glUniform4fv(location("light_position"), len(positions), positions)
+        glUniform4fv(location("light_color"), len(positions), self.colors)
+        glUniform4fv(location("light_spot"), len(positions), spots)
+        glUniform1i(location("light_cells"), 1)
+        glUniform4f(location("light_grid"), *self.origin, *self.cells)
+        glUniform1f(location("light_cell_size"), self.cell_size)
+        glUniformMatrix4fv(location("eye_to_world"), 1, GL_FALSE, eye_to_world)
+        self.uploaded.add(program)
+
+light_list = None # LightList of per pixel lighting, built by load_scene when it is on
+
+class LitProgram:
+    """Shader program whose vertex shader calls fixed_function_lighting. Like the fixed function pipeline, it is
+    compiled once for every combination of enabled lights so no time is spent on the lights that are off. With
+    per_pixel_lighting, fixed_function_lighting only passes its arguments on and the fragment shader lights the pixel,
+    taking the street lights from light_list instead of their GL lights."""
+    def __init__(self, vertex_shader, fragment_shader):
+        self.vertex_shader = vertex_shader # "{lighting}" is replaced by fixed_function_lighting
+        self.fragment_shader = fragment_shader # "{lighting}" is replaced by a lighting function taking and returning the color
+        self.programs = {}
+
+    def use(self):
+        """Makes the program for the lights that are currently enabled current and returns it."""
+        lights = tuple(i for i in range(8) if glIsEnabled(GL_LIGHT0 + i) and not (per_pixel_lighting and 1 <= i <= len(street_lights)))
+        key = (lights, per_pixel_lighting)
+        if key not in self.programs:
+            vertex_lighting = per_pixel_vertex_lighting if per_pixel_lighting else fixed_function_lighting(lights)
+            fragment_lighting = per_pixel_fragment_lighting(lights) if per_pixel_lighting else per_vertex_fragment_lighting
+            self.programs[key] = shaders.compileProgram(
+                shaders.compileShader(self.vertex_shader.replace("{lighting}", vertex_lighting), GL_VERTEX_SHADER),
+                shaders.compileShader(self.fragment_shader.replace("{lighting}", fragment_lighting), GL_FRAGMENT_SHADER))
+        glUseProgram(self.programs[key])
+        if per_pixel_lighting and light_list is not None:
+            light_list.upload(self.programs[key])
+        return self.programs[key]
+
+def instancing_supported():
+    return bool(glDrawElementsInstanced) and bool(glVertexAttribDivisor)
+
+# One row per tree. position is the bottom of the trunk, the canopy sits on top of it
+tree_dtype = np.dtype([
+    ("position", np.float32, 3),
+    ("trunk_radius", np.float32),
+    ("trunk_height", np.float32),
+    ("canopy_radius", np.float32),
+    ("canopy_height", np.float32),
+    ("green", np.float32),
+])
+
+class Forest:
+    """Every tree of the scene. The canopies are drawn with one instanced draw per level of detail and the trunks with another."""
+    canopy_slices = 15
+    trunk_slices = 5
+    lods = [(30, 8, 4), (12, 5, 3)] # (size on screen in pixels below which it is used, canopy slices, trunk slices) of the simpler levels of detail
+    canopy_top = 0.1 # Radius of the tip of every canopy
+    trunk_color = (0.6, 0.3, 0)
+
+    vertex_shader = """
+    #version 120
+    attribute vec4 instance_base; // Center of the bottom and height
+    attribute vec2 instance_radii; // Bottom and top radius
+    attribute vec3 instance_color;
+    {lighting}
+    void main() {
+        // gl_Vertex is a point of a unit cylinder: xy goes around the axis and z from its bottom to its top
+        float radius = mix(instance_radii.x, instance_radii.y, gl_Vertex.z);
+        vec3 position = instance_base.xyz + vec3(gl_Vertex.x * radius, gl_Vertex.z * instance_base.w, -gl_Vertex.y * radius);
+        vec3 normal = vec3(gl_Vertex.x, (instance_radii.x - instance_radii.y) / instance_base.w, -gl_Vertex.y);
+        vec4 eye = gl_ModelViewMatrix * vec4(position, 1.0);
+        gl_Position = gl_ProjectionMatrix * eye;
+        gl_FrontColor = fixed_function_lighting(eye.xyz, normalize(gl_NormalMatrix * normal), vec4(instance_color, 1.0));
+    }
+    """
+    fragment_shader = """
+    #version 120
+    {lighting}
+    void main() {
+        gl_FragColor = lighting(gl_Color);
+    }
+    """
+
+    def __init__(self, trees):
+        self.trees = trees
+        self.program = None
+        self.buffers = None # ([(mesh vbo, mesh ibo, index count) of each level of detail], instance vbo, instances) of the canopies and of the trunks
+        self.fallback_dl = None # Used instead of instancing when the GL version does not support it
+        self.order = None # Trees the instance buffers hold, by level of detail. Only changes when the trees the camera sees or their levels do
+        self.levels = np.zeros(len(trees), int) # Level of detail of each tree, 0 is the most detailed
+        self.handles = None # Of the box of each tree in the SpatialGrid of the scene
+        # Box around every tree
+        radius = np.maximum(trees["trunk_radius"], trees["canopy_radius"])
+        self.lower = trees["position"] - np.stack([radius, np.zeros(len(trees)), radius], 1)
+        self.upper = trees["position"] + np.stack([radius, trees["trunk_height"] + trees["canopy_height"], radius], 1)
 
-def draw_trees():
-    positionsX = [
--53,
--27,
--50,
--51,
--35,
--75,
--61,
--86,
--73,
--63,
--55,
--48,
--43,
--45,
--37,
--20,
--68,
--49,
--80,
--77,
--64,
--25,
--76,
--56,
--21,
--57,
--72,
--88,
--58,
--81,
--94,
--92,
--30,
--44,
--60,
--84,
--87,
--78,
--67,
--85,
--32,
--38,
--98,
--99,
--23,
--79,
--91,
--97,
--47,
--22,
-71,
-34,
-68,
-31,
-94,
-61,
-97,
-87,
-65,
-43,
-21,
-79,
-96,
-27,
-48,
-64,
-54,
-75,
-47,
-36,
-66,
-82,
-22,
-55,
-33,
-57,
-72,
-44,
-83,
-78,
-91,
-42,
-20,
-40,
-37,
-69,
-74,
-52,
-88,
-56,
-81,
-32,
-53,
-93,
-23,
-35,
-50,
-45,
-70,
-49
-    ]
-    positionsY = [
--26,
--105,
--53,
--122,
--112,
--128,
--107,
--129,
--64,
--124,
--101,
--62,
--46,
--125,
--60,
--109,
--20,
--88,
--77,
--65,
--31,
--83,
--32,
--120,
--51,
--76,
--114,
--63,
--81,
--70,
--127,
--44,
--102,
--85,
--68,
--33,
--91,
--106,
--38,
--58,
--45,
--61,
--54,
--49,
--22,
--94,
--40,
--72,
--75,
--71,
--55,
--74,
--30,
--79,
--118,
--97,
--100,
--66,
--93,
--126,
--108,
--98,
--43,
--28,
--110,
--89,
--67,
--113,
--82,
--48,
--130,
--84,
--87,
--59,
--103,
--104,
--39,
--24,
--50,
--25,
--92,
--99,
--111,
--115,
--41,
--52,
--21,
--36,
--29,
--47,
--119,
--35,
--27,
--86,
--90,
--23,
--69,
--78,
--95,
--73]
-    greens = [
-        0.6288, 0.6232, 0.7784, 0.7038, 0.7922, 0.7818, 0.7809, 0.7402, 0.7935, 0.6935, 0.7118, 0.6322, 0.6171, 0.6641, 0.6065, 0.6665, 0.707, 0.6596, 0.6631, 0.7858, 0.666, 0.7807, 0.6109, 0.7763, 0.6847, 0.7916, 0.7235, 0.6516, 0.6955, 0.6014, 0.6, 0.7085, 0.787, 0.748, 0.7103, 0.6664, 0.7721, 0.7233, 0.7858, 0.7343, 0.746, 0.6137, 0.7417, 0.6776, 0.6675, 0.631, 0.7975, 0.6932, 0.7772, 0.6468, 0.6758, 0.6657, 0.6913, 0.7668, 0.7346, 0.6441, 0.715, 0.7385, 0.6775, 0.6037, 0.7618, 0.6587, 0.6385, 0.6607, 0.6182, 0.6584, 0.6169, 0.7854, 0.7797, 0.6013, 0.7296, 0.6396, 0.6499, 0.6793, 0.7937, 0.703, 0.6793, 0.7361, 0.7066, 0.7633, 0.7552, 0.7879, 0.7848, 0.6808, 0.672, 0.6053, 0.6068, 0.6386, 0.727, 0.7323, 0.6367, 0.745, 0.7304, 0.6732, 0.7706, 0.7459, 0.7548, 0.7097, 0.6402, 0.7634
-    ]
-    trunks = [
-        0.2547, 0.3544, 0.276, 0.502, 0.2385, 0.3021, 0.2868, 0.4916, 0.4319, 0.3809, 0.5721, 0.5966, 0.5011, 0.3927, 0.4665, 0.2886, 0.3685, 0.5782, 0.3238, 0.5478, 0.5269, 0.586, 0.5733, 0.2728, 0.3786, 0.4769, 0.3222, 0.4413, 0.5303, 0.3714, 0.2271, 0.2497, 0.3017, 0.2931, 0.5135, 0.5524, 0.4881, 0.421, 0.2458, 0.578, 0.4666, 0.4202, 0.3953, 0.503, 0.5267, 0.2678, 0.4927, 0.4254, 0.43, 0.464, 0.3155, 0.5407, 0.2831, 0.5788, 0.4408, 0.2651, 0.207, 0.3673, 0.4399, 0.3363, 0.4413, 0.2328, 0.5657, 0.5174, 0.5742, 0.303, 0.2214, 0.3322, 0.4915, 0.5872, 0.3729, 0.534, 0.302, 0.4608, 0.3782, 0.5692, 0.3543, 0.5745, 0.2288, 0.4576, 0.3112, 0.2624, 0.4845, 0.4004, 0.2037, 0.3675, 0.5938, 0.5303, 0.2844, 0.5689, 0.3644, 0.2933, 0.4392, 0.4891, 0.3409, 0.512, 0.4941, 0.3943, 0.2368, 0.2758
-    ]
-    widths = [
-        1.9891, 1.3488, 2.1147, 1.3697, 1.2419, 1.6457, 2.3897, 2.0031, 1.4682, 2.8847, 1.2741, 2.6916, 1.3642, 2.1348, 2.261, 1.0361, 2.2734, 1.8312, 1.5199, 1.2973, 2.4516, 1.2584, 2.4907, 2.0425, 2.9217, 2.1392, 2.2842, 2.8505, 2.8994, 2.4906, 2.7219, 2.5333, 2.8981, 2.2621, 1.6825, 1.03, 2.6026, 2.0429, 2.1425, 1.3364, 2.1748, 2.273, 2.2498, 2.7394, 1.4921, 2.7213, 1.9248, 2.4806, 2.4288, 1.1902, 2.0032, 2.0762, 2.3173, 2.8992, 1.3325, 1.617, 1.8698, 1.9849, 2.7794, 2.3283, 1.5949, 1.0415, 2.7668, 2.5422, 2.8227, 2.9594, 1.2154, 2.2046, 2.3792, 1.059, 2.7216, 1.9585, 2.9857, 1.6533, 1.6539, 1.8015, 2.5788, 2.1265, 2.9703, 2.1948, 1.0069, 2.1693, 2.268, 2.834, 2.6399, 1.703, 1.4684, 1.2666, 2.7072, 2.3955, 2.0649, 1.6169, 1.7616, 2.4623, 1.1419, 1.886, 1.0806, 2.1522, 1.9039, 2.6044
-    ]
-    heights = [
-        6.2659, 6.3036, 6.3481, 4.3313, 4.1753, 3.0561, 6.6123, 4.0224, 4.5811, 4.5975, 3.1208, 4.4046, 3.5354, 4.0431, 4.7386, 5.0944, 6.163, 3.463, 3.2967, 4.8988, 5.0663, 4.708, 4.639, 6.8063, 5.9601, 5.143, 3.7997, 5.7029, 3.413, 6.0307, 3.496, 3.8878, 3.7186, 3.9521, 4.5175, 6.2592, 6.7384, 3.6114, 3.839, 4.5583, 6.8676, 6.3397, 4.6526, 4.8305, 5.1816, 3.1288, 6.0267, 3.6738, 4.3365, 6.044, 6.8462, 3.5802, 6.1543, 4.2312, 5.8795, 6.0729, 5.8318, 3.1886, 6.1382, 6.4638, 5.4616, 5.6234, 4.0931, 6.8213, 6.6032, 5.3229, 4.8614, 5.0598, 6.4951, 3.1684, 3.6898, 6.6193, 3.6253, 3.957, 5.922, 4.6214, 3.8991, 5.6486, 4.226, 3.7339, 3.0256, 5.4456, 6.5385, 5.5673, 6.8313, 5.7355, 6.4646, 5.5248, 3.4053, 3.1692, 6.7875, 3.0783, 6.6489, 3.7603, 3.4659, 3.1114, 5.0647, 6.5091, 4.9005, 5.92]
-    heightOffs = [
-        2.6227, 2.2296, 3.1824, 3.854, 3.473, 2.1252, 3.825, 3.8578, 2.9844, 3.3008, 2.8587, 3.0345, 2.862, 2.8008, 2.9165, 2.8226, 3.9926, 2.3404, 2.8017, 2.5277, 3.6926, 2.9002, 3.6295, 3.7614, 3.8201, 2.7946, 3.5615, 3.1171, 2.1724, 3.578, 3.0054, 3.9159, 2.4113, 3.0343, 2.8536, 3.6162, 2.3425, 2.8684, 3.6846, 3.5548, 3.1618, 2.7397, 2.2654, 3.1135, 2.5208, 3.1068, 2.2282, 3.8556, 3.8085, 2.8059, 3.2935, 2.9386, 3.9659, 3.2135, 2.9232, 3.6583, 2.1916, 2.6217, 3.6022, 2.9316, 2.7195, 3.9453, 3.7837, 2.2206, 3.3416, 3.6073, 2.572, 2.8307, 2.9367, 3.6212, 3.1896, 2.3914, 2.9865, 3.6828, 2.3181, 3.3232, 2.97, 2.6381, 2.317, 2.0614, 3.0902, 2.3088, 3.7334, 2.1661, 3.6971, 3.669, 3.402, 3.49, 2.8597, 2.3312, 2.0631, 2.0245, 2.4132, 2.8019, 2.5189, 2.355, 2.854, 2.1607, 2.9309, 3.4644
-    ]
-    def draw_tree(heightOffGround, height, trunkWidth, width, positionX, positionY, green):
-        glPushMatrix()
-        glTranslatef(0, 1.5, 0)
-        glRotatef(-90, 1, 0, 0)
-        glTranslatef(positionX, positionY, heightOffGround-2)
-        glColor3f(0, green, 0)
-        quadric = gluNewQuadric()
-        gluCylinder(quadric, width, 0.1, height, 15, 1)
-
-        glTranslatef(0, 0, -heightOffGround)
-        glColor3f(0.6, 0.3, 0)
-        quadric = gluNewQuadric()
-        gluCylinder(quadric, trunkWidth, trunkWidth, heightOffGround, 5, 1)
-        glPopMatrix()
-    for i in range(100):
-        draw_tree(heightOffs[i], heights[i], trunks[i], widths[i], positionsX[i], positionsY[i], greens[i])
+    @staticmethod
+    def load(path):
+        """Reads a tree table from a .npy file saved from a tree_dtype array, or from a csv file with a header naming its columns."""
+        if path.endswith(".npy"):
+            return Forest(np.load(path).astype(tree_dtype))
+        table = np.genfromtxt(path, delimiter=',', names=True)
+        trees = np.zeros(len(table), tree_dtype)
+        trees["position"] = np.stack([table["x"], table["y"], table["z"]], 1)
+        for field in tree_dtype.names[1:]:
+            trees[field] = table[field]
+        return Forest(trees)
+
+    @staticmethod
+    def generate(count, seed=0):
+        """Random trees spread over the same area and with the same proportions as the trees of the default forest."""
+        random = np.random.default_rng(seed)
+        trees = np.zeros(count, tree_dtype)
+        trees["position"][:, 0] = random.uniform(-100, 100, count)
+        trees["position"][:, 1] = -0.5
+        trees["position"][:, 2] = random.uniform(20, 130, count)
+        trees["trunk_radius"] = random.uniform(0.2, 0.6, count)
+        trees["trunk_height"] = random.uniform(2, 4, count)
+        trees["canopy_radius"] = random.uniform(1, 3, count)
+        trees["canopy_height"] = random.uniform(3, 7, count)
+        trees["green"] = random.uniform(0.6, 0.8, count)
+        return Forest(trees)
+
+    def instances(self):
+        """Per-instance (bottom center, height, bottom radius, top radius, color) of the canopies and of the trunks."""
+        trees = self.trees
+        canopies = np.zeros((len(trees), 9), np.float32)
+        canopies[:, 0:3] = trees["position"]
+        canopies[:, 1] += trees["trunk_height"]
+        canopies[:, 3] = trees["canopy_height"]
+        canopies[:, 4] = trees["canopy_radius"]
+        canopies[:, 5] = self.canopy_top
+        canopies[:, 7] = trees["green"]
+        trunks = np.zeros((len(trees), 9), np.float32)
+        trunks[:, 0:3] = trees["position"]
+        trunks[:, 3] = trees["trunk_height"]
+        trunks[:, 4] = trunks[:, 5] = trees["trunk_radius"]
+        trunks[:, 6:9] = self.trunk_color
+        return canopies, trunks
+
+    def upload(self):
+        if not instancing_supported():
+            self.fallback_dl = glGenLists(1)
+            glNewList(self.fallback_dl, GL_COMPILE)
+            self.draw_fixed_function()
+            glEndList()
+            return
+        self.program = LitProgram(self.vertex_shader, self.fragment_shader)
+        self.buffers = []
+        canopy_slices = [self.canopy_slices, *[slices for _, slices, _ in self.lods]]
+        trunk_slices = [self.trunk_slices, *[slices for _, _, slices in self.lods]]
+        for level_slices, instances in zip((canopy_slices, trunk_slices), self.instances()):
+            meshes = []
+            for slices in level_slices:
+                mesh = cylinder_mesh(slices, 1, 1)
+                vertices = np.ascontiguousarray(mesh.vertex_data[:, 3:6])
+                vbo, ibo = glGenBuffers(2)
+                glBindBuffer(GL_ARRAY_BUFFER, vbo)
+                glBufferData(GL_ARRAY_BUFFER, vertices.nbytes, vertices, GL_STATIC_DRAW)
+                glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, ibo)
+                glBufferData(GL_ELEMENT_ARRAY_BUFFER, mesh.indices.nbytes, mesh.indices, GL_STATIC_DRAW)
+                meshes.append((vbo, ibo, len(mesh.indices)))
+            instance_vbo = glGenBuffers(1)
+            glBindBuffer(GL_ARRAY_BUFFER, instance_vbo)
+            glBufferData(GL_ARRAY_BUFFER, instances.nbytes, instances, GL_STATIC_DRAW)
+            self.buffers.append((meshes, instance_vbo, instances))
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, 0)
+        self.order = np.arange(len(self.trees))
+
+    def draw(self, visible, frustum):
+        """Draws the trees set in the visible mask, one per tree, at the level of detail for their size on screen.
+        Without instancing every tree is drawn in full. Returns the mask of the trees drawn."""
+        if self.fallback_dl is not None:
+            glCallList(self.fallback_dl)
+            return np.ones(len(self.trees), bool)
+        shown = np.flatnonzero(visible)
+        self.levels[shown] = select_levels(self.levels[shown], frustum.screen_sizes(self.lower[shown], self.upper[shown]), [size for size, _, _ in self.lods])
+        order = shown[np.argsort(self.levels[shown], kind='stable')]
+        if not np.array_equal(order, self.order):
+            # Only the visible trees go into the instance buffers, packed at their start with the trees of each level together
+            for _, instance_vbo, instances in self.buffers:
+                glBindBuffer(GL_ARRAY_BUFFER, instance_vbo)
+                glBufferSubData(GL_ARRAY_BUFFER, 0, np.ascontiguousarray(instances[order]))
+            glBindBuffer(GL_ARRAY_BUFFER, 0)
+            self.order = order
+        if len(order) == 0:
+            return visible
+        counts = np.bincount(self.levels[order], minlength=len(self.lods) + 1)
+        program = self.program.use()
+        attributes = [(glGetAttribLocation(program, name), size, offset) for name, size, offset in (("instance_base", 4, 0), ("instance_radii", 2, 16), ("instance_color", 3, 24))]
+        glPushClientAttrib(GL_CLIENT_VERTEX_ARRAY_BIT)
+        glEnableClientState(GL_VERTEX_ARRAY)
+        for location, _, _ in attributes:
+            glEnableVertexAttribArray(location)
+            glVertexAttribDivisor(location, 1)
+        for meshes, instance_vbo, _ in self.buffers:
+            first = 0
+            for (vbo, ibo, index_count), count in zip(meshes, counts):
+                if count:
+                    glBindBuffer(GL_ARRAY_BUFFER, vbo)
+                    glVertexPointer(3, GL_FLOAT, 0, None)
+                    glBindBuffer(GL_ARRAY_BUFFER, instance_vbo)
+                    for location, size, offset in attributes:
+                        glVertexAttribPointer(location, size, GL_FLOAT, GL_FALSE, 36, ctypes.c_void_p(int(first) * 36 + offset))  # The instances of the level start at first
+                    glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, ibo)
+                    glDrawElementsInstanced(GL_TRIANGLES, index_count, GL_UNSIGNED_SHORT, None, int(count))
+                first += count
+        for location, _, _ in attributes:
+            glVertexAttribDivisor(location, 0)
+            glDisableVertexAttribArray(location)
+        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, 0)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+        glPopClientAttrib()
+        glUseProgram(0)
+        return visible
+
+    def draw_fixed_function(self):
+        """Draws every tree with its own transformations, for GL versions without instancing."""
+        for tree in self.trees:
+            glPushMatrix()
+            glTranslatef(*tree["position"])
+            glRotatef(-90, 1, 0, 0)
+            glColor3f(*self.trunk_color)
+            cached_cylinder(tree["trunk_radius"], tree["trunk_radius"], tree["trunk_height"], self.trunk_slices, 1)
+            glTranslatef(0, 0, tree["trunk_height"])
+            glColor3f(0, tree["green"], 0)
+            cached_cylinder(tree["canopy_radius"], self.canopy_top, tree["canopy_height"], self.canopy_slices, 1)
+            glPopMatrix()
 
 def draw_cylinder(radius, segments, height, offset=0):
     
@@ -1230,6 +2563,22 @@ def draw_dome(radius, segments, rings, offset, height_scale=0.5):
             glVertex3f(x2, y2 + offset, z2)
         glEnd()        
 
+coliseum_position = [-55, 0, -15]  # [x, y, z] coordinates for the coliseum
+coliseum_bounds = ((-86, 0, -46), (-24, 40, 16))  # Walls stick out 1 past the radius of 30, dome reaches 25 + 30 * 0.5
+
+# (size on screen in pixels below which it is used, segments, dome rings) of the simpler levels of detail. Each is
+# used once its circles would be less than about a pixel away from the circles of the level before
+coliseum_lods = [(120, 24, 10), (30, 12, 5)]
+
+def draw_coliseum(segments=50, rings=20):
+    glPushMatrix()
+    glTranslatef(*coliseum_position)  # Move the coliseum to its specified position
+    # Draw the coliseum components
+    draw_cylinder(30, segments, 25, offset=0)
+    draw_coliseum_walls(30, segments, 25)
+    draw_dome(30, segments, rings, offset=25)
+    glPopMatrix()
+
 def init_opengl():
     """Initializes OpenGL settings and projection matrix."""
     glEnable(GL_DEPTH_TEST)  # Enable depth testing for 3D rendering
@@ -1268,6 +2617,7 @@ def draw_ground():
 def draw_dotted_line_straight():
     """Draws a dotted yellow line down the straight road."""
     glEnable(GL_POLYGON_OFFSET_FILL)  # Prevents Z-fighting
+    glPolygonOffset(-1.0, -1.0)  # Set by the tunnel before, which may now be culled
     glColor3f(1.0, 1.0, 0.0)  # Yellow color for the line
 
     # Line parameters
@@ -1299,6 +2649,7 @@ def draw_dotted_line_straight():
 def draw_dotted_line_diagonal():
     """Draws a dotted yellow line down the diagonal road."""
     glEnable(GL_POLYGON_OFFSET_FILL)  # Prevents Z-fighting
+    glPolygonOffset(-1.0, -1.0)  # Set by the tunnel before, which may now be culled
     glColor3f(1.0, 1.0, 0.0)  # Yellow color for the line
 
     # Line parameters
@@ -1514,12 +2865,13 @@ def draw_water():
     glEnd()
     glDisable(GL_TEXTURE_2D)  # Disable textures for subsequent objects
 
-def draw_pyramid(base_size, height, position, color):
-    """Helper function to draw a mountain/pyramid with a snowy peak."""
+def draw_pyramid(base_size, height, position, color, base=True):
+    """Helper function to draw a mountain/pyramid with a snowy peak. The base can only be seen from below the ground."""
     x, y, z = position
     half_base = base_size / 2
     peak_color = (1.0, 1.0, 1.0)  # White color for snowy peak
 
+    glNormal3f(0, 1, 0)  # Lit like the ground, as when they were drawn right after the water
     glBegin(GL_TRIANGLES)
 
     # Front face
@@ -1551,6 +2903,8 @@ def draw_pyramid(base_size, height, position, color):
     glVertex3f(x, y + height, z)
     glEnd()
 
+    if not base:
+        return
     # Base of pyramid
     glColor3f(color[0] * 0.7, color[1] * 0.7, color[2] * 0.7)  # Slightly darker color
     glBegin(GL_QUADS)
@@ -1560,10 +2914,70 @@ def draw_pyramid(base_size, height, position, color):
     glVertex3f(x - half_base, y, z + half_base)
     glEnd()
 
-class Car:
-    pos = [0, 0, 0]
-    def __init__(self, start_position):
-        self.pos = start_position
+traffic_capacity = 256 # Most cars on the road at once. Cars added while the road is full are dropped
+
+def car_frame():
+    """Turns the car model to drive along z and scales it to the road."""
+    glTranslatef(-3.5, 0, 0)
+    glRotate(-90, 0, 1, 0)
+    glScalef(1.75, 1.75, 1.75)
+
+class Traffic:
+    """Cars driving down the road. Each car is a slot of fixed size arrays, and the slots of the cars that left the
+    road go on a free list to be reused by the next cars, so the cars are moved with array math and drawn with one
+    instanced draw."""
+    start = (0, 0, -50) # Where cars enter the road
+    speed = 10
+    end = 150 # Cars leave the road once their z is past this
+
+    def __init__(self, capacity):
+        self.positions = np.zeros((capacity, 3), np.float32)
+        self.previous = np.zeros((capacity, 3), np.float32) # Positions at the tick before the last one
+        self.shown = np.zeros((capacity, 3), np.float32) # Positions the cars are drawn at, between previous and positions
+        self.velocities = np.zeros((capacity, 3), np.float32)
+        self.alive = np.zeros(capacity, bool)
+        self.handles = np.full(capacity, -1) # Of the box of each car in the SpatialGrid of the scene, -1 until the car model is loaded
+        self.free = list(range(capacity - 1, -1, -1)) # Slots without a car, the lowest last so it is used first
+        self.model = None
+        self.frame = None # car_frame as a matrix
+
+    def spawn(self):
+        """Puts a car at the start of the road and returns its slot, or None when every slot is taken."""
+        if not self.free:
+            return None
+        slot = self.free.pop()
+        self.positions[slot] = self.previous[slot] = self.shown[slot] = self.start
+        self.velocities[slot] = (0, 0, self.speed)
+        self.alive[slot] = True
+        return slot
+
+    def step(self, delta):
+        """Moves every car along and frees the slots of the cars past the end of the road. Returns those slots."""
+        self.previous[:] = self.positions
+        self.positions[self.alive] += self.velocities[self.alive] * delta
+        gone = np.flatnonzero(self.alive & (self.positions[:, 2] > self.end))
+        self.alive[gone] = False
+        self.free.extend(gone[::-1].tolist())
+        return gone
+
+    def interpolate(self, alpha):
+        """Shows the cars alpha of the way from where they were at the tick before the last one to where they are."""
+        self.shown = self.previous + (self.positions - self.previous) * alpha
+
+    def set_model(self, model):
+        """Draws model in car_frame at every car from now on."""
+        self.model = model
+        glPushMatrix()
+        glLoadIdentity()
+        car_frame()
+        self.frame = glGetFloatv(GL_MODELVIEW_MATRIX)
+        glPopMatrix()
+
+    def draw(self, slots):
+        """Draws the cars in the given slots."""
+        transforms = np.tile(self.frame, (len(slots), 1, 1))
+        transforms[:, 3, :3] += self.shown[slots] # Moves each car after car_frame
+        draw_model_instanced(self.model, transforms)
 
 class Human:
     started_waving = 0
@@ -1590,28 +3004,27 @@ def draw_human(human, human_body_model, human_arm_model):
     glPushMatrix()
     glTranslate(0, 0, 10)
     glRotate(180, 0, 1, 0)
-    global timeVar
     wave_speed = 4
     glScale(1.75, 1.75, 1.75)
-    if human.is_waving:
-        rot = (timeVar - human.started_waving)
-        if rot > 180:
-            rot = 180
-        glRotate(rot, 0, 1, 0)
-        glPushMatrix()
-        glTranslate(-0.24308, 1.3941, 0)
-        glRotate(math.fabs(math.sin((timeVar - human.started_waving) / 1000 * wave_speed)) * -180, 0, 0, 1)
-        draw_model(human_arm_model)
-        glPopMatrix()
-    else:
-        draw_at(lambda: draw_model(human_arm_model), -0.24308, 1.3941, 0)
-    draw_model(human_body_model)
+    with gl_state.batch():
+        if human.is_waving:
+            rot = (render_time - human.started_waving)
+            if rot > 180:
+                rot = 180
+            glRotate(rot, 0, 1, 0)
+            glPushMatrix()
+            glTranslate(-0.24308, 1.3941, 0)
+            glRotate(math.fabs(math.sin((render_time - human.started_waving) / 1000 * wave_speed)) * -180, 0, 0, 1)
+            draw_model(human_arm_model)
+            glPopMatrix()
+        else:
+            draw_at(lambda: draw_model(human_arm_model), -0.24308, 1.3941, 0)
+        draw_model(human_body_model)
     glPopMatrix()
 
 def draw_garage(door, door_model, scale, position):
-    global timeVar
     if door.is_opening:
-        rot = (timeVar - door.started_opening)
+        rot = (render_time - door.started_opening)
         if rot > 90:
             rot = 90
         glPushMatrix()
@@ -1624,50 +3037,49 @@ def draw_garage(door, door_model, scale, position):
     else:
         draw_house_at([door_model], position, False, scale)
 
-def draw_background():
-    """Draws many pyramids to create a mountain range."""
-    pyramids = [
-        # Main cluster
-        (50, 30, (-20, 0, -100)),
-        (60, 40, (0, 0, -120)),
-        (70, 50, (20, 0, -110)),
-        (40, 25, (-50, 0, -90)),
-        (55, 35, (-10, 0, -130)),
-        (65, 45, (30, 0, -140)),
-        (45, 28, (10, 0, -80)),
-        (50, 30, (50, 0, -100)),
-        (35, 22, (-35, 0, -120)),
-
-        # Left cluster
-        (40, 26, (-70, 0, -100)),
-        (50, 35, (-90, 0, -120)),
-        (60, 40, (-110, 0, -110)),
-        (45, 30, (-130, 0, -100)),
-        (55, 38, (-150, 0, -130)),
-        (50, 35, (-170, 0, -110)),
-
-        # Right cluster
-        (40, 26, (70, 0, -100)),
-        (50, 35, (90, 0, -120)),
-        (60, 40, (110, 0, -110)),
-        (45, 30, (130, 0, -100)),
-        (55, 38, (150, 0, -130)),
-        (50, 35, (170, 0, -110)),
-    ]
-
-    mountain_color = (0.6, 0.4, 0.2)  # Earthy brown color
-
-    # Draw the pyramids
-    for base_size, height, position in pyramids:
-        draw_pyramid(base_size, height, position, mountain_color)
+# Pyramids of the mountain range behind the scene, as (base size, height, position)
+mountains = [
+    # Main cluster
+    (50, 30, (-20, 0, -100)),
+    (60, 40, (0, 0, -120)),
+    (70, 50, (20, 0, -110)),
+    (40, 25, (-50, 0, -90)),
+    (55, 35, (-10, 0, -130)),
+    (65, 45, (30, 0, -140)),
+    (45, 28, (10, 0, -80)),
+    (50, 30, (50, 0, -100)),
+    (35, 22, (-35, 0, -120)),
+
+    # Left cluster
+    (40, 26, (-70, 0, -100)),
+    (50, 35, (-90, 0, -120)),
+    (60, 40, (-110, 0, -110)),
+    (45, 30, (-130, 0, -100)),
+    (55, 38, (-150, 0, -130)),
+    (50, 35, (-170, 0, -110)),
+
+    # Right cluster
+    (40, 26, (70, 0, -100)),
+    (50, 35, (90, 0, -120)),
+    (60, 40, (110, 0, -110)),
+    (45, 30, (130, 0, -100)),
+    (55, 38, (150, 0, -130)),
+    (50, 35, (170, 0, -110)),
+]
+mountain_color = (0.6, 0.4, 0.2)  # Earthy brown color
+mountain_lod = 150  # Size on screen in pixels below which mountains are drawn without their base
 
 # Initial camera position and rotation
 camera_pos = [0, -15, -75]
 camera_rotation = [10, 0]
+camera_previous_pos = camera_pos.copy() # Where the camera was at the tick before the last one, so frames can be drawn between ticks
+camera_previous_rotation = camera_rotation.copy()
 
 def camera_controls():
-    """Handles keyboard input for camera controls."""
+    """Handles keyboard input for camera controls. Called once a tick."""
     global camera_pos, camera_rotation
+    camera_previous_pos[:] = camera_pos
+    camera_previous_rotation[:] = camera_rotation
     keys = pygame.key.get_pressed()
     if keys[pygame.K_w]: camera_pos[2] += 2  # Move forward along Z-axis
     if keys[pygame.K_s]: camera_pos[2] -= 2  # Move backward along Z-axis
@@ -1678,17 +3090,20 @@ def camera_controls():
     if keys[pygame.K_LEFT]: camera_rotation[1] -= 2  # Yaw left
     if keys[pygame.K_RIGHT]: camera_rotation[1] += 2  # Yaw right
 
-def apply_camera():
-    """Applies camera's position and rotation."""
+def apply_camera(alpha=1):
+    """Applies camera's position and rotation, alpha of the way from where they were at the tick before the last one
+    to where they are."""
+    shown = lambda previous, current: [value * alpha + before * (1 - alpha) for before, value in zip(previous, current)]
+    position, rotation = shown(camera_previous_pos, camera_pos), shown(camera_previous_rotation, camera_rotation)
     glLoadIdentity()
-    glTranslatef(*camera_pos)
-    glRotatef(camera_rotation[0], 1, 0, 0)
-    glRotatef(camera_rotation[1], 0, 1, 0)
+    glTranslatef(*position)
+    glRotatef(rotation[0], 1, 0, 0)
+    glRotatef(rotation[1], 0, 1, 0)
 
 # Initialize global variables for the day/night cycle
 is_day = True           # Indicates whether it's currently day
 transition_in_progress = False  # Indicates if a transition is happening
-transition_start_time = 0       # Time when the transition started
+transition_start_time = 0       # timeVar when the transition started
 transition_duration = 5000      # Duration of the transition in milliseconds (5 seconds)
 
 # Light position variables
@@ -1699,8 +3114,15 @@ current_light_position = day_light_position.copy()
 # Background color
 background_color = [0.53, 0.81, 0.92, 1.0]  # Initial sky color (day)
 
-# Initialize time variable for human animation
+# Simulation clock in milliseconds, advanced by every tick of step_scene. Animations start at this time
 timeVar = 0
+render_time = 0  # timeVar interpolated to between the last two ticks, what the frame is drawn at
+
+# Simulation settings
+simulation_rate = 60  # Ticks per second. The simulation advances in ticks of this fixed length whatever the frame rate
+simulation_max_lag = 0.25  # Most seconds of simulation run to catch up after a slow frame. Beyond it the simulation slows down instead
+vsync = True  # Wait for the vertical blank to swap buffers, when the driver allows it
+frame_cap = 0  # Most frames drawn per second, 0 for no limit other than vsync
 
 def lerp(start, end, t):
     """Linear interpolation between start and end by t."""
@@ -1711,8 +3133,7 @@ def update_day_night_cycle():
     global transition_in_progress, transition_start_time, current_light_position, background_color
 
     if transition_in_progress:
-        current_time = pygame.time.get_ticks()
-        elapsed = current_time - transition_start_time
+        elapsed = render_time - transition_start_time
         t = min(elapsed / transition_duration, 1.0)  # Normalized time [0.0, 1.0]
 
         if is_day:
@@ -1758,38 +3179,83 @@ def update_day_night_cycle():
         glClearColor(*background_color)
 
 
-def main():
-    global timeVar
-    global is_day, transition_in_progress, transition_start_time, current_light_position, background_color, lightDelta, lightOn
-    lightOn = False
-    lightDelta = 0
-    pygame.init()
-    display = (1920, 1080)
-    pygame.display.set_mode(display, DOUBLEBUF | OPENGL)
-    init_opengl()
-    glEnable(GL_LIGHT0)
-    # We will set the light position in the main loop after applying camera transformations
-
-    global ground_texture_id
-    ground_texture_id = load_texture('snow.jpg')  # Load the ground texture
-
-    global water_texture_id
-    water_texture_id = load_texture('river.jpg')  # Load the water texture
+# Street lights fade on at night and off during the day
+street_lights = [(10, 50, 46), (10, 50, 49), (31, 50, 28), (28, 50, 28), (-21, 50, 65), (-18, 50, 65)]  # Spot lights shining down on the houses, GL_LIGHT1 on
+lightOn = False
+lightDelta = 0
+
+def update_street_lights(delta):
+    """Switches the street lights a few seconds after the day/night cycle changes."""
+    global lightOn, lightDelta
+    if(is_day and lightOn and lightDelta < 4 or not is_day and not lightOn and lightDelta < 4):
+        lightDelta += delta
+    elif(lightDelta > 4):
+        lightOn = not lightOn
+        lightDelta = 0
+
+def setup_lights():
+    """Places the lights after the camera transformations and turns the street lights on or off. Positions and spot
+    directions are set every frame since the camera moves, the rest only once through gl_state. With per pixel
+    lighting the shaders take the street lights from light_list instead, but they stay on for the pods and the
+    coliseum, which are still lit by the fixed function pipeline."""
+    glLightfv(GL_LIGHT0, GL_POSITION, current_light_position)
+
+    for i, position in enumerate(street_lights):
+        light = GL_LIGHT1 + i
+        glLightfv(light, GL_POSITION, [*position, 1.0])
+        glLightfv(light, GL_SPOT_DIRECTION, [0.0, -1.0, 0.0])
+        gl_state.light(light, GL_SPOT_CUTOFF, 40.0)
+        gl_state.light(light, GL_SPOT_EXPONENT, 80)
+        gl_state.light(light, GL_DIFFUSE, [1.0, 1.0, 1.0, 1.0])
+        gl_state.light(light, GL_SPECULAR, [1.0, 1.0, 1.0, 1.0])
+        if lightOn:
+            gl_state.enable(light)
+        else:
+            gl_state.disable(light)
 
-    coliseum_position = [-55, 0, -15]  # [x, y, z] coordinates for the coliseum
+    if light_list is not None:
+        light_list.place(glGetFloatv(GL_MODELVIEW_MATRIX), lightOn)
 
-    # PRT position variables
-    previousTime = time.time()
-    delta = 0
-    global position
-    position = 0
-    speed = 0
-    maxSpeed = 4.5
-    minSpeed = 0
-    acceleration = 1.5
-    global position2
-    position2 = 3
-    speed2 = 0
+@dataclass
+class Scene:
+    assets : AssetRegistry
+    acquired : list # (obj file, texture file) of each model acquired from assets, with None as obj file for lone textures
+    drawables : List[Drawable] # Procedural part of the scene, drawn from the first frame on
+    guideway : Drawable
+    forest : Forest
+    pending_models : list # (name, model Futures, draw function taking the models) of the static models not yet recorded into models
+    models : List[Drawable] # Houses, garage and parked car. Each is recorded once all of its models are loaded
+    car_model : Future
+    human_body_model : Future
+    human_arm_model : Future
+    garage_model : Future
+    human : Human
+    garage : GarageDoor
+    traffic : Traffic
+    fleet : PrtFleet
+    grid : SpatialGrid # Boxes of everything drawn, for culling and queries
+    pod_handles : np.ndarray
+    queue : RenderQueue # Of the models of the frame
+    car_bounds : tuple = None # (lower, upper) of the box around a car at the origin, moved to every car
+    human_handle : int = None # Of the box around the human in its current pose, once its models are loaded
+    garage_door_handle : int = None
+
+model_lods = [(50, 0.01), (17, 0.03)] # (size on screen in pixels below which it is used, grid cell size as a fraction of the size of the model) of the simpler levels of detail of the models. Cells are about a pixel wide when they are used
+decimated_models = {} # Simplified copies of the models, by the buffer and texture of the model and the fraction
+
+def decimated(model, fraction):
+    """Copy of model simplified on a grid whose cells are fraction of its size, in the GPU. Models shared between
+    objects are only simplified once, so their copies can still be drawn together."""
+    key = (model.vbo, model.texture_id, fraction)
+    if key not in decimated_models:
+        lower, upper = model.bounds()
+        decimated_models[key] = model.decimate(fraction * np.linalg.norm(upper - lower))
+        decimated_models[key].send_geometry()
+    return decimated_models[key]
+
+def load_scene():
+    """Starts loading every asset in the background and compiles the procedural part of the scene. Needs a current GL context."""
+    global ground_texture_id, water_texture_id, light_list
 
     # Initialize default material properties
     Model.default_material.specular_reflection = glGetMaterialfv(GL_FRONT, GL_SPECULAR)
@@ -1798,224 +3264,713 @@ def main():
     Model.default_material.specular_exponent = glGetMaterialfv(GL_FRONT, GL_SHININESS)
     Model.default_material.emissive_material = glGetMaterialfv(GL_FRONT, GL_EMISSION)
 
-    # Human, garage, and car state
-    human = Human()
-    cars : List[Car] = []
-    garage = GarageDoor()
-
-    # Load Models
-    houseObjects = [[Model.load("Resources/furniture.obj", "Resources/brown.png"), Model.load("Resources/doors.obj", "Resources/door.png"), Model.load("Resources/walls.obj", x[0]), Model.load("Resources/roof.obj", x[1])] for x in [("Resources/brick.png", "Resources/roof.png"), ("Resources/brick1.png", "Resources/roof1.png"), ("Resources/brick2.png", "Resources/roof2.png")]]
-    for lists in houseObjects:
-        for models in lists:
-            models.send_texture(1024)
-            models.unbind_texture()
-    garageObjects = [Model.load("Resources/gfurn.obj", "Resources/brown.png"), Model.load("Resources/gdoor.obj", "Resources/door.png"), Model.load("Resources/gwall.obj", "Resources/roof.png"), Model.load("Resources/groof.obj", "Resources/brown.png")]
-    for models in garageObjects:
-        models.send_texture(1024)
-        models.unbind_texture()
-    car_model = Model.load("Resources/car.obj", "Resources/Car.png")
-    car_model.send_texture(1024)
-    car_model.unbind_texture()
-    car_dl = glGenLists(1)
-    glNewList(car_dl, GL_COMPILE)
-    glPushMatrix()
-    glTranslatef(-3.5, 0, 0)
-    glRotate(-90, 0, 1, 0)
-    glScalef(1.75, 1.75, 1.75)
-    draw_model(car_model)
-    glPopMatrix()
-    glEndList()
-    human_body_model = Model.load("Resources/humanbody.obj", "Resources/Human.png")
-    human_body_model.send_texture(1024)
-    human_body_model.unbind_texture()
-    human_arm_model = Model.load("Resources/humanarm.obj", "Resources/Human.png")
-    human_arm_model.send_texture(1024)
-    human_arm_model.unbind_texture()
-    garage_model = Model.load("Resources/garage.obj", "Resources/door.png")
-    garage_model.send_texture(1024)
-    garage_model.unbind_texture()
-
-    scene_dl = glGenLists(1)
-    glNewList(scene_dl, GL_COMPILE)
-    draw_tunnel()
-    draw_ground()
-    draw_road()
-    draw_water()
-    draw_background()
-    draw_trees()
-    draw_house_at(houseObjects[0], (-25,0,-15), False, (.5,.5,.5))
-    draw_house_at(houseObjects[1], (-25,0,65), False, (.5,.5,.5))
-    draw_house_at(houseObjects[2], (31,0,20), True, (.6,.6,.6))
-    draw_house_at(garageObjects, (-26, -1, 40), False, (.7, .7, .7))
-    draw_at(lambda: draw_model(car_model), -15, -1, 29)
-    glPushMatrix()
-    glTranslatef(*coliseum_position)  # Move the coliseum to its specified position
-    # Draw the coliseum components
-    draw_cylinder(30, 50, 25, offset=0)
-    draw_coliseum_walls(30, 50, 25)
-    draw_dome(30, 50, 20, offset=25)
-    glPopMatrix()
-    glEndList()
+    # Assets are parsed and decoded in the background and sent to the GPU a few at a time between frames
+    assets = AssetRegistry()
+    acquired = [] # (obj file or None, texture file) of everything acquired, for unload_scene to release
+    def acquire_model(obj_file, texture_file=None):
+        acquired.append((obj_file, texture_file))
+        return assets.acquire_model(obj_file, texture_file)
+    def acquire_texture(texture_file):
+        acquired.append((None, texture_file))
+        return assets.acquire_texture(texture_file)
+    ground_texture_id = acquire_texture('snow.jpg')  # Load the ground texture
+    water_texture_id = acquire_texture('river.jpg')  # Load the water texture
+
+    # The procedural part of the scene does not need any model, so it is drawn from the first frame on.
+    # Each part is its own display list so the parts the camera does not see can be skipped
+    diagonal_end = 150 * math.cos(math.radians(30)) + 3  # Far end of the diagonal road, plus half its width
+    drawables = [
+        Drawable.compile("tunnel", draw_tunnel, ((-6, 0, -90), (6, 15, -50)), textured=False),
+        Drawable.compile("ground", draw_ground, ((-150, -0.5, -150), (150, -0.5, 150)), textured=True),
+        Drawable.compile("road", draw_road, ((-6, 0.01, -150), (diagonal_end, 0.05, 150)), textured=False),
+        Drawable.compile("water", draw_water, ((-120, 0.01, -150), (-100, 0.01, 150)), textured=True),
+        *[Drawable.compile("mountain", lambda: draw_pyramid(base_size, height, position, mountain_color),
+                           (np.add(position, (-base_size / 2, 0, -base_size / 2)), np.add(position, (base_size / 2, height, base_size / 2))),
+                           [(mountain_lod, lambda: draw_pyramid(base_size, height, position, mountain_color, False))], textured=False)
+          for base_size, height, position in mountains],
+        Drawable.compile("coliseum", draw_coliseum, coliseum_bounds, # Switches lighting off for its walls, so it stays on fixed function lighting
+                         [(size, lambda segments=segments, rings=rings: draw_coliseum(segments, rings)) for size, segments, rings in coliseum_lods]),
+    ]
+
+    # The guideway never moves, only the pods on it are drawn every frame
+    guideway = compile_guideway()
+    if per_pixel_lighting:
+        light_list = build_light_list()
+
+    forest = Forest.generate(forest_trees, forest_seed) if forest_trees is not None else Forest.load(forest_file)
+    forest.upload()
+
+    grid = SpatialGrid()
+    for drawable in [*drawables, guideway]:
+        drawable.handle = grid.insert(drawable.lower, drawable.upper, drawable.name)
+    forest.handles = grid.insert_many(forest.lower, forest.upper, itertools.repeat("tree"))
+    fleet = PrtFleet(prt_routes, prt_pods)
+
+    # Load Models. Each of these is a Future that is resolved once the model is ready to draw
+    house_models = [[acquire_model("Resources/furniture.obj", "Resources/brown.png"), acquire_model("Resources/doors.obj", "Resources/door.png"), acquire_model("Resources/walls.obj", x[0]), acquire_model("Resources/roof.obj", x[1])] for x in [("Resources/brick.png", "Resources/roof.png"), ("Resources/brick1.png", "Resources/roof1.png"), ("Resources/brick2.png", "Resources/roof2.png")]]
+    garage_models = [acquire_model("Resources/gfurn.obj", "Resources/brown.png"), acquire_model("Resources/gdoor.obj", "Resources/door.png"), acquire_model("Resources/gwall.obj", "Resources/roof.png"), acquire_model("Resources/groof.obj", "Resources/brown.png")]
+    car_model = acquire_model("Resources/car.obj", "Resources/Car.png")
+    return Scene(
+        assets=assets,
+        acquired=acquired,
+        drawables=drawables,
+        guideway=guideway,
+        forest=forest,
+        pending_models=[
+            ("house", house_models[0], lambda models: draw_house_at(models, (-25,0,-15), False, (.5,.5,.5))),
+            ("house", house_models[1], lambda models: draw_house_at(models, (-25,0,65), False, (.5,.5,.5))),
+            ("house", house_models[2], lambda models: draw_house_at(models, (31,0,20), True, (.6,.6,.6))),
+            ("garage", garage_models, lambda models: draw_house_at(models, (-26, -1, 40), False, (.7, .7, .7))),
+            ("parked car", [car_model], lambda models: draw_at(lambda: draw_model(models[0]), -15, -1, 29)),
+        ],
+        models=[],
+        car_model=car_model,
+        human_body_model=acquire_model("Resources/humanbody.obj", "Resources/Human.png"),
+        human_arm_model=acquire_model("Resources/humanarm.obj", "Resources/Human.png"),
+        garage_model=acquire_model("Resources/garage.obj", "Resources/door.png"),
+        human=Human(),
+        garage=GarageDoor(),
+        traffic=Traffic(traffic_capacity),
+        fleet=fleet,
+        grid=grid,
+        queue=RenderQueue(),
+        pod_handles=grid.insert_many(*prt_pod_boxes(fleet), itertools.repeat("pod")))
+
+def unload_scene(scene):
+    """Releases every asset load_scene acquired, which removes them from the GPU. Needs the GL context of load_scene."""
+    scene.assets.finish()  # Released assets are deleted once they are uploaded, which only happens on this thread
+    for obj_file, texture_file in scene.acquired:
+        if obj_file is None:
+            scene.assets.release_texture(texture_file)
+        else:
+            scene.assets.release_model(obj_file, texture_file)
+    scene.acquired = []
+    scene.assets.executor.shutdown()
+
+def compile_loaded_models(scene):
+    """Records the static models as soon as all of their models are loaded, and measures the animated ones."""
+    for pending in list(scene.pending_models):
+        name, futures, draw = pending
+        if all(future.done() for future in futures):
+            models = [future.result() for future in futures]
+            drawable = Drawable.record(name, lambda: draw(models), lods=[(size, lambda fraction=fraction: draw([decimated(model, fraction) for model in models])) for size, fraction in model_lods])
+            drawable.handle = scene.grid.insert(drawable.lower, drawable.upper, name)
+            scene.models.append(drawable)
+            scene.pending_models.remove(pending)
+
+    if scene.car_bounds is None and scene.car_model.done():
+        scene.traffic.set_model(scene.car_model.result())
+        scene.car_bounds = transform_bounds(scene.traffic.frame, *scene.car_model.result().bounds())
+
+    # The human and the garage door move, so their boxes are measured again on every update
+    if scene.human_handle is None and scene.human_body_model.done() and scene.human_arm_model.done():
+        scene.human_handle = scene.grid.insert(*measure_models(lambda: draw_human(scene.human, scene.human_body_model.result(), scene.human_arm_model.result())), "human")
+    if scene.garage_door_handle is None and scene.garage_model.done():
+        scene.garage_door_handle = scene.grid.insert(*measure_models(lambda: draw_garage(scene.garage, scene.garage_model.result(), (.7, .7, .7), (-26, -1, 40))), "garage door")
+
+def step_scene(scene, delta):
+    """Advances the simulation by one tick of delta seconds: the clock, the pods, the cars and the street lights."""
+    global timeVar
+    timeVar += delta * 1000
+    scene.fleet.step(delta)
+    traffic = scene.traffic
+    gone = traffic.step(delta)
+    for handle in traffic.handles[gone]:
+        if handle >= 0:
+            scene.grid.remove(handle)
+    traffic.handles[gone] = -1
+    update_street_lights(delta)
+
+def update_scene(scene, alpha):
+    """Shows everything that moves alpha of the way from the tick before the last one to the last one, and moves
+    their boxes in the spatial grid to match."""
+    global render_time
+    render_time = timeVar - (1 - alpha) * 1000 / simulation_rate
+    scene.fleet.interpolate(alpha)
+    scene.traffic.interpolate(alpha)
+    scene.grid.move_many(scene.pod_handles, *prt_pod_boxes(scene.fleet))
+    if scene.human_handle is not None:
+        scene.grid.move(scene.human_handle, *measure_models(lambda: draw_human(scene.human, scene.human_body_model.result(), scene.human_arm_model.result())))
+    if scene.garage_door_handle is not None:
+        scene.grid.move(scene.garage_door_handle, *measure_models(lambda: draw_garage(scene.garage, scene.garage_model.result(), (.7, .7, .7), (-26, -1, 40))))
+    if scene.car_bounds is None:
+        return
+    traffic = scene.traffic
+    cars = np.flatnonzero(traffic.alive)
+    placed, added = cars[traffic.handles[cars] >= 0], cars[traffic.handles[cars] < 0]
+    lower, upper = scene.car_bounds
+    scene.grid.move_many(traffic.handles[placed], traffic.shown[placed] + lower, traffic.shown[placed] + upper)
+    traffic.handles[added] = scene.grid.insert_many(traffic.shown[added] + lower, traffic.shown[added] + upper, itertools.repeat("car"))
+
+def pick(scene, x, y):
+    """What the nearest object under the window pixel x, y, counted from the top left, was inserted into the grid
+    with, or None. Uses the matrices of the last frame."""
+    viewport = glGetIntegerv(GL_VIEWPORT)
+    modelview = glGetDoublev(GL_MODELVIEW_MATRIX)
+    projection = glGetDoublev(GL_PROJECTION_MATRIX)
+    near = np.array(gluUnProject(x, viewport[3] - y, 0, modelview, projection, viewport))
+    far = np.array(gluUnProject(x, viewport[3] - y, 1, modelview, projection, viewport))
+    hit = scene.grid.raycast(near, far - near)
+    return None if hit is None else scene.grid.items[hit[0]]
+
+def draw_scene(scene, profiler):
+    """Draws the parts of the scene the camera can see."""
+    frustum = Frustum()
+    with profiler.phase("cull"):
+        visible = scene.grid.query_frustum(frustum)
+    with profiler.phase("prt"):
+        profiler.count_visible("objects", draw_visible([scene.guideway], visible, frustum))
+        pods = visible[scene.pod_handles]
+        draw_prt(scene.fleet, pods)
+        profiler.count_visible("pods", pods)
+    with profiler.phase("scene"):
+        profiler.count_visible("objects", draw_visible(scene.drawables, visible, frustum))
+    with profiler.phase("forest"):
+        trees = scene.forest.draw(visible[scene.forest.handles], frustum)
+        profiler.count_visible("trees", trees)
+        profiler.count("trees simplified", int(np.count_nonzero(scene.forest.levels[trees])))
+    with profiler.phase("models"):
+        # Houses, garage, parked car, human and garage door are drawn together so they share their textures and materials
+        profiler.count_visible("objects", queue_visible(scene.models, visible, frustum, scene.queue))
+        profiler.count("objects simplified", sum(drawable.level > 0 for drawable in [*scene.drawables, *scene.models] if visible[drawable.handle]))
+        if scene.human_handle is not None:
+            if visible[scene.human_handle]:
+                scene.queue.submit(record_models(lambda: draw_human(scene.human, scene.human_body_model.result(), scene.human_arm_model.result())))
+            profiler.count_visible("objects", visible[[scene.human_handle]])
+        if scene.garage_door_handle is not None:
+            if visible[scene.garage_door_handle]:
+                scene.queue.submit(record_models(lambda: draw_garage(scene.garage, scene.garage_model.result(), (.7, .7, .7), (-26, -1, 40))))
+            profiler.count_visible("objects", visible[[scene.garage_door_handle]])
+        glColor3f(0.6, 0.3, 0)  # Textures are modulated by the current color. Keep the tint the models had when they were drawn right after the tree trunks
+        calls, changes = scene.queue.draw(frustum.eye)
+        profiler.count("model draw calls", calls)
+        profiler.count("model state changes", changes)
+    with profiler.phase("cars"):
+        if scene.car_bounds is not None:
+            placed = np.flatnonzero(scene.traffic.handles >= 0)  # Cars added since the last update are not in the grid yet
+            cars = visible[scene.traffic.handles[placed]]
+            scene.traffic.draw(placed[cars])
+            profiler.count_visible("cars", cars)
+
+# Profiler settings
+profiler_overlay = False  # Show the per-phase frame times on screen. F3 toggles it
+trace_file = None  # Chrome trace (chrome://tracing, Perfetto) of the recent frames written on exit. None writes nothing
+gl_call_count = 0  # GL calls made so far. Only counted once count_gl_calls has been called
+
+def count_gl_calls():
+    """Wraps every GL and GLU function this module calls so the profiler can count the calls made in each phase.
+    Functions the driver does not have are left as they are, so the probes testing them for truth still see them
+    as missing."""
+    def counted(function):
+        def call(*args, **kwargs):
+            global gl_call_count
+            gl_call_count += 1
+            return function(*args, **kwargs)
+        return call
+    module = globals()
+    for name, value in list(module.items()):
+        if re.match(r'glu?[A-Z]', name) and callable(value) and bool(value):
+            module[name] = counted(value)
+
+@dataclass
+class FrameSample:
+    start : float
+    duration : float
+    phases : dict # Seconds spent in each phase
+    gl_calls : dict # GL calls made in each phase
+    events : list # (phase, start, duration) in the order the phases ran
+    counters : dict # Totals counted during the frame, like how many objects were drawn and culled
+
+class FrameProfiler:
+    """Times the phases of each frame and keeps the most recent frames in a ring buffer."""
+    def __init__(self, history=600):
+        self.frames = deque(maxlen=history) # FrameSample of each recent frame, oldest first
+        self.current = FrameSample(time.perf_counter(), 0, {}, {}, [], {})
+
+    @contextmanager
+    def phase(self, name):
+        calls = gl_call_count
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            self.current.phases[name] = self.current.phases.get(name, 0) + duration
+            self.current.gl_calls[name] = self.current.gl_calls.get(name, 0) + gl_call_count - calls
+            self.current.events.append((name, start, duration))
+
+    def count(self, name, value):
+        self.current.counters[name] = self.current.counters.get(name, 0) + value
+
+    def count_visible(self, kind, visible):
+        """Counts how many objects of a kind were drawn and how many were culled, from the mask of the visible ones."""
+        drawn = int(np.count_nonzero(visible))
+        self.count(kind + " drawn", drawn)
+        self.count(kind + " culled", len(visible) - drawn)
+
+    def end_frame(self):
+        now = time.perf_counter()
+        self.current.duration = now - self.current.start
+        self.frames.append(self.current)
+        self.current = FrameSample(now, 0, {}, {}, [], {})
+
+    def summary(self, frames=60):
+        """Average frame time, and average time and GL calls of each phase, over the last few frames."""
+        recent = list(self.frames)[-frames:]
+        phases = {}
+        for sample in recent:
+            for name in sample.phases:
+                time_spent, calls = phases.get(name, (0, 0))
+                phases[name] = (time_spent + sample.phases[name] / len(recent), calls + sample.gl_calls[name] / len(recent))
+        return sum(sample.duration for sample in recent) / max(len(recent), 1), phases
+
+    def counter_summary(self, frames=60):
+        """Average of each counter over the last few frames."""
+        recent = list(self.frames)[-frames:]
+        counters = {}
+        for sample in recent:
+            for name, value in sample.counters.items():
+                counters[name] = counters.get(name, 0) + value / len(recent)
+        return counters
+
+    def save_trace(self, path):
+        """Writes the recent frames as Chrome trace events."""
+        events = []
+        for sample in self.frames:
+            events.append({"name": "frame", "ph": "X", "pid": 0, "tid": 0, "ts": sample.start * 1e6, "dur": sample.duration * 1e6})
+            for name, start, duration in sample.events:
+                events.append({"name": name, "ph": "X", "pid": 0, "tid": 0, "ts": start * 1e6, "dur": duration * 1e6, "args": {"gl_calls": sample.gl_calls[name]}})
+            if sample.counters:
+                events.append({"name": "counters", "ph": "C", "pid": 0, "tid": 0, "ts": sample.start * 1e6, "args": sample.counters})
+        with open(path, "w") as file:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, file)
+
+class ProfilerOverlay:
+    """Draws the profiler summary in the top left corner of the window."""
+    refresh_frames = 15 # Re-rendering the text every frame would show up in the numbers themselves
+
+    def __init__(self):
+        self.font = pygame.font.SysFont("monospace", 16)
+        self.pixels = None
+        self.size = (0, 0)
+        self.age = 0
+        self.picked = None # What the last left click picked, shown under the counters
+
+    def render(self, profiler):
+        frame_time, phases = profiler.summary()
+        lines = [f"frame {frame_time * 1000:7.2f} ms {1 / frame_time if frame_time else 0:6.1f} fps"]
+        lines += [f"{name:<8} {time_spent * 1000:7.2f} ms" + (f" {calls:8.0f} gl" if gl_call_count else "") for name, (time_spent, calls) in phases.items()]
+        lines += [f"{name:<14} {value:8.0f}" for name, value in sorted(profiler.counter_summary().items())]
+        if self.picked is not None:
+            lines.append(f"picked {self.picked}")
+        rendered = [self.font.render(line, True, (255, 255, 255)) for line in lines]
+        surface = pygame.Surface((max(text.get_width() for text in rendered) + 8, sum(text.get_height() for text in rendered) + 8), pygame.SRCALPHA)
+        surface.fill((0, 0, 0, 160))
+        y = 4
+        for text in rendered:
+            surface.blit(text, (4, y))
+            y += text.get_height()
+        self.pixels = pygame.image.tostring(surface, "RGBA", True)
+        self.size = surface.get_size()
+
+    def draw(self, profiler):
+        if self.pixels is None or self.age >= self.refresh_frames:
+            self.render(profiler)
+            self.age = 0
+        self.age += 1
+        glPushAttrib(GL_ENABLE_BIT | GL_COLOR_BUFFER_BIT)
+        glDisable(GL_LIGHTING)
+        glDisable(GL_TEXTURE_2D)
+        glDisable(GL_DEPTH_TEST)
+        glDisable(GL_FOG)
+        glEnable(GL_BLEND)
+        glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
+        glWindowPos2i(10, glGetIntegerv(GL_VIEWPORT)[3] - self.size[1] - 10)
+        glDrawPixels(*self.size, GL_RGBA, GL_UNSIGNED_BYTE, self.pixels)
+        glPopAttrib()
+
+# Dynamic resolution settings
+frame_budget = 1 / 60  # Seconds a frame may take before the scene is drawn at a lower resolution. 0 always draws at the window's resolution
+min_resolution_scale = 0.5  # Lowest fraction of the window's width and height the scene is drawn at
+
+class DynamicResolution:
+    """Draws the scene at a fraction of the window's resolution into a framebuffer and scales it up to the window.
+    The fraction goes down when frames take longer than the budget and back up once they are well under it. A frame
+    takes the longer of its CPU time and the GPU time of its scene, from timestamp queries read once they are ready
+    so they never stall the frame."""
+    step = 0.05 # The scale is a multiple of this, so the framebuffer is not resized for every small change
+    headroom = 0.75 # The scale only goes back up once frames take less than this fraction of the budget
+    settle_frames = 10 # Frames to wait after a change before the next one, so the change shows in the frame times
+
+    def __init__(self, width, height, budget, min_scale, history=600):
+        self.width = width
+        self.height = height
+        self.budget = budget
+        self.min_scale = min_scale
+        self.scale = 1.0
+        self.history = deque(maxlen=history) # (frame time, scale) of each recent frame, oldest first
+        self.supported = bool(glGenFramebuffers) and bool(glBlitFramebuffer)
+        self.timed = bool(glQueryCounter)
+        self.framebuffer = None
+        self.renderbuffers = None # Color and depth
+        self.size = None # Of the renderbuffers
+        self.queries = deque() # Timestamp query pairs around the scenes whose results are not read yet, oldest first
+        self.free_queries = []
+        self.gpu_time = 0 # Of the most recent scene whose queries were read
+        self.wait = 0 # Frames left before the scale may change again
+
+    def scaled_size(self):
+        return max(1, round(self.width * self.scale)), max(1, round(self.height * self.scale))
+
+    def begin(self):
+        """Sends what is drawn next to the framebuffer when the scale is below 1, and to the window otherwise."""
+        if self.timed:
+            self.queries.append(self.free_queries.pop() if self.free_queries else [int(query) for query in glGenQueries(2)])
+            glQueryCounter(self.queries[-1][0], GL_TIMESTAMP)
+        if self.scale == 1:
+            return
+        width, height = self.scaled_size()
+        if self.framebuffer is None:
+            self.framebuffer = glGenFramebuffers(1)
+            self.renderbuffers = glGenRenderbuffers(2)
+        glBindFramebuffer(GL_FRAMEBUFFER, self.framebuffer)
+        if self.size != (width, height):
+            for renderbuffer, format, attachment in zip(self.renderbuffers, (GL_RGBA8, GL_DEPTH_COMPONENT24), (GL_COLOR_ATTACHMENT0, GL_DEPTH_ATTACHMENT)):
+                glBindRenderbuffer(GL_RENDERBUFFER, renderbuffer)
+                glRenderbufferStorage(GL_RENDERBUFFER, format, width, height)
+                glFramebufferRenderbuffer(GL_FRAMEBUFFER, attachment, GL_RENDERBUFFER, renderbuffer)
+            glBindRenderbuffer(GL_RENDERBUFFER, 0)
+            if glCheckFramebufferStatus(GL_FRAMEBUFFER) != GL_FRAMEBUFFER_COMPLETE:
+                raise Exception(f"Could not create a {width}x{height} framebuffer to draw the scene into")
+            self.size = (width, height)
+        glViewport(0, 0, width, height)
+
+    def end(self):
+        """Scales what was drawn since begin up to the window, and draws into the window from then on."""
+        if self.scale != 1:
+            glBindFramebuffer(GL_READ_FRAMEBUFFER, self.framebuffer)
+            glBindFramebuffer(GL_DRAW_FRAMEBUFFER, 0)
+            glBlitFramebuffer(0, 0, *self.scaled_size(), 0, 0, self.width, self.height, GL_COLOR_BUFFER_BIT, GL_LINEAR)
+            glBindFramebuffer(GL_FRAMEBUFFER, 0)
+            glViewport(0, 0, self.width, self.height)
+        if self.timed:
+            glQueryCounter(self.queries[-1][1], GL_TIMESTAMP)
+
+    def read_queries(self):
+        while self.queries and glGetQueryObjectiv(self.queries[0][1], GL_QUERY_RESULT_AVAILABLE):
+            queries = self.queries.popleft()
+            start, end = ctypes.c_uint64(), ctypes.c_uint64()
+            glGetQueryObjectui64vRaw(queries[0], GL_QUERY_RESULT, ctypes.byref(start))
+            glGetQueryObjectui64vRaw(queries[1], GL_QUERY_RESULT, ctypes.byref(end))
+            self.gpu_time = (end.value - start.value) / 1e9
+            self.free_queries.append(queries)
+
+    def update(self, cpu_time):
+        """Records how long the frame took and picks the scale of the next frames."""
+        if self.timed:
+            self.read_queries()
+        self.history.append((max(cpu_time, self.gpu_time), self.scale))
+        if not self.supported or self.budget <= 0:
+            return
+        if self.wait:
+            self.wait -= 1
+            return
+        frame_time = np.mean([frame_time for frame_time, _ in list(self.history)[-self.settle_frames:]])
+        if frame_time > self.budget:
+            # The time spent on pixels goes with the square of the scale
+            scale = math.floor(self.scale * max(math.sqrt(self.budget / frame_time), 0.7) / self.step + 1e-6) * self.step
+        elif frame_time < self.budget * self.headroom:
+            scale = self.scale + self.step
+        else:
+            return
+        scale = min(max(scale, self.min_scale), 1.0)
+        if scale != self.scale:
+            self.scale = scale
+            self.wait = self.settle_frames
+
+def quit_game(scene, profiler):
+    if trace_file:
+        profiler.save_trace(trace_file)
+    unload_scene(scene)
+    pygame.quit()
+    quit()
+
+def main():
+    global profiler_overlay
+    global is_day, transition_in_progress, transition_start_time
+    pygame.init()
+    display = (1920, 1080)
+    try:
+        pygame.display.set_mode(display, DOUBLEBUF | OPENGL, vsync=int(vsync))
+    except pygame.error:
+        pygame.display.set_mode(display, DOUBLEBUF | OPENGL)  # The driver does not let the swap interval be set. Only frame_cap paces the frames
+    init_opengl()
+    glEnable(GL_LIGHT0)
+    # We will set the light position in the main loop after applying camera transformations
+
+    scene = load_scene()
+    resolution = DynamicResolution(*display, frame_budget, min_resolution_scale)  # Probes the driver before count_gl_calls wraps its functions
+    profiler = FrameProfiler()
+    if profiler_overlay or trace_file:
+        count_gl_calls()  # Costs a little on every GL call, so only when asked for
+    overlay = ProfilerOverlay() if profiler_overlay else None  # Looking up its font takes a while, so only once it is shown
+    clock = pygame.time.Clock()
+    tick = 1 / simulation_rate
+    lag = 0  # Seconds of real time the simulation has not caught up with yet
+    previous_time = time.perf_counter()
 
     while True:
-        # PRT position updates
-        delta = time.time() - previousTime
-        previousTime = time.time()
-        speed += acceleration * delta
-        if speed > maxSpeed:
-            speed = maxSpeed
-        if speed < minSpeed:
-            speed = minSpeed
-        position += speed * delta
-        speed2 += acceleration * delta
-        if speed2 > maxSpeed:
-            speed2 = maxSpeed
-        if speed2 < minSpeed:
-            speed2 = minSpeed
-        position2 += speed2 * delta
-        if position > 112:
-            position = 0
-            speed = 0
-        if position2 > 110:
-            position2 = 0
-            speed2 = 0
-
-        for event in pygame.event.get():
+        frame_start = time.perf_counter()
+        with profiler.phase("assets"):
+            scene.assets.upload_ready(0.005)  # Keep streaming in assets without stalling the frame
+            compile_loaded_models(scene)
+
+        with profiler.phase("events"):
+            events = pygame.event.get()
+        for event in events:
             if event.type == pygame.QUIT:
-                pygame.quit()
-                quit()
+                quit_game(scene, profiler)
             elif event.type == KEYDOWN:
                 if event.key == K_p:
-                    acceleration = -acceleration  # Stop PRT cars
+                    scene.fleet.acceleration = -scene.fleet.acceleration  # Stop PRT cars
                 elif event.key == K_h:
-                    if human.is_waving:
-                        human.stop_waving()
+                    if scene.human.is_waving:
+                        scene.human.stop_waving()
                     else:
-                        human.start_waving(timeVar)
+                        scene.human.start_waving(render_time)
                 elif event.key == K_n:
                     if not transition_in_progress:
                         transition_in_progress = True
-                        transition_start_time = pygame.time.get_ticks()
+                        transition_start_time = render_time
                         is_day = not is_day  # Toggle between day and night
                 elif event.key == K_k:
-                    cars.append(Car([0, 0, -50]))
+                    scene.traffic.spawn()
                 elif event.key == K_g:
-                    if garage.is_opening:
-                        garage.stop_opening()
+                    if scene.garage.is_opening:
+                        scene.garage.stop_opening()
                     else:
-                        garage.start_opening(timeVar)
+                        scene.garage.start_opening(render_time)
+                elif event.key == K_F3:
+                    profiler_overlay = not profiler_overlay
+                    if overlay is None:
+                        overlay = ProfilerOverlay()
                 elif event.key == K_ESCAPE:
-                    pygame.quit()
-                    quit()
-
-        camera_controls()  # Update camera based on user input
+                    quit_game(scene, profiler)
+            elif event.type == MOUSEBUTTONDOWN and event.button == 1 and profiler_overlay:
+                overlay.picked = pick(scene, *event.pos)
+                overlay.age = overlay.refresh_frames  # Show it on the next frame
+
+        # Run as many fixed ticks as the time since the last frame holds, and show the scene between the last two
+        now = time.perf_counter()
+        lag = min(lag + now - previous_time, simulation_max_lag)
+        previous_time = now
+        with profiler.phase("update"):
+            while lag >= tick:
+                camera_controls()  # Update camera based on user input
+                step_scene(scene, tick)
+                lag -= tick
+            alpha = lag / tick
+            update_scene(scene, alpha)
 
         # Update the day/night transition before clearing the screen
-        update_day_night_cycle()
-
-        glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)  # Clear screen and depth buffer
+        with profiler.phase("daynight"):
+            update_day_night_cycle()
 
-        apply_camera()  # Apply camera transformations
+        with profiler.phase("clear"):
+            resolution.begin()
+            glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)  # Clear screen and depth buffer
+            apply_camera(alpha)  # Apply camera transformations, between the last two ticks like the rest of the scene
 
         # Set the light position after applying camera transformations
-        glLightfv(GL_LIGHT0, GL_POSITION, current_light_position)
-
-        glLightfv(GL_LIGHT1, GL_POSITION, [10, 50, 46, 1.0])
-        glLightfv(GL_LIGHT1, GL_SPOT_DIRECTION, [0.0, -1.0, 0.0])
-        glLightf(GL_LIGHT1, GL_SPOT_CUTOFF, 40.0)
-        glLightf(GL_LIGHT1, GL_SPOT_EXPONENT, 80)
-        #glLightfv(GL_LIGHT1, GL_AMBIENT, [0.1, 0.1, 0.1, 0.1])
-        glLightfv(GL_LIGHT1, GL_DIFFUSE, [1.0, 1.0, 1.0, 1.0])
-        glLightfv(GL_LIGHT1, GL_SPECULAR, [1.0, 1.0, 1.0, 1.0])
-        #glLightf(GL_LIGHT1, GL_LINEAR_ATTENUATION, 0.05)
-
-        glLightfv(GL_LIGHT2, GL_POSITION, [10, 50, 49, 1.0])
-        glLightfv(GL_LIGHT2, GL_SPOT_DIRECTION, [0.0, -1.0, 0.0])
-        glLightf(GL_LIGHT2, GL_SPOT_CUTOFF, 40.0)
-        glLightf(GL_LIGHT2, GL_SPOT_EXPONENT, 80)
-        #glLightfv(GL_LIGHT2, GL_AMBIENT, [0.1, 0.1, 0.1, 0.1])
-        glLightfv(GL_LIGHT2, GL_DIFFUSE, [1.0, 1.0, 1.0, 1.0])
-        glLightfv(GL_LIGHT2, GL_SPECULAR, [1.0, 1.0, 1.0, 1.0])
-        #glLightf(GL_LIGHT2, GL_LINEAR_ATTENUATION, 0.05)
-
-        glTranslatef(31, 20.5, 28)
-        #cube(3, 3, 3)
-        glTranslatef(-31, -20.5, -28)
-        glLightfv(GL_LIGHT3, GL_POSITION, [31, 50, 28, 1.0])
-        glLightfv(GL_LIGHT3, GL_SPOT_DIRECTION, [0.0, -1.0, 0.0])
-        glLightf(GL_LIGHT3, GL_SPOT_CUTOFF, 40.0)
-        glLightf(GL_LIGHT3, GL_SPOT_EXPONENT, 80)
-        #glLightfv(GL_LIGHT3, GL_AMBIENT, [0.1, 0.1, 0.1, 0.1])
-        glLightfv(GL_LIGHT3, GL_DIFFUSE, [1.0, 1.0, 1.0, 1.0])
-        glLightfv(GL_LIGHT3, GL_SPECULAR, [1.0, 1.0, 1.0, 1.0])
-        #glLightf(GL_LIGHT3, GL_LINEAR_ATTENUATION, 0.05)
-
-        glLightfv(GL_LIGHT4, GL_POSITION, [28, 50, 28, 1.0])
-        glLightfv(GL_LIGHT4, GL_SPOT_DIRECTION, [0.0, -1.0, 0.0])
-        glLightf(GL_LIGHT4, GL_SPOT_CUTOFF, 40.0)
-        glLightf(GL_LIGHT4, GL_SPOT_EXPONENT, 80)
-        #glLightfv(GL_LIGHT4, GL_AMBIENT, [0.1, 0.1, 0.1, 0.1])
-        glLightfv(GL_LIGHT4, GL_DIFFUSE, [1.0, 1.0, 1.0, 1.0])
-        glLightfv(GL_LIGHT4, GL_SPECULAR, [1.0, 1.0, 1.0, 1.0])
-        #glLightf(GL_LIGHT4, GL_LINEAR_ATTENUATION, 0.05)
-
-        glTranslatef(-18, 20.5, 68)
-        #cube(3, 3, 3)
-        glTranslatef(18, -20.5, -68)
-
-        glLightfv(GL_LIGHT5, GL_POSITION, [-21, 50, 65, 1.0])
-        glLightfv(GL_LIGHT5, GL_SPOT_DIRECTION, [0.0, -1.0, 0.0])
-        glLightf(GL_LIGHT5, GL_SPOT_CUTOFF, 40.0)
-        glLightf(GL_LIGHT5, GL_SPOT_EXPONENT, 80)
-        #glLightfv(GL_LIGHT5, GL_AMBIENT, [0.1, 0.1, 0.1, 0.1])
-        glLightfv(GL_LIGHT5, GL_DIFFUSE, [1.0, 1.0, 1.0, 1.0])
-        glLightfv(GL_LIGHT5, GL_SPECULAR, [1.0, 1.0, 1.0, 1.0])
-        #glLightf(GL_LIGHT5, GL_LINEAR_ATTENUATION, 0.05)
-
-        glLightfv(GL_LIGHT6, GL_POSITION, [-18, 50, 65, 1.0])
-        glLightfv(GL_LIGHT6, GL_SPOT_DIRECTION, [0.0, -1.0, 0.0])
-        glLightf(GL_LIGHT6, GL_SPOT_CUTOFF, 40.0)
-        glLightf(GL_LIGHT6, GL_SPOT_EXPONENT, 80)
-        #glLightfv(GL_LIGHT6, GL_AMBIENT, [0.1, 0.1, 0.1, 0.1])
-        glLightfv(GL_LIGHT6, GL_DIFFUSE, [1.0, 1.0, 1.0, 1.0])
-        glLightfv(GL_LIGHT6, GL_SPECULAR, [1.0, 1.0, 1.0, 1.0])
-        #glLightf(GL_LIGHT6, GL_LINEAR_ATTENUATION, 0.05)
-
-        if(is_day and lightOn and lightDelta < 4 or not is_day and not lightOn and lightDelta < 4):
-            lightDelta += delta
-        elif(lightDelta > 4):
-            lightOn = not lightOn
-            lightDelta = 0
-        
-        if(lightOn):
-            glEnable(GL_LIGHT1)
-            glEnable(GL_LIGHT2)
-            glEnable(GL_LIGHT3)
-            glEnable(GL_LIGHT4)
-            glEnable(GL_LIGHT5)
-            glEnable(GL_LIGHT6)
-        else:
-            glDisable(GL_LIGHT1)
-            glDisable(GL_LIGHT2)
-            glDisable(GL_LIGHT3)
-            glDisable(GL_LIGHT4)
-            glDisable(GL_LIGHT5)
-            glDisable(GL_LIGHT6)
+        with profiler.phase("lights"):
+            setup_lights()
 
         # Draw scene
-        draw_prt()
-        glCallList(scene_dl)
-        draw_human(human, human_body_model, human_arm_model)
-        draw_garage(garage, garage_model, (.7, .7, .7), (-26, -1, 40))
-        for car in cars:
-            car.pos = [car.pos[0], car.pos[1], car.pos[2] + delta * 10]
-            if car.pos[2] > 150:
-                cars.remove(car)
-                continue
-            draw_at(lambda: glCallList(car_dl), *car.pos)
-
-        pygame.display.flip()  # Swap buffers0
-        pygame.time.wait(10)  # Small delay to control camera speed
-        timeVar += 10
-
-main()
\ No newline at end of file
+        draw_scene(scene, profiler)
+        with profiler.phase("upscale"):
+            resolution.end()
+
+        if profiler_overlay:
+            with profiler.phase("overlay"):
+                overlay.draw(profiler)
+
+        resolution.update(time.perf_counter() - frame_start)  # Up to the swap, which waits for the vertical blank
+        profiler.count("resolution %", round(resolution.scale * 100))
+        profiler.count("gl calls skipped", gl_state.take_skipped())
+        with profiler.phase("flip"):
+            pygame.display.flip()  # Swap buffers, waiting for the vertical blank when vsync is on
+        if frame_cap:
+            with profiler.phase("pace"):
+                clock.tick(frame_cap)  # Sleeps rather than spins, giving the CPU back
+        profiler.end_frame()
+
+def bake_mesh_cache():
+    """Rebuilds the model cache of every obj file in Resources so the next launch does not parse any of them."""
+    for obj_file in sorted(glob.glob("Resources/*.obj")):
+        obj_file = obj_file.replace(os.sep, '/')
+        Model.save_cache(obj_file, *Model.parse_obj(obj_file))
+        print("Baked " + Model.cache_file(obj_file))
+
+def create_offscreen_context(width, height):
+    """Makes a GL context current without opening a window. Uses EGL, or OSMesa when PYOPENGL_PLATFORM is osmesa."""
+    if os.environ.get("PYOPENGL_PLATFORM") == "osmesa":
+        from OpenGL import osmesa
+        context = osmesa.OSMesaCreateContextExt(osmesa.OSMESA_RGBA, 24, 0, 0, None)
+        buffer = np.zeros((height, width, 4), np.uint8)
+        if not context or not osmesa.OSMesaMakeCurrent(context, buffer, GL_UNSIGNED_BYTE, width, height):
+            raise Exception("Could not create an OSMesa context")
+        return context, buffer
+
+    from OpenGL import EGL
+    display = EGL.eglGetDisplay(EGL.EGL_DEFAULT_DISPLAY)
+    if not display or not EGL.eglInitialize(display, None, None):
+        raise Exception("Could not initialize EGL")
+    config = EGL.EGLConfig()
+    count = EGL.EGLint()
+    attributes = [EGL.EGL_SURFACE_TYPE, EGL.EGL_PBUFFER_BIT, EGL.EGL_RENDERABLE_TYPE, EGL.EGL_OPENGL_BIT,
+                  EGL.EGL_RED_SIZE, 8, EGL.EGL_GREEN_SIZE, 8, EGL.EGL_BLUE_SIZE, 8, EGL.EGL_DEPTH_SIZE, 24, EGL.EGL_NONE]
+    if not EGL.eglChooseConfig(display, (EGL.EGLint * len(attributes))(*attributes), ctypes.pointer(config), 1, ctypes.pointer(count)) or count.value == 0:
+        raise Exception("No EGL config supports offscreen OpenGL rendering")
+    surface_attributes = [EGL.EGL_WIDTH, width, EGL.EGL_HEIGHT, height, EGL.EGL_NONE]
+    surface = EGL.eglCreatePbufferSurface(display, config, (EGL.EGLint * len(surface_attributes))(*surface_attributes))
+    EGL.eglBindAPI(EGL.EGL_OPENGL_API)
+    context = EGL.eglCreateContext(display, config, EGL.EGL_NO_CONTEXT, None)
+    if not context or not EGL.eglMakeCurrent(display, surface, surface, context):
+        raise Exception("Could not create an EGL context")
+    return display, surface, context
+
+def percentiles(samples):
+    """Summarizes a list of durations in seconds as milliseconds."""
+    ms = np.asarray(samples, np.float64) * 1000
+    return {
+        "mean": round(float(ms.mean()), 3),
+        "p50": round(float(np.percentile(ms, 50)), 3),
+        "p95": round(float(np.percentile(ms, 95)), 3),
+        "p99": round(float(np.percentile(ms, 99)), 3),
+        "max": round(float(ms.max()), 3),
+    }
+
+def run_benchmark(frames, width, height, output=None, warmup=10, budget=0):
+    """Renders a scripted sequence of frames offscreen and returns how long every phase of a frame took, written to output as JSON.
+    With a frame budget the resolution is scaled like in the window, otherwise every frame is drawn at full resolution."""
+    global is_day, transition_in_progress, transition_start_time
+    context = create_offscreen_context(width, height)
+    pygame.init()  # No window is opened
+    init_opengl()
+    glViewport(0, 0, width, height)
+    glEnable(GL_LIGHT0)
+
+    start = time.perf_counter()
+    scene = load_scene()
+    scene.assets.finish()
+    compile_loaded_models(scene)
+    load_time = time.perf_counter() - start
+
+    profiler = FrameProfiler(frames + warmup)
+    resolution = DynamicResolution(width, height, budget, min_resolution_scale)
+    delta = 1 / simulation_rate  # One tick per frame, so every run simulates the same thing
+    for frame in range(frames + warmup):
+        frame_start = time.perf_counter()
+        # Orbit the camera around the scene while the script triggers every animation
+        camera_rotation[1] = frame * 360 / (frames + warmup)
+        if frame % 30 == 0:
+            scene.traffic.spawn()
+        if frame % 120 == 0:
+            scene.human.start_waving(render_time)
+            scene.garage.start_opening(render_time)
+        if frame == (frames + warmup) // 2 and not transition_in_progress:
+            transition_in_progress = True
+            transition_start_time = render_time
+            is_day = not is_day
+
+        with profiler.phase("update"):
+            step_scene(scene, delta)
+            update_scene(scene, 1)
+            update_day_night_cycle()
+        resolution.begin()
+        glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+        apply_camera()
+        with profiler.phase("lights"):
+            setup_lights()
+        draw_scene(scene, profiler)
+        with profiler.phase("upscale"):
+            resolution.end()
+        with profiler.phase("finish"):
+            glFinish()  # Wait for the GPU so the frame time includes the rendering itself
+        resolution.update(time.perf_counter() - frame_start)
+        profiler.count("resolution %", round(resolution.scale * 100))
+        profiler.count("gl calls skipped", gl_state.take_skipped())
+        profiler.end_frame()
+
+    measured = list(profiler.frames)[warmup:]
+    frame_times = [sample.duration for sample in measured]
+    report = {
+        "renderer": glGetString(GL_RENDERER).decode(),
+        "resolution": [width, height],
+        "pods": len(scene.fleet.position),
+        "frames": len(measured),
+        "load_seconds": round(load_time, 3),
+        "fps": round(len(frame_times) / sum(frame_times), 2),
+        "frame_ms": percentiles(frame_times),
+        "phases_ms": {name: percentiles([sample.phases.get(name, 0) for sample in measured]) for name in measured[0].phases},
+        "counters": {name: round(sum(sample.counters.get(name, 0) for sample in measured) / len(measured), 2) for name in sorted(measured[-1].counters)},
+    }
+    if output:
+        with open(output, "w") as file:
+            json.dump(report, file, indent=2)
+    if trace_file:
+        profiler.save_trace(trace_file)
+    unload_scene(scene)
+    return report
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--bake-cache", action="store_true", help="compile every model in Resources into its cache file and exit")
+    parser.add_argument("--texture-max-size", type=int, help="downsample textures larger than this many pixels on a side")
+    parser.add_argument("--texture-compression", action="store_true", help="keep textures S3TC compressed on the GPU and in the texture cache, which is lossy")
+    parser.add_argument("--benchmark", action="store_true", help="render a scripted sequence of frames offscreen and print frame time statistics as JSON")
+    parser.add_argument("--frames", type=int, default=600, help="number of frames the benchmark measures")
+    parser.add_argument("--size", type=int, nargs=2, default=(1920, 1080), metavar=("WIDTH", "HEIGHT"), help="resolution the benchmark renders at")
+    parser.add_argument("--output", help="also write the benchmark report to this file")
+    parser.add_argument("--pods", type=int, default=2, help=f"number of PRT pods on the guideway, at most {PrtFleet.capacity(prt_routes)}")
+    parser.add_argument("--max-cars", type=int, default=traffic_capacity, help="most cars on the road at once")
+    parser.add_argument("--forest", default=forest_file, help="csv or npy table of the trees in the scene")
+    parser.add_argument("--trees", type=int, help="generate this many random trees instead of loading the table")
+    parser.add_argument("--forest-seed", type=int, default=0, help="seed of the random trees")
+    parser.add_argument("--lod-scale", type=float, default=lod_scale, help="multiply the sizes on screen at which objects switch to simpler levels of detail, 0 always draws full detail")
+    parser.add_argument("--tick-rate", type=int, default=simulation_rate, help="simulation ticks per second")
+    parser.add_argument("--no-vsync", action="store_true", help="swap buffers without waiting for the vertical blank")
+    parser.add_argument("--fps-cap", type=int, default=frame_cap, help="most frames drawn per second, 0 for no limit other than vsync")
+    parser.add_argument("--frame-budget", type=float, help=f"milliseconds a frame may take before the scene is drawn at a lower resolution, 0 never lowers it (default {frame_budget * 1000:.1f}, the benchmark draws at full resolution unless it is given)")
+    parser.add_argument("--min-scale", type=float, default=min_resolution_scale, help="lowest fraction of the window's resolution the scene is drawn at")
+    parser.add_argument("--per-pixel-lighting", action="store_true", help="light the scene per pixel in shaders, with the lights of the guideway added to the street lights at night")
+    parser.add_argument("--profile", action="store_true", help="show the per-phase frame times and GL call counts on screen (F3 toggles it)")
+    parser.add_argument("--trace", help="write a Chrome trace of the most recent frames to this file on exit")
+    args = parser.parse_args()
+    if not 0 <= args.pods <= PrtFleet.capacity(prt_routes):
+        parser.error(f"--pods must be between 0 and {PrtFleet.capacity(prt_routes)}, the most pods that fit on the guideway")
+    texture_max_size = args.texture_max_size
+    texture_compression = args.texture_compression
+    profiler_overlay = args.profile
+    trace_file = args.trace
+    prt_pods = args.pods
+    traffic_capacity = args.max_cars
+    forest_file = args.forest
+    forest_trees = args.trees
+    forest_seed = args.forest_seed
+    lod_scale = args.lod_scale
+    simulation_rate = args.tick_rate
+    vsync = not args.no_vsync
+    frame_cap = args.fps_cap
+    if args.frame_budget is not None:
+        frame_budget = args.frame_budget / 1000
+    min_resolution_scale = args.min_scale
+    per_pixel_lighting = args.per_pixel_lighting
+    if args.bake_cache:
+        bake_mesh_cache()
+    elif args.benchmark:
+        with redirect_stdout(sys.stderr):  # Messages printed while loading would break the JSON on stdout
+            report = run_benchmark(args.frames, *args.size, args.output, budget=frame_budget if args.frame_budget is not None else 0)
+        print(json.dumps(report, indent=2))
+    else:
+        main()
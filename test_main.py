@@ -0,0 +1,82 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+import main
+
+
+def write_obj(tmp_path, faces):
+    obj_file = tmp_path / "model.obj"
+    obj_file.write_text("v 0 0 0\nv 1 0 0\nv 0 1 0\nvt 0 0\nvn 0 0 1\n" + faces)
+    return str(obj_file)
+
+
+def test_parse_obj_reads_full_corners(tmp_path):
+    _, _, _, faces, face_sizes, _, _ = main.Model.parse_obj(write_obj(tmp_path, "f 1/1/1 2/1/1 3/1/1\n"))
+    assert faces.tolist() == [[0, 0, 0], [1, 0, 0], [2, 0, 0]]
+    assert face_sizes.tolist() == [3]
+
+
+@pytest.mark.parametrize("face", ["f 1//1 2//1 3//1", "f 1 2 3"])
+def test_parse_obj_rejects_other_corner_formats(tmp_path, face):
+    with pytest.raises(ValueError, match="v/vt/vn"):
+        main.Model.parse_obj(write_obj(tmp_path, face + "\n"))
+
+
+def test_untextured_model_after_textured_one_in_batch_draws_without_texture(monkeypatch):
+    state = {"texturing": False, "texture": 0}
+    drawn = []
+    monkeypatch.setattr(main, "gl_state", main.GLStateCache())
+    monkeypatch.setattr(main, "glEnable", lambda capability: state.update(texturing=True))
+    monkeypatch.setattr(main, "glDisable", lambda capability: state.update(texturing=False))
+    monkeypatch.setattr(main, "glBindTexture", lambda target, texture_id: state.update(texture=texture_id))
+    monkeypatch.setattr(main, "glMaterial", lambda face, name, value: None)
+    monkeypatch.setattr(main.Model, "draw_geometry", lambda self: drawn.append(dict(state)))
+
+    def model(texture, texture_id):
+        model = object.__new__(main.Model)
+        model.texture, model.texture_id, model.material = texture, texture_id, main.Model.default_material
+        return model
+
+    with main.gl_state.batch():
+        main.draw_model(model(object(), 7))
+        main.draw_model(model(None, -1))
+    assert drawn == [{"texturing": True, "texture": 7}, {"texturing": False, "texture": 7}]
+    assert state == {"texturing": False, "texture": 0}
+
+
+def test_benchmark_writes_only_the_report_to_stdout():
+    result = subprocess.run([sys.executable, "main.py", "--benchmark", "--frames", "2", "--size", "64", "36"],
+                            cwd=os.path.dirname(os.path.abspath(main.__file__)), capture_output=True, text=True, timeout=600)
+    assert result.returncode == 0, result.stderr
+    report = json.loads(result.stdout)
+    assert report["resolution"] == [64, 36]
+    assert report["frames"] == 2
+
+
+def test_prt_fleet_rejects_more_pods_than_fit():
+    capacity = main.PrtFleet.capacity(main.prt_routes)
+    assert len(main.PrtFleet(main.prt_routes, capacity).position) == capacity
+    with pytest.raises(ValueError, match=f"at most {capacity}"):
+        main.PrtFleet(main.prt_routes, capacity + 1)
+
+
+@pytest.mark.parametrize("keep", [0, 40, 200])
+def test_model_load_reparses_a_corrupt_cache(tmp_path, keep):
+    obj_file = write_obj(tmp_path, "f 1/1/1 2/1/1 3/1/1\n")
+    main.Model.save_cache(obj_file, *main.Model.parse_obj(obj_file))
+    cache_file = main.Model.cache_file(obj_file)
+    with open(cache_file, "r+b") as cache:
+        cache.truncate(keep)
+    assert main.Model.load_cache(obj_file) is None
+    assert len(main.Model.load(obj_file).indices) == 3
+    assert main.Model.load_cache(obj_file) is not None
+
+
+@pytest.mark.parametrize("line", ["v 1 0 oops", "v 1 0", "vn 0 0", "vt 0.5 x"])
+def test_parse_obj_rejects_malformed_elements(tmp_path, line):
+    with pytest.raises(ValueError, match="cannot parse line"):
+        main.Model.parse_obj(write_obj(tmp_path, line + "\nf 1/1/1 2/1/1 3/1/1\n"))